@@ -0,0 +1,265 @@
+"""Benchmarks of the orchestration layer
+
+Synthetic subjects are processed by the batch workflow with stub executables in
+place of MRtrix3, FSL and NiftyReg (see benchmarks.stubs), so that the measures
+only reflect mrproc and Nipype:
++ import: import of mrproc.workflows.batch in a fresh interpreter
++ construct: creation of the batch workflow
++ construct_per_subject: creation of one single subject workflow
++ expand: flattening and iterables expansion of the execution graph
++ run: execution with the MultiProc plugin (scheduler overhead per node)
++ rerun: second execution in the same working directory (Nipype cache hits)
++ store_rerun: execution in a new working directory sharing the result store
+
+Usage, from the repository root:
+python -m benchmarks.run_benchmarks --subjects 1 10 100 500 --run-subjects 1 10 \
+    -o results.json
+python -m benchmarks.run_benchmarks --baseline results.json --tolerance 0.25
+The second form exits with status 1 when a measure is slower than the baseline by
+more than the tolerance.
+"""
+
+import argparse
+import copy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from nipype import config
+from nipype import logging
+from nipype.pipeline.engine.utils import generate_expanded_graph
+
+from benchmarks.stubs import install_stubs
+from benchmarks.synthetic import make_dataset
+from mrproc.workflows.batch import create_batch_dwi_processing_pipeline
+from mrproc.workflows.batch import read_manifest
+from mrproc.workflows.batch import run_batch
+from mrproc.workflows.dwi_processing import create_dwi_processing_pipeline
+
+# Measures with less than this duration (s) are not checked against the baseline
+MIN_DURATION = 0.05
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_call(function, *args, **kwargs):
+    """
+    Call a function and measure its duration
+    :return: result, duration (s)
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def create_batch(subjects, work_dir, result_store=None):
+    batch = create_batch_dwi_processing_pipeline(
+        subjects,
+        nb_tracks=1000,
+        min_length=30,
+        max_length=300,
+        result_store=result_store,
+    )
+    batch.base_dir = work_dir
+    return batch
+
+
+def expand_graph(batch):
+    """
+    Build the execution graph of a workflow as Workflow.run does
+    :param batch: workflow
+    :return: execution graph
+    """
+    flat_graph = batch._create_flat_graph()
+    batch._set_needed_outputs(flat_graph)
+    return generate_expanded_graph(copy.deepcopy(flat_graph))
+
+
+def benchmark_import(repeat=5):
+    """
+    Measure the import of the batch module in fresh interpreters
+    :param repeat: number of imports, the fastest one is kept
+    :return: dict of measures
+    """
+    command = [sys.executable, "-c", "import mrproc.workflows.batch"]
+    # Import the mrproc of this checkout wherever the benchmarks are run from
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [REPO_ROOT] + [p for p in [os.environ.get("PYTHONPATH")] if p]
+    )
+    durations = [
+        time_call(
+            subprocess.run,
+            command,
+            check=True,
+            cwd=REPO_ROOT,
+            env=env,
+            stderr=subprocess.DEVNULL,
+        )[1]
+        for _ in range(repeat)
+    ]
+    return {"import": min(durations)}
+
+
+def benchmark_graph(subjects, work_dir):
+    """
+    Measure the construction and expansion of the batch workflow
+    :param subjects: subject records
+    :param work_dir: working directory of the workflow
+    :return: dict of measures
+    """
+    batch, construct = time_call(create_batch, subjects, work_dir)
+    graph, expand = time_call(expand_graph, batch)
+    _, construct_subjects = time_call(
+        lambda: [create_dwi_processing_pipeline() for _ in subjects]
+    )
+    return {
+        "construct": construct,
+        "construct_per_subject": construct_subjects / len(subjects),
+        "expand": expand,
+        "nb_nodes": graph.number_of_nodes(),
+    }
+
+
+def benchmark_run(subjects, work_dir, n_procs):
+    """
+    Measure executions and cache-hit reruns of the batch workflow
+    :param subjects: subject records
+    :param work_dir: directory of the working directories and result store
+    :param n_procs: number of processes of the MultiProc plugin
+    :return: dict of measures
+    """
+    store = os.path.join(work_dir, "store")
+    batch = create_batch(subjects, os.path.join(work_dir, "run"), store)
+    graph, run = time_call(run_batch, batch, n_procs=n_procs)
+    batch = create_batch(subjects, os.path.join(work_dir, "run"), store)
+    _, rerun = time_call(run_batch, batch, n_procs=n_procs)
+    batch = create_batch(subjects, os.path.join(work_dir, "store_run"), store)
+    _, store_rerun = time_call(run_batch, batch, n_procs=n_procs)
+    nb_nodes = graph.number_of_nodes()
+    return {
+        "run": run,
+        "run_per_node": run / nb_nodes,
+        "rerun": rerun,
+        "store_rerun": store_rerun,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    List the measures slower than a baseline
+    :param results: benchmark results
+    :param baseline: results of a previous benchmark
+    :param tolerance: allowed relative slowdown
+    :return: list of (nb_subjects, measure, baseline value, value)
+    """
+    regressions = []
+    for nb_subjects, measures in results.items():
+        for measure, value in measures.items():
+            reference = baseline.get(nb_subjects, {}).get(measure)
+            if reference is None or measure == "nb_nodes":
+                continue
+            if value > MIN_DURATION and value > reference * (1 + tolerance):
+                regressions.append((nb_subjects, measure, reference, value))
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the mrproc orchestration layer with synthetic "
+        "subjects and stub executables"
+    )
+    parser.add_argument(
+        "--subjects",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100, 500],
+        help="cohort sizes of the construction and expansion benchmarks",
+    )
+    parser.add_argument(
+        "--run-subjects",
+        type=int,
+        nargs="*",
+        default=[1, 10],
+        help="cohort sizes of the execution benchmarks",
+    )
+    parser.add_argument(
+        "--n-procs", type=int, default=4, help="processes of the MultiProc plugin"
+    )
+    parser.add_argument(
+        "--stub-config",
+        help='JSON file of stub behaviours, e.g. {"tckgen": {"sleep": 1.0}}',
+    )
+    parser.add_argument("--work-dir", help="working directory (default: temporary)")
+    parser.add_argument("-o", "--output", help="JSON file receiving the results")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative slowdown with respect to the baseline",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    config.set("logging", "workflow_level", "WARNING")
+    config.set("execution", "crashfile_format", "txt")
+    logging.update_logging(config)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="mrproc_benchmarks_")
+    stub_config = None
+    if args.stub_config:
+        with open(args.stub_config) as f:
+            stub_config = json.load(f)
+    os.environ.update(install_stubs(os.path.join(work_dir, "bin"), stub_config))
+    nb_subjects = max(args.subjects + args.run_subjects)
+    subjects = read_manifest(make_dataset(os.path.join(work_dir, "data"), nb_subjects))
+
+    results = {"import": benchmark_import()}
+    print("import: %.3f" % results["import"]["import"], flush=True)
+    for n in sorted(set(args.subjects + args.run_subjects)):
+        measures = {}
+        if n in args.subjects:
+            measures.update(
+                benchmark_graph(subjects[:n], os.path.join(work_dir, "graph_%d" % n))
+            )
+        if n in args.run_subjects:
+            measures.update(
+                benchmark_run(
+                    subjects[:n], os.path.join(work_dir, "run_%d" % n), args.n_procs
+                )
+            )
+        results[str(n)] = measures
+        print(
+            "%5d subjects: %s"
+            % (
+                n,
+                ", ".join(
+                    "%s=%.3f" % item if isinstance(item[1], float) else "%s=%d" % item
+                    for item in measures.items()
+                ),
+            ),
+            flush=True,
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for nb_subjects, measure, reference, value in regressions:
+            print(
+                "Regression: %s subjects, %s %.3fs -> %.3fs"
+                % (nb_subjects, measure, reference, value)
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
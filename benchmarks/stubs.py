@@ -0,0 +1,120 @@
+"""Stub executables standing in for MRtrix3, FSL and NiftyReg
+
+Each stub sleeps, burns CPU and writes every output file found on its command
+line (non-existing arguments with an image, tractogram or text extension) with a
+configurable size. The behaviour is read from the JSON file pointed to by
+MRPROC_STUB_CONFIG, e.g.:
+{"default": {"sleep": 0.0, "cpu": 0.0, "output_mb": 0.0},
+ "tckgen": {"sleep": 2.0, "output_mb": 50}}
+"""
+
+import json
+import os
+import stat
+import sys
+
+# Commands launched by the mrproc workflows
+TOOLS = [
+    "mrconvert",
+    "dwibiascorrect",
+    "dwi2mask",
+    "dwi2tensor",
+    "tensor2metric",
+    "5ttgen",
+    "dwi2response",
+    "dwi2fod",
+    "tckgen",
+    "tckedit",
+    "tcksift",
+    "tcksift2",
+    "bet",
+    "flirt",
+    "convert_xfm",
+    "reg_f3d",
+    "reg_aladin",
+    "reg_resample",
+    # Called by dwibiascorrect ants and 5ttgen fsl (see mrproc.preflight)
+    "N4BiasFieldCorrection",
+    "fast",
+    "run_first_all",
+]
+
+STUB_TEMPLATE = '''#!{python}
+"""Stub of {tool} generated by benchmarks/stubs.py"""
+import json
+import os
+import sys
+import time
+
+TOOL = "{tool}"
+OUTPUT_EXTENSIONS = (
+    ".mif", ".mih", ".nii", ".nii.gz", ".tck", ".txt", ".mat", ".csv", ".json"
+)
+
+
+def main(argv):
+    if argv in (["--version"], ["-version"], ["-v"]):
+        if TOOL.startswith("reg_"):
+            print("1.5.68")
+        elif TOOL in ("bet", "flirt", "convert_xfm", "fast", "run_first_all"):
+            print("%s version 6.0.7" % TOOL)
+        else:
+            print("== %s 3.0.4" % TOOL)
+        return 0
+    entry = {{"sleep": 0.0, "cpu": 0.0, "output_mb": 0.0}}
+    config_file = os.environ.get("MRPROC_STUB_CONFIG")
+    if config_file:
+        with open(config_file) as f:
+            config = json.load(f)
+        entry.update(config.get("default", {{}}))
+        entry.update(config.get(TOOL, {{}}))
+    time.sleep(entry["sleep"])
+    deadline = time.process_time() + entry["cpu"]
+    while time.process_time() < deadline:
+        pass
+    size = int(entry["output_mb"] * 1024 ** 2)
+    block = b"\\0" * min(size, 1024 ** 2)
+    outputs = list(argv)
+    # reg_f3d -vel also writes the backward transformation and image
+    if TOOL == "reg_f3d" and "-vel" in argv:
+        for option in ("-cpp", "-res"):
+            if option in argv:
+                stem = argv[argv.index(option) + 1].split(".nii")[0]
+                outputs.append(stem + "_backward.nii.gz")
+    for arg in outputs:
+        if arg.endswith(OUTPUT_EXTENSIONS) and not os.path.exists(arg):
+            with open(arg, "wb") as f:
+                written = 0
+                while written < size:
+                    f.write(block[: size - written])
+                    written += len(block)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+'''
+
+
+def install_stubs(bin_dir, config=None):
+    """
+    Write the stub executables and their configuration
+    :param bin_dir: directory of the stubs (to be put first on PATH)
+    :param config: dict of tool behaviours (see module docstring)
+    :return: environment variables to set (PATH, MRPROC_STUB_CONFIG and
+    FSLOUTPUTTYPE)
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(STUB_TEMPLATE.format(python=sys.executable, tool=tool))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP)
+    config_file = os.path.join(bin_dir, "stub_config.json")
+    with open(config_file, "w") as f:
+        json.dump(config or {}, f)
+    return {
+        "PATH": os.path.abspath(bin_dir) + os.pathsep + os.environ.get("PATH", ""),
+        "MRPROC_STUB_CONFIG": config_file,
+        "FSLOUTPUTTYPE": "NIFTI_GZ",
+    }
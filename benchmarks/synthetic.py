@@ -0,0 +1,68 @@
+"""Synthetic subjects for the benchmarks
+
+Every subject gets a tiny 4D diffusion volume (one b=0 and six directions), its
+FSL gradient tables and a T1 volume. Contents are random: the stub executables
+never read them, only the orchestration layer is exercised.
+"""
+
+import os
+import zlib
+
+import nibabel
+import numpy as np
+
+BVALS = [0, 1000, 1000, 1000, 1000, 1000, 1000]
+BVECS = [
+    [0, 1, 0, 0, 0.7071, 0.7071, 0],
+    [0, 0, 1, 0, 0.7071, 0, 0.7071],
+    [0, 0, 0, 1, 0, 0.7071, 0.7071],
+]
+
+
+def make_subject(directory, subject_id, dwi_shape=(8, 8, 4), t1_shape=(16, 16, 8)):
+    """
+    Write the input files of one synthetic subject
+    :param directory: output directory
+    :param subject_id: subject identifier
+    :param dwi_shape: spatial shape of the diffusion volume
+    :param t1_shape: shape of the T1 volume
+    :return: subject record (see mrproc.workflows.batch.read_manifest)
+    """
+    # crc32 rather than hash(): string hashes are salted per interpreter
+    rng = np.random.default_rng(zlib.crc32(subject_id.encode()))
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.join(directory, subject_id)
+    dwi = rng.random(tuple(dwi_shape) + (len(BVALS),)).astype(np.float32)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    nibabel.save(nibabel.Nifti1Image(dwi, affine), prefix + "_dwi.nii.gz")
+    t1 = rng.random(t1_shape).astype(np.float32)
+    nibabel.save(nibabel.Nifti1Image(t1, np.eye(4)), prefix + "_T1w.nii.gz")
+    np.savetxt(prefix + "_dwi.bval", [BVALS], fmt="%d")
+    np.savetxt(prefix + "_dwi.bvec", BVECS, fmt="%.4f")
+    return {
+        "subject_id": subject_id,
+        "diffusion_volume": prefix + "_dwi.nii.gz",
+        "bvals": prefix + "_dwi.bval",
+        "bvecs": prefix + "_dwi.bvec",
+        "t1_volume": prefix + "_T1w.nii.gz",
+    }
+
+
+def make_dataset(root, nb_subjects):
+    """
+    Write nb_subjects synthetic subjects and their manifest
+    :param root: dataset directory
+    :param nb_subjects: number of subjects
+    :return: path of the TSV manifest
+    """
+    subjects = [
+        make_subject(os.path.join(root, "sub-%04d" % i), "sub-%04d" % i)
+        for i in range(nb_subjects)
+    ]
+    manifest = os.path.join(root, "subjects.tsv")
+    fields = ["subject_id", "diffusion_volume", "bvals", "bvecs", "t1_volume"]
+    with open(manifest, "w") as f:
+        f.write("\t".join(fields) + "\n")
+        for subject in subjects:
+            f.write("\t".join(subject[field] for field in fields) + "\n")
+    return manifest
@@ -0,0 +1,405 @@
+"""Event-driven execution of workflows from an asyncio event loop
+
+Nearly every node of the diffusion workflows wraps a command line tool, the
+Python side of the execution mostly waits for child processes. The Nipype
+distributed plugins (MultiProc included) check their running jobs every
+poll_sleep_duration seconds, and the commands are read by a select loop, so that
+every edge of the graph costs up to a polling period.
+
+AsyncioPlugin runs the scheduler as an asyncio event loop in a single process:
++ commands of the command line nodes are launched as asyncio subprocesses, their
+standard output and error are streamed to stdout.log and stderr.log in the
+_report directory of the node as they come (kept by the cleanup of the node
+directory), and the exit of a command wakes the loop up at once
++ the Nipype bookkeeping of these nodes (hashing, input and result files) runs in
+threads taking turns under a lock, as it changes the working directory of the
+process; a thread hands the lock over while its command runs, so that any number
+of commands run at the same time
++ Python steps (Function nodes, DataSink...) run in a pool of worker processes,
+unless their results are cached
++ MapNode iterations are scheduled as independent jobs, as MultiProc does
+A node starts as soon as its last dependency completes and the CPU and memory
+budget (n_procs, memory_gb) allows it: scheduling latency between dependent nodes
+drops to the bookkeeping time, milliseconds for most nodes.
+
+The bookkeeping is serialized: nodes completing together wait for each other's
+bookkeeping, one node at a time, and Python code running in other threads of the
+process sees its working directory change. Its cost is small next to the
+commands of the diffusion workflows; with many short commands on large inputs
+hashed by content, MultiProc, which does the bookkeeping in worker processes,
+scales better.
+
+Nipype calls nipype.interfaces.base.core.run_command for every command line
+interface. While runs of the plugin are in progress, it is replaced with
+run_command, which hands the command over to the event loop only in the node
+threads of the plugin and calls the function it replaced anywhere else.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from traceback import format_exception
+
+import networkx as nx
+from nipype import logging
+from nipype.interfaces.base import CommandLine
+from nipype.interfaces.base import core as interface_core
+from nipype.interfaces.utility import IdentityInterface
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.plugins.base import PluginBase
+from nipype.pipeline.plugins.multiproc import run_node
+from nipype.pipeline.plugins.tools import report_crash
+from nipype.pipeline.plugins.tools import report_nodes_not_run
+from nipype.utils.filemanip import canonicalize_env
+from nipype.utils.profiler import get_system_total_memory_gb
+from nipype.utils.subprocess import run_command as nipype_run_command
+
+logger = logging.getLogger("nipype.workflow")
+
+# Bookkeeping of the command line nodes, which changes the working directory
+_BOOKKEEPING = threading.Lock()
+# Event loop of the node being run, None outside of AsyncioPlugin threads
+_NODE_LOOP = contextvars.ContextVar("asyncio_plugin_loop", default=None)
+# Runs of the plugin in progress, the run_command they replaced
+_HOOK_LOCK = threading.Lock()
+_hook_users = 0
+_replaced_run_command = nipype_run_command
+# Bytes read at once from the standard output and error of a command
+READ_SIZE = 1 << 16
+
+
+async def run_command_async(cmdline, cwd, environ):
+    """
+    Run a shell command, streaming its standard output and error to stdout.log
+    and stderr.log in the _report directory of its working directory
+    :param cmdline: command line
+    :param cwd: working directory
+    :param environ: environment of the command
+    :return: return code, standard output, standard error (str)
+    """
+    process = await asyncio.create_subprocess_shell(
+        cmdline,
+        cwd=cwd,
+        env=canonicalize_env(environ),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    report_dir = os.path.join(cwd, "_report")
+    os.makedirs(report_dir, exist_ok=True)
+
+    async def pump(stream, name):
+        chunks = []
+        with open(os.path.join(report_dir, name + ".log"), "wb") as log:
+            while True:
+                chunk = await stream.read(READ_SIZE)
+                if not chunk:
+                    break
+                log.write(chunk)
+                log.flush()
+                chunks.append(chunk)
+        return b"".join(chunks).decode("utf-8", errors="replace")
+
+    stdout, stderr = await asyncio.gather(
+        pump(process.stdout, "stdout"), pump(process.stderr, "stderr")
+    )
+    return await process.wait(), stdout, stderr
+
+
+def run_command(runtime, output=None, timeout=0.01, write_cmdline=False):
+    """
+    nipype.utils.subprocess.run_command, handing the command over to the event loop
+    of AsyncioPlugin when called from one of its node threads
+    """
+    loop = _NODE_LOOP.get()
+    if loop is None:
+        return _replaced_run_command(
+            runtime, output=output, timeout=timeout, write_cmdline=write_cmdline
+        )
+    if write_cmdline:
+        with open(os.path.join(runtime.cwd, "command.txt"), "w") as f:
+            f.write(runtime.cmdline)
+    cwd = os.getcwd()
+    future = asyncio.run_coroutine_threadsafe(
+        run_command_async(runtime.cmdline, runtime.cwd, runtime.environ), loop
+    )
+    # Other nodes do their bookkeeping while the command runs
+    _BOOKKEEPING.release()
+    try:
+        returncode, stdout, stderr = future.result()
+    finally:
+        _BOOKKEEPING.acquire()
+        os.chdir(cwd)
+    runtime.returncode = returncode
+    runtime.stdout = stdout
+    runtime.stderr = stderr
+    runtime.merged = "\n".join(part for part in [stdout, stderr] if part)
+    return runtime
+
+
+@contextlib.contextmanager
+def _command_hook():
+    """
+    Install run_command in place of the run_command of the Nipype interfaces for
+    the duration of a run, concurrent runs share it
+    """
+    global _hook_users, _replaced_run_command
+    with _HOOK_LOCK:
+        if not _hook_users and interface_core.run_command is not run_command:
+            _replaced_run_command = interface_core.run_command
+            interface_core.run_command = run_command
+        _hook_users += 1
+    try:
+        yield
+    finally:
+        with _HOOK_LOCK:
+            _hook_users -= 1
+            if not _hook_users and interface_core.run_command is run_command:
+                interface_core.run_command = _replaced_run_command
+
+
+def _run_in_thread(node, updatehash, taskid, loop, cwd):
+    """Run a node in a thread of the plugin (see run_node)"""
+    token = _NODE_LOOP.set(loop)
+    try:
+        with _BOOKKEEPING:
+            os.chdir(cwd)
+            return run_node(node, updatehash, taskid)
+    finally:
+        _NODE_LOOP.reset(token)
+
+
+def _is_cached(node, cwd):
+    with _BOOKKEEPING:
+        os.chdir(cwd)
+        cached, updated = node.is_cached()
+    return cached and updated
+
+
+def _subnodes(node, cwd):
+    with _BOOKKEEPING:
+        os.chdir(cwd)
+        return list(node.get_subnodes())
+
+
+class AsyncioPlugin(PluginBase):
+    """
+    Execute a workflow from an asyncio event loop
+
+    Plugin arguments:
+    + n_procs: processors shared by the nodes (default: all)
+    + memory_gb: memory (GB) shared by the nodes (default: 90% of the system
+    memory)
+    + raise_insufficient: if False, a node needing more than the budget runs
+    alone instead of failing the run (default True)
+    + python_workers: processes running the Python steps (default: n_procs)
+    + mp_context: start method of these processes (default "forkserver")
+
+    The bookkeeping of the command line nodes takes turns with that of the other
+    runs of the plugin in the process (see the module documentation).
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.n_procs = self.plugin_args.get("n_procs") or os.cpu_count()
+        self.memory_gb = self.plugin_args.get(
+            "memory_gb", round(0.9 * get_system_total_memory_gb(), 2)
+        )
+        self.raise_insufficient = self.plugin_args.get("raise_insufficient", True)
+        self.python_workers = self.plugin_args.get("python_workers", self.n_procs)
+        self.mp_context = self.plugin_args.get("mp_context", "forkserver")
+        self._config = None
+
+    def run(self, graph, config, updatehash=False):
+        self._config = config
+        cwd = os.getcwd()
+        try:
+            with _command_hook():
+                errors, notrun = asyncio.run(self._run(graph, updatehash, cwd))
+        finally:
+            os.chdir(cwd)
+        report_nodes_not_run(notrun)
+        if errors:
+            raise RuntimeError(
+                "Workflow did not execute cleanly:\n"
+                + "\n".join("%s: %s" % item for item in errors.items())
+            )
+
+    def _check_resources(self, graph):
+        for node in graph.nodes():
+            if node.n_procs > self.n_procs or node.mem_gb > self.memory_gb:
+                message = "Node %s needs %d processors and %.2f GB (%d, %.2f GB)" % (
+                    node.fullname,
+                    node.n_procs,
+                    node.mem_gb,
+                    self.n_procs,
+                    self.memory_gb,
+                )
+                if self.raise_insufficient:
+                    raise RuntimeError(message)
+                logger.warning("%s, it will run alone", message)
+
+    async def _run(self, graph, updatehash, cwd):
+        loop = asyncio.get_running_loop()
+        self._check_resources(graph)
+        threads = ThreadPoolExecutor(
+            max_workers=max(4, 2 * self.n_procs), thread_name_prefix="asyncio_plugin"
+        )
+        processes = None
+        order = {node: index for index, node in enumerate(nx.topological_sort(graph))}
+        waiting = {node: graph.in_degree(node) for node in graph.nodes()}
+        ready = sorted(
+            (node for node, count in waiting.items() if count == 0), key=order.get
+        )
+        # MapNode: number of iterations left, iteration: its MapNode
+        iterations_left, mapnode_of = {}, {}
+        running = {}  # task: (node, n_procs, mem_gb)
+        free_procs, free_mem_gb = self.n_procs, self.memory_gb
+        errors, notrun, skipped = {}, [], set()
+        stop_on_first_crash = str(
+            self._config["execution"].get("stop_on_first_crash", False)
+        ).lower() in ("true", "1")
+        taskid = 0
+
+        async def execute(node, taskid):
+            light = (
+                isinstance(node.interface, (CommandLine, IdentityInterface))
+                or node.run_without_submitting
+                or isinstance(node, MapNode)
+            )
+            if not light:
+                light = await loop.run_in_executor(threads, _is_cached, node, cwd)
+            if light:
+                return await loop.run_in_executor(
+                    threads, _run_in_thread, node, updatehash, taskid, loop, cwd
+                )
+            nonlocal processes
+            if processes is None:
+                processes = ProcessPoolExecutor(
+                    max_workers=self.python_workers,
+                    mp_context=multiprocessing.get_context(self.mp_context),
+                )
+            return await loop.run_in_executor(
+                processes, run_node, node, updatehash, taskid
+            )
+
+        def release(node):
+            """Dependents of a completed node that become ready"""
+            if node in mapnode_of:
+                mapnode = mapnode_of.pop(node)
+                iterations_left[mapnode] -= 1
+                if not iterations_left[mapnode]:
+                    ready.append(mapnode)
+                return
+            for successor in graph.successors(node):
+                waiting[successor] -= 1
+                if not waiting[successor] and successor not in skipped:
+                    ready.append(successor)
+            ready.sort(
+                key=lambda item: order.get(item, order.get(mapnode_of.get(item)))
+            )
+
+        try:
+            while ready or running:
+                # Expand the MapNodes into their iterations
+                for node in [node for node in ready if isinstance(node, MapNode)]:
+                    if node in iterations_left:
+                        continue
+                    ready.remove(node)
+                    try:
+                        subnodes = await loop.run_in_executor(
+                            threads, _subnodes, node, cwd
+                        )
+                    except Exception:
+                        result = {
+                            "result": None,
+                            "traceback": format_exception(*sys.exc_info()),
+                        }
+                        notrun.append(self._fail(graph, node, result, errors, skipped))
+                        continue
+                    iterations_left[node] = len(subnodes)
+                    for subnode in subnodes:
+                        subnode.config = node.config
+                        mapnode_of[subnode] = node
+                    ready.extend(subnodes)
+                    if not subnodes:
+                        ready.append(node)
+                # Start every ready node within the budget
+                for node in list(ready):
+                    if stop_on_first_crash and errors:
+                        break
+                    n_procs = min(node.n_procs, self.n_procs)
+                    mem_gb = min(node.mem_gb, self.memory_gb)
+                    if node.run_without_submitting or isinstance(
+                        node.interface, IdentityInterface
+                    ):
+                        n_procs, mem_gb = 0, 0.0
+                    elif n_procs > free_procs or mem_gb > free_mem_gb:
+                        continue
+                    ready.remove(node)
+                    free_procs -= n_procs
+                    free_mem_gb -= mem_gb
+                    taskid += 1
+                    if self._status_callback:
+                        self._status_callback(node, "start")
+                    logger.info("[Asyncio] Running %s", node.fullname)
+                    task = asyncio.ensure_future(execute(node, taskid))
+                    running[task] = (node, n_procs, mem_gb)
+                if not running:
+                    break
+                # Woken up by the first node to complete
+                finished, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in finished:
+                    node, n_procs, mem_gb = running.pop(task)
+                    free_procs += n_procs
+                    free_mem_gb += mem_gb
+                    result = task.result()
+                    if result["traceback"]:
+                        if self._status_callback:
+                            self._status_callback(node, "exception")
+                        failed = mapnode_of.pop(node, node)
+                        report = self._fail(
+                            graph, failed, result, errors, skipped, node
+                        )
+                        if report is not None:
+                            notrun.append(report)
+                        continue
+                    if self._status_callback:
+                        self._status_callback(node, "end")
+                    logger.info("[Asyncio] Finished %s", node.fullname)
+                    release(node)
+                ready[:] = [node for node in ready if node not in skipped]
+        finally:
+            threads.shutdown(wait=True)
+            if processes is not None:
+                processes.shutdown(wait=True)
+        return errors, notrun
+
+    def _fail(self, graph, node, result, errors, skipped, crashed=None):
+        """
+        Report the crash of a node and leave out its dependents
+        :param node: failed node (MapNode of a failed iteration)
+        :param result: result of run_node
+        :param crashed: node which crashed, if not node (MapNode iteration)
+        :return: report_nodes_not_run entry, None if node already failed (other
+        iteration)
+        """
+        crashed = crashed or node
+        crashed._result = result["result"]
+        crashed._traceback = result["traceback"]
+        crashfile = report_crash(crashed, traceback=result["traceback"])
+        errors[crashed.itername] = result["traceback"][-1].strip()
+        if node in skipped:
+            return None
+        dependents = nx.descendants(graph, node)
+        skipped.update(dependents)
+        skipped.add(node)
+        return {"node": node, "dependents": list(dependents), "crashfile": crashfile}
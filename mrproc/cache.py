@@ -0,0 +1,425 @@
+"""Content-addressed result store shared across runs
+
+The Nipype cache lives under the base_dir of each workflow and hashes input files
+together with their paths, so that rerunning a subject in another directory, or
+reusing a T1 volume across sessions, recomputes every node. The ResultStore keys
+the results of the expensive stages (5TT, response/FOD estimation, registration)
+by the content of their input files plus their parameters, independently of any
+path. Nodes created as CachedNode look the key up before executing, restore the
+stored outputs on a hit and publish their outputs after a successful run. The
+store is bounded in size, least recently used entries are evicted first.
+
+Only the values of file inputs (File traits) are hashed by content, other strings
+such as output file names are hashed as they are. Thread counts do not change the
+results and are left out of the key.
+
+Hashing multi-GB diffusion series or tractograms on every run is slow, nodes
+reading them can use a sampled fingerprint instead (size and a few blocks spread
+over the file, see fingerprint_file and apply_fingerprints). Store keys never
+depend on modification times: an input regenerated with the same content by a
+rerun in another directory hits the store.
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import socket
+import tempfile
+import time
+
+import nipype.pipeline.engine as pe
+from nipype.interfaces.base import isdefined
+from nipype.interfaces.base.support import Bunch
+from nipype.interfaces.base.support import InterfaceResult
+from nipype.interfaces.base.traits_extension import BasePath
+from nipype.pipeline.engine.utils import save_resultfile
+from nipype.utils.misc import str2bool
+
+# Bump when the layout of the entries or the key computation changes
+STORE_VERSION = "3"
+BLOCK_SIZE = 8 * 1024 * 1024
+FINGERPRINT_MODES = ["content", "sampled"]
+# Sampled fingerprints read SAMPLED_BLOCKS blocks of SAMPLED_BLOCK_SIZE bytes
+SAMPLED_BLOCKS = 16
+SAMPLED_BLOCK_SIZE = 64 * 1024
+# Inputs setting the number of threads of a tool (see mrproc.resources)
+THREAD_TRAITS = ["nthreads", "omp_core_val"]
+
+
+def hash_file(path):
+    """
+    SHA-1 of the content of a file
+    :param path: file path
+    :return: hexadecimal digest
+    """
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def fingerprint_file(path, mode="content", mtime=False):
+    """
+    Fingerprint of a file
+    :param path: file path
+    :param mode: "content" hashes the whole file, "sampled" hashes its size and
+    SAMPLED_BLOCKS blocks evenly spread over the file
+    :param mtime: if True, the modification time is hashed too in sampled mode
+    (catches edits outside the sampled blocks, but copies of the file differ)
+    :return: hexadecimal digest
+    """
+    if mode == "content":
+        return hash_file(path)
+    if mode != "sampled":
+        raise ValueError(
+            "Unknown fingerprint mode %s (%s)" % (mode, ", ".join(FINGERPRINT_MODES))
+        )
+    stat = os.stat(path)
+    if mtime:
+        sha = hashlib.sha1(("%d:%d" % (stat.st_size, stat.st_mtime_ns)).encode())
+    else:
+        sha = hashlib.sha1(("%d" % stat.st_size).encode())
+    with open(path, "rb") as f:
+        if stat.st_size <= SAMPLED_BLOCKS * SAMPLED_BLOCK_SIZE:
+            sha.update(f.read())
+            return sha.hexdigest()
+        step = (stat.st_size - SAMPLED_BLOCK_SIZE) / (SAMPLED_BLOCKS - 1)
+        for i in range(SAMPLED_BLOCKS):
+            f.seek(int(i * step))
+            sha.update(f.read(SAMPLED_BLOCK_SIZE))
+    return sha.hexdigest()
+
+
+class ResultStore:
+    """
+    Directory of node results addressed by the hash of their inputs
+
+    Layout: <root>/objects/<key>/manifest.json and the output files. The
+    modification time of the manifest records the last use of an entry.
+    """
+
+    def __init__(self, root, max_size_gb=None):
+        self.root = op.abspath(root)
+        self.max_size_gb = max_size_gb
+        self._file_hashes = {}
+
+    def __getstate__(self):
+        # Memoized file hashes are not shipped to worker processes
+        state = dict(self.__dict__)
+        state["_file_hashes"] = {}
+        return state
+
+    @property
+    def objects_dir(self):
+        return op.join(self.root, "objects")
+
+    def file_hash(self, path, fingerprint="content"):
+        """
+        Fingerprint of an input file, memoized on (path, size, mtime)
+        :param path: file path
+        :param fingerprint: "content" or "sampled" (see fingerprint_file)
+        :return: hexadecimal digest
+        """
+        stat = os.stat(path)
+        memo_key = (op.realpath(path), stat.st_size, stat.st_mtime_ns, fingerprint)
+        if memo_key not in self._file_hashes:
+            self._file_hashes[memo_key] = fingerprint_file(path, fingerprint)
+        return self._file_hashes[memo_key]
+
+    def key(self, interface, fingerprint="content"):
+        """
+        Key of the result of an interface, independent of the input file paths
+        :param interface: Nipype interface with its inputs set
+        :param fingerprint: fingerprint mode of the input files (see
+        fingerprint_file)
+        :return: hexadecimal digest
+        """
+        inputs = interface.inputs
+        params = {}
+        for name in sorted(inputs.copyable_trait_names()):
+            value = getattr(inputs, name)
+            trait = inputs.trait(name)
+            if trait.nohash or name in THREAD_TRAITS or not isdefined(value):
+                continue
+            if _is_file_trait(trait):
+                value = self._content(value, fingerprint)
+            params[name] = value
+        description = json.dumps(
+            [
+                STORE_VERSION,
+                interface.__class__.__module__,
+                interface.__class__.__name__,
+                params,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def fetch(self, key, outdir):
+        """
+        Restore the outputs of a stored result into a node directory
+        :param key: result key
+        :param outdir: directory where the output files are restored
+        :return: outputs (dict) or None if the key is not in the store
+        """
+        entry = op.join(self.objects_dir, key)
+        manifest_file = op.join(entry, "manifest.json")
+        try:
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            outputs = _decode_files(
+                manifest["outputs"],
+                lambda stored, name: _link_or_copy(
+                    op.join(entry, stored), op.join(outdir, name)
+                ),
+            )
+        except OSError:
+            # Entry evicted while being read
+            return None
+        os.utime(manifest_file)
+        return outputs
+
+    def publish(self, key, outputs):
+        """
+        Store the outputs of a node
+        :param key: result key
+        :param outputs: dict of output values (files are copied into the store)
+        :return:
+        """
+        entry = op.join(self.objects_dir, key)
+        if op.exists(entry):
+            os.utime(op.join(entry, "manifest.json"))
+            return
+        os.makedirs(self.objects_dir, exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(prefix=".tmp_", dir=self.objects_dir)
+        sizes = []
+
+        def store_file(path):
+            # Prefix avoids collisions between outputs sharing a file name
+            stored = "%d_%s" % (len(sizes), op.basename(path))
+            _link_or_copy(path, op.join(tmp_entry, stored))
+            sizes.append(os.path.getsize(path))
+            return stored
+
+        try:
+            manifest = {"outputs": _encode_files(outputs, store_file)}
+            manifest["size"] = sum(sizes)
+            with open(op.join(tmp_entry, "manifest.json"), "w") as f:
+                json.dump(manifest, f)
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Concurrent publication of the same key
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        self.evict(keep=key)
+
+    def entries(self):
+        """
+        Stored entries, least recently used first
+        :return: list of (key, last_used, size)
+        """
+        entries = []
+        if not op.isdir(self.objects_dir):
+            return entries
+        for key in os.listdir(self.objects_dir):
+            manifest_file = op.join(self.objects_dir, key, "manifest.json")
+            try:
+                with open(manifest_file) as f:
+                    size = json.load(f)["size"]
+                last_used = os.stat(manifest_file).st_mtime
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((key, last_used, size))
+        return sorted(entries, key=lambda entry: entry[1])
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the store fits its size cap
+        :param keep: key never evicted (the entry just published)
+        :return: list of evicted keys
+        """
+        if self.max_size_gb is None:
+            return []
+        entries = self.entries()
+        total = sum(size for _, _, size in entries)
+        max_size = self.max_size_gb * 1024**3
+        evicted = []
+        for key, _, size in entries:
+            if total <= max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(op.join(self.objects_dir, key), ignore_errors=True)
+            total -= size
+            evicted.append(key)
+        return evicted
+
+    def _content(self, value, fingerprint="content"):
+        if isinstance(value, (list, tuple)):
+            return [self._content(item, fingerprint) for item in value]
+        if isinstance(value, dict):
+            return {
+                key: self._content(item, fingerprint) for key, item in value.items()
+            }
+        # Relative paths are output names, not files produced upstream
+        if isinstance(value, str) and op.isabs(value) and op.isfile(value):
+            prefix = "sha1:" if fingerprint == "content" else fingerprint + ":"
+            return prefix + self.file_hash(value, fingerprint)
+        return value
+
+
+class CachedNode(pe.Node):
+    """
+    Node checking a ResultStore before executing and publishing its outputs to it
+
+    Without a store (result_store attribute left to None) the node behaves as a
+    regular Nipype node. The fingerprint attribute sets how its input files are
+    hashed in the store key (see fingerprint_file).
+    """
+
+    def __init__(self, *args, result_store=None, fingerprint="content", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.result_store = result_store
+        self.fingerprint = fingerprint
+
+    def _run_command(self, execute, copyfiles=True):
+        if not execute or self.result_store is None:
+            return super()._run_command(execute, copyfiles=copyfiles)
+
+        key = self.result_store.key(self._interface, fingerprint=self.fingerprint)
+        outdir = self.output_dir()
+        start = time.time()
+        outputs = self.result_store.fetch(key, outdir)
+        if outputs is None:
+            result = super()._run_command(execute, copyfiles=copyfiles)
+            self.result_store.publish(key, _defined_outputs(result.outputs))
+            return result
+
+        aggregated = self._interface._outputs()
+        aggregated.trait_set(**outputs)
+        runtime = Bunch(
+            cwd=outdir,
+            returncode=0,
+            environ=dict(os.environ),
+            hostname=socket.gethostname(),
+            duration=time.time() - start,
+            result_store_key=key,
+        )
+        result = InterfaceResult(
+            interface=self._interface.__class__,
+            runtime=runtime,
+            inputs=self._interface.inputs.get_traitsfree(),
+            outputs=aggregated,
+        )
+        save_resultfile(
+            result,
+            outdir,
+            self.name,
+            rebase=str2bool(self.config["execution"]["use_relative_paths"]),
+        )
+        return result
+
+
+def attach_result_store(workflow, store):
+    """
+    Make the CachedNode nodes of a workflow use a result store
+    :param workflow: Nipype workflow (sub-workflows are processed recursively)
+    :param store: ResultStore, or None to detach
+    :return: names of the nodes using the store
+    """
+    attached = []
+    for node_name in workflow.list_node_names():
+        node = workflow.get_node(node_name)
+        if isinstance(node, CachedNode):
+            node.result_store = store
+            attached.append(node_name)
+    return attached
+
+
+def apply_fingerprints(workflow, fingerprints):
+    """
+    Set how the input files of the nodes of a workflow are fingerprinted
+
+    The mode applies to the ResultStore key of CachedNode nodes and to the Nipype
+    hash of the node: "sampled" nodes are hashed with the Nipype timestamp method
+    (size and modification time), "content" nodes with the content method.
+    :param workflow: Nipype workflow (sub-workflows are processed recursively)
+    :param fingerprints: dict mapping node names to "content" or "sampled"
+    :return: names of the configured nodes
+    """
+    configured = []
+    for node_name in workflow.list_node_names():
+        node = workflow.get_node(node_name)
+        mode = fingerprints.get(node.name)
+        if mode is None:
+            continue
+        if mode not in FINGERPRINT_MODES:
+            raise ValueError(
+                "Unknown fingerprint mode %s for node %s (%s)"
+                % (mode, node.name, ", ".join(FINGERPRINT_MODES))
+            )
+        if isinstance(node, CachedNode):
+            node.fingerprint = mode
+        config = dict(node.config or {})
+        config["execution"] = dict(
+            config.get("execution", {}),
+            hash_method="timestamp" if mode == "sampled" else "content",
+        )
+        node.config = config
+        configured.append(node_name)
+    return configured
+
+
+def _is_file_trait(trait):
+    # File, Either(File, ...) and lists of files
+    handlers = getattr(trait.handler, "handlers", None) or [trait.trait_type]
+    if any(isinstance(handler, BasePath) for handler in handlers):
+        return True
+    return any(_is_file_trait(inner) for inner in trait.inner_traits or ())
+
+
+def _defined_outputs(outputs):
+    if outputs is None:
+        return {}
+    return {
+        name: value for name, value in outputs.trait_get().items() if isdefined(value)
+    }
+
+
+def _encode_files(value, store_file):
+    # Existing files are replaced by {"file": stored name, "name": file name}
+    if isinstance(value, (list, tuple)):
+        return [_encode_files(item, store_file) for item in value]
+    if isinstance(value, dict):
+        return {key: _encode_files(item, store_file) for key, item in value.items()}
+    if isinstance(value, str) and op.isfile(value):
+        return {"file": store_file(value), "name": op.basename(value)}
+    return value
+
+
+def _decode_files(value, restore_file):
+    if isinstance(value, list):
+        return [_decode_files(item, restore_file) for item in value]
+    if isinstance(value, dict) and set(value) == {"file", "name"}:
+        return restore_file(value["file"], value["name"])
+    if isinstance(value, dict):
+        return {key: _decode_files(item, restore_file) for key, item in value.items()}
+    return value
+
+
+def _link_or_copy(src, dst):
+    os.makedirs(op.dirname(dst), exist_ok=True)
+    if op.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
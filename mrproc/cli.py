@@ -0,0 +1,347 @@
+"""Command line entry point of mrproc
+
+mrproc-batch runs the diffusion processing workflow on every subject of a
+manifest or BIDS-like dataset, scheduling all subjects concurrently.
+"""
+
+import argparse
+import os
+import sys
+
+from mrproc.preflight import run_preflight
+from mrproc.workflows.batch import create_batch_dwi_processing_pipeline
+from mrproc.workflows.batch import load_subjects
+from mrproc.workflows.batch import run_batch
+from mrproc.workflows.dwi_processing import PREVIEW_TRACKS
+
+
+def build_parser():
+    """
+    Command line arguments of mrproc-batch
+    :return: parser (argparse.ArgumentParser)
+    """
+    parser = argparse.ArgumentParser(
+        prog="mrproc-batch",
+        description="Process the diffusion MRI data of several subjects in parallel",
+    )
+    parser.add_argument(
+        "subjects", help="subject manifest (.tsv, .csv, .json) or BIDS-like directory"
+    )
+    parser.add_argument(
+        "-w", "--work-dir", required=True, help="Nipype working directory"
+    )
+    parser.add_argument(
+        "-o", "--output-dir", help="directory where final outputs are copied"
+    )
+    parser.add_argument(
+        "--participant-label", nargs="+", help="subset of subjects to process"
+    )
+    parser.add_argument("--n-procs", type=int, help="processors shared by all subjects")
+    parser.add_argument(
+        "--memory-gb", type=float, help="memory (GB) shared by all subjects"
+    )
+    parser.add_argument(
+        "--resource-profile", help="JSON file overriding node threads and memory"
+    )
+    parser.add_argument(
+        "--result-store",
+        help="result store shared across runs (5TT, CSD, registration)",
+    )
+    parser.add_argument(
+        "--result-store-max-gb", type=float, help="size cap of the result store"
+    )
+    parser.add_argument(
+        "--ledger",
+        help="completion ledger: subjects already processed with the same inputs "
+        "and parameters are skipped",
+    )
+    parser.add_argument(
+        "--report-dir",
+        help="record per-node runtime, memory and I/O and write a run report here",
+    )
+    parser.add_argument(
+        "--intermediates",
+        choices=["keep", "delete", "compress"],
+        default="keep",
+        help="fate of the intermediate files once their consumers are done",
+    )
+    parser.add_argument(
+        "--intermediate-format",
+        choices=["nifti_gz", "nifti", "mif"],
+        default="nifti_gz",
+        help="format of the intermediate volumes (nifti and mif skip the gzip "
+        "compression, mif applies to the volumes only read by MRtrix3)",
+    )
+    parser.add_argument(
+        "--compress-outputs",
+        action="store_true",
+        help="gzip the NIfTI and .mif copies of the output directory",
+    )
+    parser.add_argument(
+        "--scratch-quota-gb",
+        type=float,
+        help="working directory size above which no new subject is started "
+        "(requires --intermediates delete or compress)",
+    )
+    parser.add_argument(
+        "--registration",
+        choices=["rigid", "affine", "nonlinear", "diffeomorphic"],
+        default="nonlinear",
+        help="diffusion to T1 registration (rigid is the fastest, diffeomorphic "
+        "also exports the nonlinear diffusion to T1 transformation)",
+    )
+    parser.add_argument(
+        "--registration-resolution",
+        type=float,
+        default=1.0,
+        help="voxel size (mm) at which the T1 volume is registered, 0 keeps the "
+        "diffusion resolution",
+    )
+    parser.add_argument(
+        "--registration-levels",
+        type=int,
+        help="number of coarse to fine levels of the nonlinear registration",
+    )
+    parser.add_argument(
+        "--tensor-backend",
+        choices=["mrtrix", "numpy"],
+        default="mrtrix",
+        help="compute the FA with dwi2tensor and tensor2metric (mrtrix) or "
+        "in-process (numpy)",
+    )
+    parser.add_argument(
+        "--ingest",
+        choices=["convert", "fslgrad", "header"],
+        default="convert",
+        help="copy the diffusion series into a .mif (convert), give it to the bias "
+        "correction with its bvals/bvecs (fslgrad) or reference it from a .mih "
+        "header (header, uncompressed NIfTI only)",
+    )
+    parser.add_argument(
+        "--group-response",
+        type=int,
+        metavar="N",
+        help="average the response functions of N subjects and deconvolve every "
+        "subject with them (default: per subject responses)",
+    )
+    parser.add_argument(
+        "--connectome",
+        action="store_true",
+        help="compute the structural connectome of every subject (requires a "
+        "parcellation per subject)",
+    )
+    parser.add_argument(
+        "--preview",
+        action="store_true",
+        help="quick check of the subjects: small unfiltered tractogram and QC "
+        "images, the upstream stages are reused by a full run with the same "
+        "options (--registration rigid --registration-resolution 0 gives the "
+        "fastest preview, but the full run then recomputes the registration)",
+    )
+    parser.add_argument(
+        "--skip-preflight",
+        action="store_true",
+        help="do not check the executables, input headers and disk and memory "
+        "needs before the run",
+    )
+    parser.add_argument(
+        "--preflight-only",
+        action="store_true",
+        help="run the preflight check and exit",
+    )
+    parser.add_argument(
+        "--slurm",
+        action="store_true",
+        help="submit one SLURM job per subject instead of running locally",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="run locally from an event loop, commands as asynchronous subprocesses",
+    )
+    parser.add_argument(
+        "--sbatch-args",
+        default="",
+        help='extra sbatch arguments of the SLURM jobs, e.g. "--partition=long"',
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=2,
+        help="number of resubmissions of a failed SLURM job",
+    )
+    parser.add_argument(
+        "--nb-tracks",
+        type=int,
+        help="number of streamlines (default: 10000000, %d with --preview)"
+        % PREVIEW_TRACKS,
+    )
+    parser.add_argument("--min-length", type=float, default=30)
+    parser.add_argument("--max-length", type=float, default=300)
+    parser.add_argument(
+        "--nb-shards",
+        type=int,
+        default=1,
+        help="number of parallel tractography jobs per subject",
+    )
+    parser.add_argument(
+        "--nb-slabs",
+        type=int,
+        default=1,
+        help="number of parallel FOD estimation jobs per subject, run on slabs of "
+        "the brain mask",
+    )
+    parser.add_argument(
+        "--sift-mode",
+        choices=["sift", "sift2"],
+        default="sift",
+        help="filter the tractogram (sift) or compute streamline weights (sift2)",
+    )
+    parser.add_argument(
+        "--term-number", type=int, help="number of streamlines kept by SIFT"
+    )
+    parser.add_argument(
+        "--term-ratio",
+        type=float,
+        help="SIFT termination ratio (reduction of the cost function relative to "
+        "its initial value)",
+    )
+    parser.add_argument(
+        "--term-mu", type=float, help="SIFT termination proportionality factor"
+    )
+    parser.add_argument(
+        "--compression-tolerance",
+        type=float,
+        metavar="MM",
+        help="simplify the streamlines within this distance before SIFT, the size "
+        "reduction and a summary of the SIFT output are written to "
+        "compression_report (default: no compression)",
+    )
+    parser.add_argument(
+        "--compression-check",
+        action="store_true",
+        help="also run SIFT on the uncompressed tractogram and compare both "
+        "outputs in compression_report (doubles the SIFT cost, requires "
+        "--compression-tolerance)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="random seed of the tractography, change it to draw independent "
+        "replicates",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    subjects = load_subjects(args.subjects, participant_label=args.participant_label)
+    if not subjects:
+        sys.exit("No subject found in %s" % args.subjects)
+    nb_tracks = args.nb_tracks
+    if nb_tracks is None and not args.preview:
+        nb_tracks = 10000000
+    options = dict(
+        nb_tracks=nb_tracks,
+        min_length=args.min_length,
+        max_length=args.max_length,
+        nb_shards=args.nb_shards,
+        sift_mode=args.sift_mode,
+        term_number=args.term_number,
+        term_ratio=args.term_ratio,
+        term_mu=args.term_mu,
+        seed=args.seed,
+        registration=args.registration,
+        registration_resolution=args.registration_resolution or None,
+        registration_levels=args.registration_levels,
+        group_response=args.group_response,
+        connectome=args.connectome,
+        preview=args.preview,
+        tensor_backend=args.tensor_backend,
+        ingest=args.ingest,
+        compression_tolerance=args.compression_tolerance,
+        compression_check=args.compression_check,
+        nb_slabs=args.nb_slabs,
+        intermediate_format=args.intermediate_format,
+        output_dir=args.output_dir,
+        compress_outputs=args.compress_outputs,
+        resource_profile=args.resource_profile,
+        max_procs=args.n_procs,
+        result_store=args.result_store,
+        result_store_max_gb=args.result_store_max_gb,
+        ledger=args.ledger,
+    )
+    batch = create_batch_dwi_processing_pipeline(subjects, **options)
+    if batch is None:
+        print("Every subject is already processed (see %s)" % args.ledger)
+        return
+    if not args.skip_preflight:
+        # Subjects left out by the ledger are not checked
+        pending = set(batch.get_node("infosource").iterables[1])
+        _, report = run_preflight(
+            [subject for subject in subjects if subject["subject_id"] in pending],
+            batch,
+            args.work_dir,
+            batch.get_node("selectfiles").inputs.fields,
+            nb_tracks=nb_tracks or PREVIEW_TRACKS,
+            nb_shards=args.nb_shards,
+            sift_mode="none" if args.preview else args.sift_mode,
+            resource_profile=args.resource_profile,
+            memory_gb=args.memory_gb,
+            intermediates=args.intermediates,
+        )
+        print_preflight_report(report)
+        if report["errors"]:
+            sys.exit("Preflight check failed")
+        if args.preflight_only:
+            return
+        if report["rejected"]:
+            subjects = [
+                subject
+                for subject in subjects
+                if subject["subject_id"] not in report["rejected"]
+            ]
+            if not set(report["rejected"]) < pending:
+                sys.exit("No subject passed the preflight check")
+            batch = create_batch_dwi_processing_pipeline(subjects, **options)
+    batch.base_dir = os.path.abspath(args.work_dir)
+    plugin = "MultiProc"
+    if args.slurm:
+        from mrproc.slurm import SLURMBundlePlugin
+
+        plugin = SLURMBundlePlugin(
+            plugin_args={
+                "sbatch_args": args.sbatch_args,
+                "max_retries": args.max_retries,
+            }
+        )
+    elif args.asyncio:
+        plugin = "Asyncio"
+    run_batch(
+        batch,
+        plugin=plugin,
+        n_procs=args.n_procs,
+        memory_gb=args.memory_gb,
+        report_dir=args.report_dir,
+        intermediates=args.intermediates,
+        scratch_quota_gb=args.scratch_quota_gb,
+    )
+
+
+def print_preflight_report(report):
+    """
+    Print the problems found by the preflight check on the standard error
+    :param report: preflight report (see mrproc.preflight.run_preflight)
+    :return:
+    """
+    for error in report["errors"]:
+        print("error: %s" % error, file=sys.stderr)
+    for warning in report["warnings"]:
+        print("warning: %s" % warning, file=sys.stderr)
+    for subject_id, problems in sorted(report["rejected"].items()):
+        print("%s rejected: %s" % (subject_id, "; ".join(problems)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
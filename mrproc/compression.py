@@ -0,0 +1,295 @@
+"""Lossy compression of tractograms before SIFT
+
+tckgen (iFOD2) writes a vertex every step (a fraction of the voxel size), most of
+them aligned with their neighbours. The vertices of every streamline are
+simplified by the Douglas-Peucker algorithm: a vertex is dropped when it lies
+within tolerance (mm) of the segment joining the kept vertices around it, so
+that the simplified streamline never departs from the original one by more
+than tolerance. Segments are also kept shorter than max_segment (mm): SIFT maps
+streamlines onto fixels by interpolating a fixed number of points between
+consecutive vertices, derived from the output_step_size header field, which is
+set to the longest segment.
+
+The tractogram is streamed by chunks (see mrproc.io.tck) and all the streamlines
+of a chunk are simplified at once: each pass splits every segment whose farthest
+vertex is beyond tolerance, in vectorized operations over the vertices of the
+chunk. Chunks are simplified by n_procs processes and written in order.
+
+MRtrix3 reads the vertices of .tck files as float32 or float64 only, the
+compressed tractogram keeps the float32 encoding of tckgen.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mrproc.io.tck import TckFile
+from mrproc.io.tck import TckWriter
+
+# Longest segment (mm) between two kept vertices, about a diffusion voxel
+MAX_SEGMENT_LENGTH = 2.0
+
+
+def simplify(points, lengths, tolerance, max_segment=MAX_SEGMENT_LENGTH):
+    """
+    Vertices kept by the Douglas-Peucker simplification of a chunk of streamlines
+    :param points: (P, 3) array of concatenated vertices
+    :param lengths: number of vertices of each streamline
+    :param tolerance: largest distance (mm) between a dropped vertex and the
+    simplified streamline
+    :param max_segment: longest segment (mm) between two kept vertices, unless
+    the original vertices are further apart
+    :return: (P,) boolean mask of the kept vertices, endpoints are always kept
+    """
+    coordinates = np.asarray(points, dtype=np.float32).T.copy()
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    keep = np.zeros(len(coordinates[0]), dtype=bool)
+    filled = lengths > 0
+    keep[starts[filled]] = True
+    keep[ends[filled] - 1] = True
+    # Segments between two kept vertices with vertices in between
+    inner = lengths > 2
+    first, last = starts[inner], ends[inner] - 1
+    while len(first):
+        sizes = last - first - 1
+        offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        segment = np.repeat(np.arange(len(first)), sizes)
+        index = np.arange(len(segment)) + np.repeat(first + 1 - offsets, sizes)
+        # Squared distances of the vertices to the chord of their segment
+        chords = [axis[last] - axis[first] for axis in coordinates]
+        squared = sum(chord * chord for chord in chords)
+        inverse = np.repeat(1 / np.where(squared > 0, squared, 1), sizes)
+        chords = [np.repeat(chord, sizes) for chord in chords]
+        relatives = [
+            axis[index] - np.repeat(axis[first], sizes) for axis in coordinates
+        ]
+        position = sum(r * c for r, c in zip(relatives, chords)) * inverse
+        np.clip(position, 0, 1, out=position)
+        distances = sum((r - position * c) ** 2 for r, c in zip(relatives, chords))
+        farthest = np.maximum.reduceat(distances, offsets)
+        # First vertex at the largest distance of every segment
+        is_farthest = np.flatnonzero(distances == np.repeat(farthest, sizes))
+        changes = np.diff(segment[is_farthest], prepend=-1) != 0
+        split = index[is_farthest[changes]]
+        beyond = farthest > tolerance**2
+        # Segments within tolerance but too long are split in their middle
+        split = np.where(beyond, split, (first + last) // 2)
+        selected = beyond | (squared > max_segment**2)
+        first, last, split = first[selected], last[selected], split[selected]
+        keep[split] = True
+        first, last = np.concatenate((first, split)), np.concatenate((split, last))
+        inner = last - first > 1
+        first, last = first[inner], last[inner]
+    return keep
+
+
+def _simplify_chunks(chunks, tolerance, max_segment, n_procs):
+    """Chunks with their kept vertices (see simplify), in order"""
+    if n_procs <= 1:
+        for points, lengths in chunks:
+            yield points, lengths, simplify(points, lengths, tolerance, max_segment)
+        return
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        # At most two chunks per process are held in memory
+        pending = deque()
+        for points, lengths in chunks:
+            future = executor.submit(simplify, points, lengths, tolerance, max_segment)
+            pending.append((points, lengths, future))
+            if len(pending) >= 2 * n_procs:
+                points, lengths, future = pending.popleft()
+                yield points, lengths, future.result()
+        for points, lengths, future in pending:
+            yield points, lengths, future.result()
+
+
+def compress_tractogram(
+    in_file,
+    out_file,
+    tolerance,
+    max_segment=MAX_SEGMENT_LENGTH,
+    n_procs=1,
+    chunk_size=100000,
+):
+    """
+    Simplify the streamlines of a tractogram (see simplify)
+    :param in_file: path of the input .tck file
+    :param out_file: path of the output .tck file
+    :param tolerance: largest distance (mm) between a dropped vertex and the
+    simplified streamline
+    :param max_segment: longest segment (mm) between two kept vertices
+    :param n_procs: number of processes simplifying chunks, written in order
+    :param chunk_size: number of streamlines read at once
+    :return: statistics (dict): streamlines, vertices and bytes before and after
+    """
+    tck = TckFile(in_file)
+    header = dict(tck.header)
+    step_size = float(header.get("output_step_size", header.get("step_size", 0)))
+    header["output_step_size"] = "%g" % max(max_segment, step_size)
+    chunks = _simplify_chunks(
+        tck.iter_chunks(chunk_size=chunk_size), tolerance, max_segment, n_procs
+    )
+    vertices, compressed_vertices = 0, 0
+    with TckWriter(out_file, header=header) as writer:
+        for points, lengths, keep in chunks:
+            streamline = np.repeat(np.arange(len(lengths)), lengths)
+            writer.write(
+                points[keep], np.bincount(streamline[keep], minlength=len(lengths))
+            )
+            vertices += len(points)
+            compressed_vertices += int(keep.sum())
+    return {
+        "tolerance_mm": tolerance,
+        "max_segment_mm": max_segment,
+        "streamlines": writer.count,
+        "vertices": vertices,
+        "compressed_vertices": compressed_vertices,
+        "bytes": os.path.getsize(in_file),
+        "compressed_bytes": os.path.getsize(out_file),
+    }
+
+
+def write_compressed_tractogram(in_file, tolerance, max_segment=None, n_procs=1):
+    """
+    Simplify the streamlines of a tractogram (Nipype Function step)
+    :param in_file: path of the .tck file
+    :param tolerance: largest distance (mm) between a dropped vertex and the
+    simplified streamline
+    :param max_segment: longest segment (mm) between two kept vertices
+    (default MAX_SEGMENT_LENGTH)
+    :param n_procs: number of processes simplifying the streamlines
+    :return: out_file (path of compressed.tck), statistics (dict, see
+    compress_tractogram)
+    """
+    import os
+
+    from mrproc.compression import MAX_SEGMENT_LENGTH
+    from mrproc.compression import compress_tractogram
+
+    if max_segment is None:
+        max_segment = MAX_SEGMENT_LENGTH
+
+    out_file = os.path.abspath("compressed.tck")
+    statistics = compress_tractogram(
+        in_file, out_file, tolerance, max_segment=max_segment, n_procs=n_procs
+    )
+    return out_file, statistics
+
+
+def write_compression_report(
+    statistics,
+    tractogram=None,
+    weights=None,
+    reference_tractogram=None,
+    reference_weights=None,
+):
+    """
+    Write the size reduction of the compression and a summary of the SIFT output
+    computed from the compressed tractogram (Nipype Function step)
+
+    Given the SIFT output of the uncompressed tractogram, its summary and the
+    differences between both outputs (see compare_sift) are added to the report.
+    :param statistics: statistics of the compression (see compress_tractogram)
+    :param tractogram: SIFT filtered tractogram (sift mode)
+    :param weights: text file of SIFT2 weights (sift2 mode)
+    :param reference_tractogram: SIFT filtered uncompressed tractogram
+    :param reference_weights: SIFT2 weights of the uncompressed tractogram
+    :return: path of compression.json
+    """
+    import json
+    import os
+
+    from mrproc.compression import compare_sift
+    from mrproc.compression import summarize_sift
+
+    report = dict(statistics)
+    report["vertex_ratio"] = report["compressed_vertices"] / max(report["vertices"], 1)
+    report["size_ratio"] = report["compressed_bytes"] / max(report["bytes"], 1)
+    report["sift"] = summarize_sift(tractogram=tractogram, weights=weights)
+    reference = summarize_sift(
+        tractogram=reference_tractogram, weights=reference_weights
+    )
+    if reference is not None:
+        report["reference_sift"] = reference
+        report["sift_comparison"] = compare_sift(
+            report["sift"], reference, weights, reference_weights
+        )
+    out_file = os.path.abspath("compression.json")
+    with open(out_file, "w") as f:
+        json.dump(report, f, indent=2)
+    return out_file
+
+
+def summarize_sift(tractogram=None, weights=None):
+    """
+    Summary of a SIFT output
+    :param tractogram: SIFT filtered tractogram: number of kept streamlines and
+    their lengths
+    :param weights: SIFT2 weights: their distribution and effective number of
+    streamlines (sum of the weights squared over the sum of the squared weights)
+    :return: dict, None without SIFT output
+    """
+    from mrproc.qc import streamline_lengths
+    from mrproc.qc import summary_statistics
+
+    if weights is not None:
+        values = np.loadtxt(weights, comments="#", ndmin=1)
+        squared = float((values**2).sum())
+        return {
+            "streamlines": int(len(values)),
+            "weights": summary_statistics(values),
+            "effective_streamlines": (
+                float(values.sum()) ** 2 / squared if squared else 0.0
+            ),
+        }
+    if tractogram is not None:
+        lengths = streamline_lengths(tractogram)
+        return {
+            "streamlines": int(len(lengths)),
+            "streamline_length_mm": summary_statistics(lengths),
+        }
+    return None
+
+
+def compare_sift(summary, reference, weights=None, reference_weights=None):
+    """
+    Differences between the SIFT outputs of a compressed tractogram and of the
+    uncompressed one
+    :param summary: summary of the SIFT output of the compressed tractogram (see
+    summarize_sift)
+    :param reference: summary of the SIFT output of the uncompressed tractogram
+    :param weights: SIFT2 weights of the compressed tractogram
+    :param reference_weights: SIFT2 weights of the uncompressed tractogram, whose
+    streamlines are those of the compressed tractogram, in the same order
+    :return: dict
+    """
+    from mrproc.qc import summary_statistics
+
+    comparison = {
+        "streamline_ratio": summary["streamlines"] / max(reference["streamlines"], 1)
+    }
+    if weights is not None and reference_weights is not None:
+        values = np.loadtxt(weights, comments="#", ndmin=1)
+        reference_values = np.loadtxt(reference_weights, comments="#", ndmin=1)
+        effective = reference["effective_streamlines"]
+        comparison["effective_streamline_ratio"] = (
+            summary["effective_streamlines"] / effective if effective else None
+        )
+        if len(values) == len(reference_values) and len(values):
+            differences = np.abs(values - reference_values)
+            comparison["weight_difference"] = summary_statistics(differences)
+            if len(values) > 1 and values.std() > 0 and reference_values.std() > 0:
+                comparison["weight_correlation"] = float(
+                    np.corrcoef(values, reference_values)[0, 1]
+                )
+        return comparison
+    lengths = summary.get("streamline_length_mm")
+    reference_lengths = reference.get("streamline_length_mm")
+    if lengths is not None and reference_lengths is not None:
+        comparison["median_length_difference_mm"] = (
+            lengths["median"] - reference_lengths["median"]
+        )
+    return comparison
@@ -0,0 +1,207 @@
+"""Structural connectomes from whole brain tractograms
+
+Both endpoints of every streamline are assigned to the parcel of the voxel they
+fall in (labels of a parcellation image in diffusion space, 0 meaning
+unassigned) and the streamlines joining two parcels are counted, or their SIFT2
+weights summed. The connectivity matrix is symmetric, node i being label i + 1
+(MRtrix3 tck2connectome convention, end voxel assignment); streamlines with an
+unassigned endpoint are left out.
+
+The tractogram is memory-mapped (see mrproc.io.tck) and split into vertex ranges
+scanned in parallel by n_procs processes: each worker finds the separators of its
+range and assigns the streamlines ending in it by vectorized lookups. Only the
+pair of parcels of each streamline (4 bytes) and its weight are held in memory,
+never the vertices of the whole tractogram. The first streamline of a range
+starts in a previous range: its endpoints are assigned once all the ranges are
+scanned.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mrproc.io.tck import TckFile
+
+# Vertices scanned at once by a worker
+BLOCK_SIZE = 1 << 20
+# Largest label whose matrix cells can be indexed by int32 pairs
+MAX_LABEL = 46340
+
+
+def load_parcellation(parcellation):
+    """
+    Labels and voxel to world transformation of a parcellation
+    :param parcellation: path of a NIfTI label image
+    :return: labels (3D integer array), affine (4x4 array)
+    """
+    import nibabel
+
+    image = nibabel.load(parcellation)
+    labels = np.asarray(image.dataobj)
+    if labels.ndim > 3:
+        labels = labels.reshape(labels.shape[:3])
+    if labels.min() < 0:
+        raise ValueError("%s: negative parcel labels" % parcellation)
+    if labels.max() > MAX_LABEL:
+        raise ValueError(
+            "%s: labels above %d, relabel the parcels consecutively (labelconvert)"
+            % (parcellation, MAX_LABEL)
+        )
+    return np.rint(labels).astype(np.int32), image.affine
+
+
+def assign_points(points, labels, affine):
+    """
+    Parcel of world coordinates
+    :param points: (P, 3) array of coordinates (mm)
+    :param labels: 3D array of parcel labels
+    :param affine: voxel to world transformation of labels
+    :return: (P,) array of labels, 0 outside of the image
+    """
+    inverse = np.linalg.inv(affine)
+    voxels = np.rint(points @ inverse[:3, :3].T + inverse[:3, 3]).astype(np.int64)
+    inside = np.all((voxels >= 0) & (voxels < labels.shape), axis=1)
+    assigned = np.zeros(len(points), dtype=np.int32)
+    assigned[inside] = labels[tuple(voxels[inside].T)]
+    return assigned
+
+
+def pair_indices(first, last, nb_nodes):
+    """
+    Index of the connectivity matrix cell of streamlines
+    :param first: label of the first endpoint of each streamline
+    :param last: label of the last endpoint
+    :param nb_nodes: size of the matrix
+    :return: flat index of the upper triangle cell, -1 for unassigned streamlines
+    """
+    low = np.minimum(first, last).astype(np.int64)
+    high = np.maximum(first, last).astype(np.int64)
+    return np.where(low > 0, (low - 1) * nb_nodes + high - 1, -1)
+
+
+def _scan_range(tractogram, start, stop, parcellation):
+    """
+    Assign the streamlines ending in a vertex range of a tractogram
+    :param tractogram: path of the .tck file
+    :param start, stop: vertex range
+    :param parcellation: path of the parcellation
+    :return: dict with the first separator of the range (first), the last one
+    (last), whether the end of the tractogram was reached (end) and the cell
+    index of the streamlines ending at the following separators (pairs)
+    """
+    labels, affine = load_parcellation(parcellation)
+    nb_nodes = int(labels.max())
+    vertices = TckFile(tractogram).vertices
+    separators = []
+    end = False
+    for position in range(start, stop, BLOCK_SIZE):
+        block = vertices[position : min(position + BLOCK_SIZE, stop), 0]
+        inf = np.flatnonzero(np.isinf(block))
+        if len(inf):
+            block = block[: inf[0]]
+            end = True
+        separators.append(np.flatnonzero(np.isnan(block)) + position)
+        if end:
+            break
+    separators = np.concatenate(separators) if separators else np.empty(0, int)
+    result = {"first": None, "last": None, "end": end, "pairs": np.empty(0, "i4")}
+    if len(separators) == 0:
+        return result
+    result["first"], result["last"] = int(separators[0]), int(separators[-1])
+    starts, stops = separators[:-1] + 1, separators[1:] - 1
+    result["pairs"] = _assign_streamlines(
+        vertices, starts, stops, labels, affine, nb_nodes
+    ).astype(np.int32)
+    return result
+
+
+def _assign_streamlines(vertices, starts, stops, labels, affine, nb_nodes):
+    # Empty streamlines (consecutive separators) are unassigned
+    empty = stops < starts
+    first = assign_points(np.asarray(vertices[starts], float), labels, affine)
+    last = assign_points(np.asarray(vertices[stops], float), labels, affine)
+    first[empty] = last[empty] = 0
+    return pair_indices(first, last, nb_nodes)
+
+
+def compute_connectome(tractogram, parcellation, weights=None, n_procs=1):
+    """
+    Connectivity matrix of a tractogram
+    :param tractogram: path of the .tck file
+    :param parcellation: path of the parcellation in the space of the tractogram
+    :param weights: optional text file of streamline weights (tcksift2 output),
+    streamlines are counted otherwise
+    :param n_procs: number of processes scanning the tractogram
+    :return: (N, N) symmetric matrix, N being the largest label
+    """
+    labels, affine = load_parcellation(parcellation)
+    nb_nodes = int(labels.max())
+    vertices = TckFile(tractogram).vertices
+    nb_vertices = len(vertices)
+    nb_ranges = max(1, min(int(n_procs), -(-nb_vertices // BLOCK_SIZE)))
+    bounds = np.linspace(0, nb_vertices, nb_ranges + 1).astype(np.int64)
+    arguments = [
+        (tractogram, int(start), int(stop), parcellation)
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+    if nb_ranges > 1:
+        with ProcessPoolExecutor(max_workers=nb_ranges) as executor:
+            results = list(executor.map(_scan_range, *zip(*arguments)))
+    else:
+        results = [_scan_range(*arguments[0])]
+
+    # The first streamline of a range starts after the last separator of the
+    # previous ranges
+    pairs = []
+    previous = -1
+    for result in results:
+        if result["first"] is not None:
+            head = _assign_streamlines(
+                vertices,
+                np.array([previous + 1]),
+                np.array([result["first"] - 1]),
+                labels,
+                affine,
+                nb_nodes,
+            )
+            pairs.extend([head.astype(np.int32), result["pairs"]])
+            previous = result["last"]
+        if result["end"]:
+            break
+    pairs = np.concatenate(pairs) if pairs else np.empty(0, np.int32)
+
+    if weights is not None:
+        weights = np.loadtxt(weights, ndmin=2).ravel()
+        if len(weights) != len(pairs):
+            raise ValueError(
+                "%d weights for %d streamlines in %s"
+                % (len(weights), len(pairs), tractogram)
+            )
+        weights = weights[pairs >= 0]
+    matrix = np.bincount(
+        pairs[pairs >= 0], weights=weights, minlength=nb_nodes**2
+    ).reshape(nb_nodes, nb_nodes)
+    return matrix + np.triu(matrix, 1).T
+
+
+def write_connectome(tractogram, parcellation, weights=None, n_procs=1):
+    """
+    Compute a connectivity matrix and write it as CSV (Nipype Function step)
+    :param tractogram: path of the .tck file
+    :param parcellation: path of the parcellation in diffusion space
+    :param weights: optional streamline weights file (tcksift2)
+    :param n_procs: number of processes
+    :return: path of connectome.csv
+    """
+    import os
+
+    import numpy as np
+
+    from mrproc.connectome import compute_connectome
+
+    matrix = compute_connectome(
+        tractogram, parcellation, weights=weights, n_procs=n_procs
+    )
+    out_file = os.path.abspath("connectome.csv")
+    np.savetxt(out_file, matrix, delimiter=",", fmt="%.10g")
+    return out_file
@@ -0,0 +1,334 @@
+"""Per-node runtime, memory and I/O instrumentation of workflow executions
+
+InstrumentedMultiProcPlugin is a drop-in replacement of the MultiProc plugin that
+measures, in the worker process running each node:
++ wall time and CPU time (node process plus the commands it launched)
++ peak resident memory and peak number of busy threads of the node process tree
++ bytes read and written from/to block devices by the launched commands
++ size of the input files and of the node directory (outputs)
+Declared threads (n_procs) and memory (mem_gb) are recorded next to the measures.
+When the run ends, a JSON and a CSV report are written together with the critical
+path of the execution graph. Reports of several runs or subjects are merged with
+aggregate_reports, and suggest_resource_profile turns the aggregate into a
+resource profile (see mrproc.resources).
+
+CPU time and block I/O rely on getrusage: they are exact once the commands have
+exited, page cache hits are not counted as reads. Peak memory and busy threads
+are sampled by the Nipype resource monitor (every monitor_frequency seconds,
+worker process and all its children), which requires psutil. Without psutil
+they are left to None.
+"""
+
+import csv
+import glob
+import json
+import math
+import os
+import os.path as op
+import resource
+import statistics
+import time
+
+import networkx as nx
+from nipype import config as nipype_config
+from nipype.pipeline.plugins import MultiProcPlugin
+from nipype.pipeline.plugins.multiproc import run_node
+
+REPORT_FIELDS = [
+    "node",
+    "name",
+    "subject_id",
+    "status",
+    "start",
+    "wall_time",
+    "cpu_time",
+    "parallelism",
+    "peak_rss_gb",
+    "peak_threads",
+    "n_procs",
+    "mem_gb",
+    "bytes_read",
+    "bytes_written",
+    "input_size",
+    "output_size",
+]
+BLOCK_UNIT = 512
+
+
+def run_instrumented_node(node, updatehash, taskid):
+    """
+    Execute a node as MultiProc does and attach its measures to the result
+    :param node: Nipype node
+    :param updatehash: flag for updating hash
+    :param taskid: identifier of the task
+    :return: result dictionary of run_node with an extra "metrics" entry
+    """
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    result = run_node(node, updatehash, taskid)
+    wall_time = time.time() - start
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def delta(field):
+        return (
+            getattr(self_after, field)
+            - getattr(self_before, field)
+            + getattr(children_after, field)
+            - getattr(children_before, field)
+        )
+
+    # The monitor logs its samples in the worker directory, one file per interface
+    for log_file in glob.glob(".proc-%d_time-*" % os.getpid()):
+        os.remove(log_file)
+    cpu_percent = _monitored(result.get("result"), "cpu_percent")
+    result["metrics"] = {
+        "start": start,
+        "wall_time": wall_time,
+        "cpu_time": delta("ru_utime") + delta("ru_stime"),
+        "peak_rss_gb": _monitored(result.get("result"), "mem_peak_gb"),
+        "peak_threads": None if cpu_percent is None else cpu_percent / 100,
+        "bytes_read": delta("ru_inblock") * BLOCK_UNIT,
+        "bytes_written": delta("ru_oublock") * BLOCK_UNIT,
+        "input_size": _input_size(node),
+        "output_size": directory_size(node.output_dir()),
+    }
+    return result
+
+
+class InstrumentedMultiProcPlugin(MultiProcPlugin):
+    """
+    MultiProc plugin writing a per-node run report
+
+    Accepts the MultiProc plugin_args plus "report_dir", the directory of the
+    run report (default: current directory), and "monitor_frequency", the
+    sampling period (s) of the resource monitor (default: 0.5).
+    """
+
+    def __init__(self, plugin_args=None):
+        plugin_args = dict(plugin_args or {})
+        self.report_dir = op.abspath(plugin_args.pop("report_dir", os.getcwd()))
+        self.monitor_frequency = plugin_args.pop("monitor_frequency", 0.5)
+        super().__init__(plugin_args=plugin_args)
+        self._submitted = {}
+        self._metrics = {}
+
+    def run(self, graph, config, updatehash=False):
+        # Workers are forked on the first submission and inherit the monitor
+        monitoring = nipype_config.resource_monitor
+        frequency = nipype_config.get("execution", "resource_monitor_frequency", "1")
+        nipype_config.enable_resource_monitor()
+        nipype_config.set(
+            "execution", "resource_monitor_frequency", str(self.monitor_frequency)
+        )
+        try:
+            return super().run(graph, config, updatehash=updatehash)
+        finally:
+            nipype_config.resource_monitor = monitoring
+            nipype_config.set("execution", "resource_monitor_frequency", frequency)
+            records = self.records()
+            critical_path = compute_critical_path(graph, records)
+            write_report(records, critical_path, self.report_dir)
+
+    def records(self):
+        """
+        Measures of the nodes executed so far
+        :return: list of dict (see REPORT_FIELDS)
+        """
+        records = []
+        for taskid, node_info in sorted(self._submitted.items()):
+            metrics = self._metrics.get(taskid)
+            record = dict(node_info)
+            record["status"] = "running"
+            record.update(metrics or {})
+            if record.get("wall_time"):
+                record["parallelism"] = record["cpu_time"] / record["wall_time"]
+            records.append(record)
+        return records
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        if getattr(node.interface, "terminal_output", "") == "stream":
+            node.interface.terminal_output = "allatonce"
+        self._submitted[self._taskid] = {
+            "node": node.fullname,
+            "name": node.name,
+            "subject_id": node_subject_id(node),
+            "output_dir": node.output_dir(),
+            "n_procs": node.n_procs,
+            "mem_gb": node.mem_gb,
+        }
+        result_future = self.pool.submit(
+            run_instrumented_node, node, updatehash, self._taskid
+        )
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+        return self._taskid
+
+    def _async_callback(self, args):
+        result = args.result()
+        metrics = result.pop("metrics", {})
+        metrics["status"] = "error" if result["traceback"] else "done"
+        self._metrics[result["taskid"]] = metrics
+        super()._async_callback(args)
+
+
+def compute_critical_path(graph, records):
+    """
+    Longest chain of dependent nodes weighted by their wall time
+    :param graph: execution graph (nodes are Nipype nodes)
+    :param records: node records (see InstrumentedMultiProcPlugin.records)
+    :return: dict with the total duration and the nodes of the path
+    """
+    wall_times = {
+        record["output_dir"]: record.get("wall_time") or 0.0 for record in records
+    }
+    names = {record["output_dir"]: record["node"] for record in records}
+    finish = {}
+    previous = {}
+    for node in nx.topological_sort(graph):
+        key = node.output_dir()
+        best = None
+        for parent in graph.predecessors(node):
+            parent_key = parent.output_dir()
+            if best is None or finish[parent_key] > finish[best]:
+                best = parent_key
+        previous[key] = best
+        finish[key] = wall_times.get(key, 0.0) + (finish[best] if best else 0.0)
+    if not finish:
+        return {"duration": 0.0, "nodes": []}
+    last = max(finish, key=finish.get)
+    path = []
+    key = last
+    while key is not None:
+        if key in names:
+            path.append({"node": names[key], "wall_time": wall_times[key]})
+        key = previous[key]
+    return {"duration": finish[last], "nodes": path[::-1]}
+
+
+def write_report(records, critical_path, report_dir):
+    """
+    Write run_report.json (records and critical path) and run_report.csv
+    :param records: node records
+    :param critical_path: see compute_critical_path
+    :param report_dir: output directory
+    :return: paths of the JSON and CSV reports
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    json_report = op.join(report_dir, "run_report.json")
+    csv_report = op.join(report_dir, "run_report.csv")
+    with open(json_report, "w") as f:
+        json.dump({"nodes": records, "critical_path": critical_path}, f, indent=2)
+    with open(csv_report, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(records)
+    return json_report, csv_report
+
+
+def aggregate_reports(report_files):
+    """
+    Statistics of every node name across subjects and runs
+    :param report_files: paths of run_report.json files
+    :return: dict mapping node names to the count, median and max of the wall
+    time, CPU time, parallelism, peak memory and peak threads of its successful
+    executions
+    """
+    samples = {}
+    for report_file in report_files:
+        with open(report_file) as f:
+            records = json.load(f)["nodes"]
+        for record in records:
+            if record["status"] == "done":
+                samples.setdefault(record["name"], []).append(record)
+
+    aggregate = {}
+    for name, node_records in sorted(samples.items()):
+        stats = {"count": len(node_records)}
+        for field in [
+            "wall_time",
+            "cpu_time",
+            "parallelism",
+            "peak_rss_gb",
+            "peak_threads",
+        ]:
+            values = [r[field] for r in node_records if r.get(field) is not None]
+            if values:
+                stats[field + "_median"] = statistics.median(values)
+                stats[field + "_max"] = max(values)
+        aggregate[name] = stats
+    return aggregate
+
+
+def suggest_resource_profile(aggregate, memory_margin=1.2):
+    """
+    Resource profile entries derived from measured executions
+    :param aggregate: see aggregate_reports
+    :param memory_margin: factor applied to the largest measured peak memory
+    :return: profile (dict) accepted by mrproc.resources.load_resource_profile
+    """
+    profile = {}
+    for name, stats in aggregate.items():
+        entry = {}
+        # Busy threads sampled while running, else average CPU time per second
+        threads = stats.get("peak_threads_median", stats.get("parallelism_median"))
+        if threads is not None:
+            entry["n_procs"] = max(1, int(math.ceil(threads)))
+        if "peak_rss_gb_max" in stats:
+            entry["mem_gb"] = round(stats["peak_rss_gb_max"] * memory_margin, 2)
+        if entry:
+            profile[name] = entry
+    return profile
+
+
+def node_subject_id(node):
+    """
+    Subject processed by a node of an expanded batch workflow
+    :param node: Nipype node of the execution graph
+    :return: subject_id iterable value (str) or None outside of the batch workflow
+    """
+    # Iterables expansion of the batch workflow: "_subject_id_<label>"
+    for parameter in node.parameterization or []:
+        if str(parameter).startswith("_subject_id_"):
+            return str(parameter)[len("_subject_id_") :]
+    return None
+
+
+def directory_size(directory):
+    """
+    Size of the files of a directory tree (symbolic links are not followed, files
+    removed during the walk are skipped)
+    :param directory: path of the directory
+    :return: bytes
+    """
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = op.join(root, name)
+            try:
+                if not op.islink(path):
+                    size += op.getsize(path)
+            except OSError:
+                # Removed while walking the tree
+                continue
+    return size
+
+
+def _monitored(result, field):
+    # Value recorded by the resource monitor, maximum over the jobs of a MapNode
+    runtime = getattr(result, "runtime", None)
+    runtimes = runtime if isinstance(runtime, list) else [runtime]
+    values = [getattr(runtime, field, None) for runtime in runtimes]
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def _input_size(node):
+    size = 0
+    for value in node.inputs.get_traitsfree().values():
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            if isinstance(item, str) and op.isfile(item):
+                size += op.getsize(item)
+    return size
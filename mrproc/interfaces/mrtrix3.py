@@ -0,0 +1,234 @@
+"""
+Nipype interfaces of the Mrtrix3 commands that are missing from (or need more
+options than) nipype.interfaces.mrtrix3
+"""
+
+import os.path as op
+
+from nipype.interfaces.base import File
+from nipype.interfaces.base import InputMultiPath
+from nipype.interfaces.base import TraitedSpec
+from nipype.interfaces.base import isdefined
+from nipype.interfaces.base import traits
+from nipype.interfaces.mrtrix3 import tracking
+from nipype.interfaces.mrtrix3.base import MRTrix3Base
+from nipype.interfaces.mrtrix3.base import MRTrix3BaseInputSpec
+
+
+class TractographyInputSpec(tracking.TractographyInputSpec):
+    rng_seed = traits.Int(
+        desc="seed of the Mrtrix3 random number generator (MRTRIX_RNG_SEED), "
+        "allows independent and reproducible tractograms"
+    )
+
+
+class Tractography(tracking.Tractography):
+    """
+    tckgen whose random number generator can be seeded
+
+    Mrtrix3 only reads its seed from the MRTRIX_RNG_SEED environment variable,
+    which is set from the rng_seed input (part of the node hash, contrary to
+    environ).
+    """
+
+    input_spec = TractographyInputSpec
+
+    def _get_environ(self):
+        environ = dict(super()._get_environ())
+        if isdefined(self.inputs.rng_seed):
+            environ["MRTRIX_RNG_SEED"] = str(self.inputs.rng_seed)
+        return environ
+
+
+class TCKEditInputSpec(MRTrix3BaseInputSpec):
+    in_files = InputMultiPath(
+        File(exists=True),
+        argstr="%s",
+        position=-2,
+        mandatory=True,
+        desc="input tractograms, concatenated in the output",
+    )
+    out_file = File(
+        "edited.tck",
+        argstr="%s",
+        position=-1,
+        usedefault=True,
+        desc="output tractogram",
+    )
+    number = traits.Int(
+        argstr="-number %d", desc="maximum number of streamlines to write"
+    )
+    min_length = traits.Float(
+        argstr="-minlength %f", desc="minimal length of the written streamlines"
+    )
+    max_length = traits.Float(
+        argstr="-maxlength %f", desc="maximal length of the written streamlines"
+    )
+
+
+class TCKEditOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="output tractogram")
+
+
+class TCKEdit(MRTrix3Base):
+    """
+    Concatenate and/or filter tractograms (tckedit)
+
+    >>> merge = TCKEdit(in_files=["shard0.tck", "shard1.tck"])  # doctest: +SKIP
+    >>> merge.cmdline  # doctest: +SKIP
+    'tckedit shard0.tck shard1.tck edited.tck'
+    """
+
+    _cmd = "tckedit"
+    input_spec = TCKEditInputSpec
+    output_spec = TCKEditOutputSpec
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs["out_file"] = op.abspath(self.inputs.out_file)
+        return outputs
+
+
+class SIFTInputSpec(MRTrix3BaseInputSpec):
+    in_file = File(
+        exists=True,
+        argstr="%s",
+        position=-3,
+        mandatory=True,
+        desc="input tractogram",
+    )
+    in_fod = File(
+        exists=True,
+        argstr="%s",
+        position=-2,
+        mandatory=True,
+        desc="white matter fiber orientation distribution used to filter the "
+        "tractogram",
+    )
+    act_file = File(
+        exists=True,
+        argstr="-act %s",
+        desc="ACT five-tissue-type image, used to derive the processing mask",
+    )
+    proc_mask = File(
+        exists=True,
+        argstr="-proc_mask %s",
+        desc="processing mask (instead of the one derived from the ACT image)",
+    )
+    fd_scale_gm = traits.Bool(
+        argstr="-fd_scale_gm",
+        requires=["act_file"],
+        desc="scale the fiber density by the white matter partial volume",
+    )
+    out_mu = File(argstr="-out_mu %s", desc="output the final proportionality factor")
+    out_csv = File(argstr="-csv %s", desc="output statistics of the optimisation")
+
+
+class TCKSiftInputSpec(SIFTInputSpec):
+    out_file = File(
+        "filtered.tck",
+        argstr="%s",
+        position=-1,
+        usedefault=True,
+        desc="output filtered tractogram",
+    )
+    term_number = traits.Int(
+        argstr="-term_number %d",
+        desc="number of streamlines to keep",
+    )
+    term_ratio = traits.Float(
+        argstr="-term_ratio %f",
+        desc="termination ratio, defined as the ratio between the reduction in "
+        "cost function and the total initial cost function",
+    )
+    term_mu = traits.Float(
+        argstr="-term_mu %f",
+        desc="terminate once the proportionality factor reaches this value",
+    )
+    out_selection = File(
+        argstr="-out_selection %s",
+        desc="output a text file with a 0/1 selection mask for every input "
+        "streamline",
+    )
+
+
+class SIFTOutputSpec(TraitedSpec):
+    out_mu = File(desc="final proportionality factor")
+    out_csv = File(desc="statistics of the optimisation")
+
+
+class SIFTBase(MRTrix3Base):
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        for name in ["out_mu", "out_csv"]:
+            if isdefined(getattr(self.inputs, name)):
+                outputs[name] = op.abspath(getattr(self.inputs, name))
+        return outputs
+
+
+class TCKSiftOutputSpec(SIFTOutputSpec):
+    out_file = File(exists=True, desc="output filtered tractogram")
+    out_selection = File(desc="selection mask of the input streamlines")
+
+
+class TCKSift(SIFTBase):
+    """
+    Filter a whole-brain tractogram to match the fiber densities of the FOD
+    (tcksift)
+
+    >>> sift = TCKSift(in_file="tracked.tck", in_fod="wm.mif")  # doctest: +SKIP
+    >>> sift.inputs.act_file = "5tt.nii.gz"  # doctest: +SKIP
+    >>> sift.inputs.term_ratio = 0.1  # doctest: +SKIP
+    >>> sift.cmdline  # doctest: +SKIP
+    'tcksift -act 5tt.nii.gz -term_ratio 0.100000 tracked.tck wm.mif filtered.tck'
+    """
+
+    _cmd = "tcksift"
+    input_spec = TCKSiftInputSpec
+    output_spec = TCKSiftOutputSpec
+
+    def _list_outputs(self):
+        outputs = super()._list_outputs()
+        outputs["out_file"] = op.abspath(self.inputs.out_file)
+        if isdefined(self.inputs.out_selection):
+            outputs["out_selection"] = op.abspath(self.inputs.out_selection)
+        return outputs
+
+
+class TCKSift2InputSpec(SIFTInputSpec):
+    out_weights = File(
+        "sift2_weights.txt",
+        argstr="%s",
+        position=-1,
+        usedefault=True,
+        desc="output text file with one weight per streamline",
+    )
+    min_td_frac = traits.Float(
+        argstr="-min_td_frac %f",
+        desc="minimum fraction of the FOD integral reconstructed by streamlines "
+        "for a fixel to be included in the optimisation",
+    )
+
+
+class TCKSift2OutputSpec(SIFTOutputSpec):
+    out_weights = File(exists=True, desc="per streamline weights")
+
+
+class TCKSift2(SIFTBase):
+    """
+    Compute a weight per streamline so that the weighted tractogram matches the
+    fiber densities of the FOD (tcksift2). The tractogram is left untouched.
+
+    >>> sift2 = TCKSift2(in_file="tracked.tck", in_fod="wm.mif")  # doctest: +SKIP
+    >>> sift2.cmdline  # doctest: +SKIP
+    'tcksift2 tracked.tck wm.mif sift2_weights.txt'
+    """
+
+    _cmd = "tcksift2"
+    input_spec = TCKSift2InputSpec
+    output_spec = TCKSift2OutputSpec
+
+    def _list_outputs(self):
+        outputs = super()._list_outputs()
+        outputs["out_weights"] = op.abspath(self.inputs.out_weights)
+        return outputs
@@ -0,0 +1,319 @@
+"""Memory-mapped reader and writer of MRtrix3 images (.mif, .mih)
+
+A .mif file is a text header followed by the voxel data, a .mih file is a header
+whose data lives in another file (file: <path> <offset>). The layout field gives
+the order of the axes in memory: the axis with the smallest absolute value is the
+fastest varying one and a negative sign means that the axis is stored reversed.
+The reader exposes the data as a NumPy view over a memory map, indexed by
+(i, j, k, volume) whatever the layout, so that only the accessed slabs are read.
+Gradient-compressed (.mif.gz) images are not supported.
+
+write_nifti_header writes a .mih header over the data of an uncompressed NIfTI
+file, so that a diffusion series can be given to MRtrix3 with its gradient table
+embedded without copying its voxels.
+"""
+
+import os
+
+import numpy as np
+
+MAGIC = "mrtrix image"
+DTYPES = {
+    "Int8": np.dtype("i1"),
+    "UInt8": np.dtype("u1"),
+    "Int16LE": np.dtype("<i2"),
+    "Int16BE": np.dtype(">i2"),
+    "UInt16LE": np.dtype("<u2"),
+    "UInt16BE": np.dtype(">u2"),
+    "Int32LE": np.dtype("<i4"),
+    "Int32BE": np.dtype(">i4"),
+    "UInt32LE": np.dtype("<u4"),
+    "UInt32BE": np.dtype(">u4"),
+    "Float32LE": np.dtype("<f4"),
+    "Float32BE": np.dtype(">f4"),
+    "Float64LE": np.dtype("<f8"),
+    "Float64BE": np.dtype(">f8"),
+}
+# Fields generated by the writer
+RESERVED_FIELDS = ["dim", "vox", "layout", "datatype", "transform", "file"]
+
+
+def read_header(path):
+    """
+    Read the header of an MRtrix3 image
+    :param path: path of the .mif or .mih file
+    :return: header (dict of str), values of repeated keys (transform, dw_scheme)
+    are joined by newlines
+    """
+    header = {}
+    with open(path, "rb") as f:
+        magic = f.readline().decode("latin-1").strip()
+        if magic != MAGIC:
+            raise ValueError("%s is not a MRtrix3 image" % path)
+        for line in f:
+            line = line.decode("latin-1").strip()
+            if line == "END":
+                break
+            key, _, value = line.partition(":")
+            key, value = key.strip(), value.strip()
+            header[key] = header[key] + "\n" + value if key in header else value
+        else:
+            raise ValueError("%s: unterminated header" % path)
+    return header
+
+
+def parse_layout(layout):
+    """
+    Memory order of the axes of an image
+    :param layout: layout header field, e.g. "+1,+2,+3,+0"
+    :return: rank of each axis (0: fastest varying), whether each axis is stored
+    reversed
+    """
+    ranks, reversed_axes = [], []
+    for item in layout.split(","):
+        item = item.strip()
+        reversed_axes.append(item.startswith("-"))
+        ranks.append(int(item.lstrip("+-")))
+    return ranks, reversed_axes
+
+
+class MifFile:
+    """
+    Memory-mapped MRtrix3 image
+
+    >>> dwi = MifFile("dwi_biascorr.mif")  # doctest: +SKIP
+    >>> slab = np.asarray(dwi.data[:, :, 10:20])  # doctest: +SKIP
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.shape = tuple(int(n) for n in self.header["dim"].split(","))
+        datatype = self.header.get("datatype", "Float32LE")
+        if datatype != "Bit" and datatype not in DTYPES:
+            raise ValueError("%s: unsupported datatype %s" % (path, datatype))
+        self.datatype = datatype
+        data_file, _, offset = self.header["file"].partition(" ")
+        self.offset = int(offset or 0)
+        self.data_file = (
+            path
+            if data_file == "."
+            else os.path.join(os.path.dirname(os.path.abspath(path)), data_file)
+        )
+
+    @property
+    def vox(self):
+        """Voxel sizes of the spatial axes (mm)"""
+        return tuple(float(v) for v in self.header["vox"].split(",")[:3])
+
+    @property
+    def transform(self):
+        """(3, 4) voxel (mm) to scanner transformation"""
+        rows = [
+            [float(value) for value in line.split(",")]
+            for line in self.header["transform"].split("\n")
+        ]
+        return np.array(rows[:3])
+
+    @property
+    def affine(self):
+        """(4, 4) voxel index to scanner transformation (NIfTI convention)"""
+        affine = np.eye(4)
+        affine[:3] = self.transform
+        affine[:3, :3] = affine[:3, :3] * self.vox
+        return affine
+
+    @property
+    def dw_scheme(self):
+        """(N, 4) gradient table (x, y, z, b) in scanner space, None if absent"""
+        if "dw_scheme" not in self.header:
+            return None
+        return np.array(
+            [
+                [float(value) for value in line.split(",")]
+                for line in self.header["dw_scheme"].split("\n")
+            ]
+        )
+
+    @property
+    def data(self):
+        """Voxel data indexed by axis order, a view over a memory map except for
+        Bit images (read at once)"""
+        ranks, reversed_axes = parse_layout(
+            self.header.get(
+                "layout", ",".join("+%d" % i for i in range(len(self.shape)))
+            )
+        )
+        size = int(np.prod(self.shape))
+        # C order shape: slowest varying axis first
+        memory_order = sorted(range(len(self.shape)), key=lambda axis: -ranks[axis])
+        memory_shape = [self.shape[axis] for axis in memory_order]
+        if self.datatype == "Bit":
+            nb_bytes = (size + 7) // 8
+            with open(self.data_file, "rb") as f:
+                f.seek(self.offset)
+                packed = np.frombuffer(f.read(nb_bytes), dtype=np.uint8)
+            flat = np.unpackbits(packed)[:size].astype(bool)
+        else:
+            flat = np.memmap(
+                self.data_file,
+                dtype=DTYPES[self.datatype],
+                mode="r",
+                offset=self.offset,
+                shape=(size,),
+            )
+        data = flat.reshape(memory_shape).transpose(np.argsort(memory_order))
+        flips = tuple(
+            slice(None, None, -1) if flipped else slice(None)
+            for flipped in reversed_axes
+        )
+        data = data[flips]
+        if "scaling" in self.header:
+            offset, scale = (float(v) for v in self.header["scaling"].split(","))
+            if (offset, scale) != (0.0, 1.0):
+                data = data * scale + offset
+        return data
+
+
+def _header_lines(shape, affine, datatype, header):
+    """
+    Header fields of an image stored with the first axis fastest varying
+    :return: list of lines, magic and "file" field excluded
+    """
+    vox = np.sqrt((np.asarray(affine)[:3, :3] ** 2).sum(axis=0))
+    transform = np.array(affine[:3], dtype=float)
+    transform[:, :3] /= vox
+    lines = [
+        "dim: %s" % ",".join(str(n) for n in shape),
+        "vox: %s" % ",".join("%.10g" % v for v in list(vox) + [1] * (len(shape) - 3)),
+        "layout: %s" % ",".join("+%d" % i for i in range(len(shape))),
+        "datatype: %s" % datatype,
+    ]
+    lines.extend(
+        "transform: %s" % ",".join("%.10g" % v for v in row) for row in transform
+    )
+    for key, value in (header or {}).items():
+        if key not in RESERVED_FIELDS:
+            lines.extend("%s: %s" % (key, item) for item in str(value).split("\n"))
+    return lines
+
+
+def write_mif(path, data, affine, header=None, datatype="Float32LE"):
+    """
+    Write an image as .mif (first axis fastest varying)
+    :param path: path of the .mif file
+    :param data: array indexed by (i, j, k[, volume])
+    :param affine: (4, 4) voxel index to scanner transformation
+    :param header: other header fields (dict of str, e.g. dw_scheme, repeated
+    values joined by newlines)
+    :param datatype: datatype of the data (DTYPES)
+    :return: path
+    """
+    if datatype not in DTYPES:
+        raise ValueError("Unsupported datatype %s" % datatype)
+    data = np.asarray(data)
+    text = "\n".join([MAGIC] + _header_lines(data.shape, affine, datatype, header))
+    text += "\n"
+    # "file" holds the data offset, which depends on its own number of digits
+    offset = len(text)
+    while True:
+        tail = "file: . %d\nEND\n" % offset
+        if len(text) + len(tail) == offset:
+            break
+        offset = len(text) + len(tail)
+    with open(path, "wb") as f:
+        f.write((text + tail).encode("latin-1"))
+        f.write(data.astype(DTYPES[datatype]).tobytes(order="F"))
+    return path
+
+
+def fsl_gradient_table(bvals, bvecs, affine):
+    """
+    Gradient table in scanner space from FSL bvals/bvecs, as mrconvert -fslgrad
+    imports it
+    :param bvals: path of the bvals file
+    :param bvecs: path of the bvecs file (3 rows, or 3 columns)
+    :param affine: (4, 4) voxel index to scanner transformation of the series
+    :return: (N, 4) gradient table (x, y, z, b)
+    """
+    values = np.loadtxt(bvals, ndmin=1)
+    vectors = np.loadtxt(bvecs, ndmin=2)
+    if vectors.shape[0] != 3:
+        vectors = vectors.T
+    if vectors.shape != (3, len(values)):
+        raise ValueError(
+            "%s does not hold 3 x %d gradient directions" % (bvecs, len(values))
+        )
+    vectors = vectors.T.copy()
+    linear = np.asarray(affine, dtype=float)[:3, :3]
+    # bvecs are given in the voxel frame of a radiological (left-handed) image:
+    # the first axis is flipped for images stored the other way
+    if np.linalg.det(linear) > 0:
+        vectors[:, 0] = -vectors[:, 0]
+    rotation = linear / np.sqrt((linear**2).sum(axis=0))
+    return np.column_stack([vectors @ rotation.T, values])
+
+
+def write_nifti_header(path, nifti, header=None):
+    """
+    Write a .mih header over the voxels of an uncompressed NIfTI file
+    :param path: path of the .mih file
+    :param nifti: path of the .nii file
+    :param header: other header fields (see write_mif)
+    :return: path
+    """
+    import nibabel
+
+    if not nifti.endswith(".nii"):
+        raise ValueError(
+            "%s: only the voxels of uncompressed NIfTI files can be referenced" % nifti
+        )
+    image = nibabel.load(nifti)
+    dtype = image.get_data_dtype()
+    datatypes = {value: key for key, value in DTYPES.items()}
+    if dtype not in datatypes:
+        raise ValueError("%s: unsupported datatype %s" % (nifti, dtype))
+    fields = dict(header or {})
+    # Offset and scaling of the stored values, held by the nibabel proxy
+    slope, inter = float(image.dataobj.slope), float(image.dataobj.inter)
+    if (slope, inter) != (1.0, 0.0):
+        fields["scaling"] = "%.10g,%.10g" % (inter, slope)
+    text = "\n".join(
+        [MAGIC]
+        + _header_lines(image.shape, image.affine, datatypes[dtype], fields)
+        + [
+            "file: %s %d" % (os.path.abspath(nifti), image.dataobj.offset),
+            "END",
+        ]
+    )
+    with open(path, "w") as f:
+        f.write(text + "\n")
+    return path
+
+
+def write_diffusion_header(diffusion_volume, bvals, bvecs):
+    """
+    Reference a NIfTI diffusion series from a .mih header with its gradient table
+    embedded, instead of converting it (Nipype Function step)
+    :param diffusion_volume: path of the uncompressed NIfTI series
+    :param bvals: path of the bvals file
+    :param bvecs: path of the bvecs file
+    :return: path of dwi.mih
+    """
+    import os
+
+    import nibabel
+
+    from mrproc.io.mif import fsl_gradient_table
+    from mrproc.io.mif import write_nifti_header
+
+    scheme = fsl_gradient_table(bvals, bvecs, nibabel.load(diffusion_volume).affine)
+    return write_nifti_header(
+        os.path.abspath("dwi.mih"),
+        diffusion_volume,
+        {
+            "dw_scheme": "\n".join(
+                ",".join("%.10g" % value for value in row) for row in scheme
+            )
+        },
+    )
@@ -0,0 +1,250 @@
+"""Streaming reader and writer of MRtrix3 tractograms (.tck)
+
+A .tck file is a text header followed by float triplets: the vertices of every
+streamline are followed by a (NaN, NaN, NaN) separator and the file ends with an
+(Inf, Inf, Inf) triplet. The reader memory-maps the vertices and yields the
+streamlines by chunks, so that whole-brain tractograms (10M streamlines) are
+processed in bounded memory. A chunk is a pair (points, lengths): the (P, 3)
+array of the concatenated vertices of the streamlines of the chunk and the number
+of vertices of each streamline.
+"""
+
+import os
+
+import numpy as np
+
+MAGIC = "mrtrix tracks"
+DTYPES = {
+    "Float32LE": np.dtype("<f4"),
+    "Float32BE": np.dtype(">f4"),
+    "Float64LE": np.dtype("<f8"),
+    "Float64BE": np.dtype(">f8"),
+}
+# Fields generated by the writer
+RESERVED_FIELDS = ["datatype", "file", "count", "total_count"]
+# Width of the count field, which is rewritten in place once the file is complete
+COUNT_WIDTH = 10
+
+
+def read_header(path):
+    """
+    Read the header of a tractogram
+    :param path: path of the .tck file
+    :return: header (dict of str), values of repeated keys are joined by newlines
+    """
+    header = {}
+    with open(path, "rb") as f:
+        magic = f.readline().decode("latin-1").strip()
+        if magic != MAGIC:
+            raise ValueError("%s is not a MRtrix3 tractogram" % path)
+        for line in f:
+            line = line.decode("latin-1").strip()
+            if line == "END":
+                break
+            key, _, value = line.partition(":")
+            key, value = key.strip(), value.strip()
+            header[key] = header[key] + "\n" + value if key in header else value
+        else:
+            raise ValueError("%s: unterminated header" % path)
+    return header
+
+
+def chunk_streamlines(points, lengths):
+    """
+    Split a chunk into the arrays of its streamlines
+    :param points: (P, 3) array of concatenated vertices
+    :param lengths: number of vertices of each streamline
+    :return: list of (n, 3) arrays
+    """
+    return np.split(points, np.cumsum(lengths)[:-1]) if len(lengths) else []
+
+
+class TckFile:
+    """
+    Memory-mapped MRtrix3 tractogram
+
+    >>> tck = TckFile("tracked.tck")  # doctest: +SKIP
+    >>> for points, lengths in tck.iter_chunks(chunk_size=100000):  # doctest: +SKIP
+    ...     endpoints = points[np.cumsum(lengths) - 1]
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        datatype = self.header.get("datatype", "Float32LE")
+        if datatype not in DTYPES:
+            raise ValueError("%s: unsupported datatype %s" % (path, datatype))
+        self.dtype = DTYPES[datatype]
+        self.offset = int(self.header["file"].split()[-1])
+        nb_values = (os.path.getsize(path) - self.offset) // self.dtype.itemsize
+        self._nb_vertices = nb_values // 3
+
+    @property
+    def count(self):
+        """Number of streamlines declared in the header (None if absent)"""
+        count = self.header.get("count")
+        return int(count) if count is not None else None
+
+    @property
+    def vertices(self):
+        """(V, 3) memory map of the vertices, separators included"""
+        if self._nb_vertices == 0:
+            return np.empty((0, 3), dtype=self.dtype)
+        return np.memmap(
+            self.path,
+            dtype=self.dtype,
+            mode="r",
+            offset=self.offset,
+            shape=(self._nb_vertices, 3),
+        )
+
+    def iter_chunks(self, chunk_size=100000, block_size=1 << 20):
+        """
+        Iterate over the streamlines by chunks
+        :param chunk_size: maximal number of streamlines of a chunk
+        :param block_size: number of vertices scanned at once for separators
+        :return: generator of (points, lengths) chunks, points are float32 or
+        float64 native arrays
+        """
+        vertices = self.vertices
+        nb_vertices = len(vertices)
+        # Vertex index of the first vertex of the next streamline
+        start = 0
+        # Separator indices of the complete streamlines not yet yielded
+        separators = []
+        position = 0
+        while position < nb_vertices:
+            block = vertices[position : position + block_size, 0]
+            inf = np.flatnonzero(np.isinf(block))
+            if len(inf):
+                nb_vertices = position + inf[0]
+                block = block[: inf[0]]
+            separators.extend(np.flatnonzero(np.isnan(block)) + position)
+            position += len(block)
+            while len(separators) >= chunk_size:
+                chunk, separators = separators[:chunk_size], separators[chunk_size:]
+                yield self._read_chunk(vertices, start, chunk)
+                start = chunk[-1] + 1
+        if separators:
+            yield self._read_chunk(vertices, start, separators)
+
+    def iter_streamlines(self, chunk_size=100000):
+        """
+        Iterate over the streamlines one by one
+        :param chunk_size: number of streamlines read at once
+        :return: generator of (n, 3) arrays
+        """
+        for points, lengths in self.iter_chunks(chunk_size=chunk_size):
+            yield from chunk_streamlines(points, lengths)
+
+    def _read_chunk(self, vertices, start, separators):
+        separators = np.asarray(separators, dtype=np.int64)
+        starts = np.concatenate(([start], separators[:-1] + 1))
+        lengths = separators - starts
+        block = np.asarray(vertices[start : separators[-1]])
+        points = block[~np.isnan(block[:, 0])]
+        return points.astype(self.dtype.newbyteorder("="), copy=False), lengths
+
+
+class TckWriter:
+    """
+    Write a MRtrix3 tractogram chunk by chunk
+
+    The header is written first with a placeholder count, which is updated when
+    the writer is closed.
+
+    >>> with TckWriter("filtered.tck", header=TckFile("in.tck").header) as writer:
+    ...     writer.write(points, lengths)  # doctest: +SKIP
+    """
+
+    def __init__(self, path, header=None, datatype="Float32LE"):
+        if datatype not in DTYPES:
+            raise ValueError("Unsupported datatype %s" % datatype)
+        self.path = path
+        self.dtype = DTYPES[datatype]
+        self.count = 0
+        header = {
+            key: value
+            for key, value in (header or {}).items()
+            if key not in RESERVED_FIELDS
+        }
+        lines = [MAGIC]
+        for key, value in header.items():
+            lines.extend("%s: %s" % (key, item) for item in str(value).split("\n"))
+        lines.append("datatype: %s" % datatype)
+        text = "\n".join(lines) + "\n"
+        # "file" holds the data offset, which depends on its own number of digits
+        offset = len(text)
+        while True:
+            tail = "file: . %d\ncount: %s\nEND\n" % (offset, "0" * COUNT_WIDTH)
+            if len(text) + len(tail) == offset:
+                break
+            offset = len(text) + len(tail)
+        self._count_position = len(text) + tail.index("count: ") + len("count: ")
+        self._file = open(path, "wb")
+        self._file.write((text + tail).encode("latin-1"))
+
+    def write(self, points, lengths):
+        """
+        Append a chunk of streamlines
+        :param points: (P, 3) array of concatenated vertices
+        :param lengths: number of vertices of each streamline
+        :return:
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if len(lengths) == 0:
+            return
+        points = np.asarray(points)
+        if points.shape != (lengths.sum(), 3):
+            raise ValueError("points do not match the streamline lengths")
+        # Each streamline is followed by a separator row
+        data = np.full((len(points) + len(lengths), 3), np.nan, dtype=self.dtype)
+        rows = np.arange(len(points)) + np.repeat(np.arange(len(lengths)), lengths)
+        data[rows] = points
+        self._file.write(data.tobytes())
+        self.count += len(lengths)
+
+    def write_streamlines(self, streamlines):
+        """
+        Append a sequence of (n, 3) streamline arrays
+        :param streamlines: iterable of arrays
+        :return:
+        """
+        streamlines = list(streamlines)
+        if streamlines:
+            self.write(
+                np.concatenate(streamlines),
+                [len(streamline) for streamline in streamlines],
+            )
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self.count >= 10**COUNT_WIDTH:
+            raise ValueError("Too many streamlines for the header count field")
+        self._file.write(np.full(3, np.inf, dtype=self.dtype).tobytes())
+        self._file.seek(self._count_position)
+        self._file.write(("%0*d" % (COUNT_WIDTH, self.count)).encode("latin-1"))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def concatenate(in_files, out_file, chunk_size=100000):
+    """
+    Concatenate tractograms in bounded memory (header of the first input kept)
+    :param in_files: paths of the input tractograms
+    :param out_file: path of the output tractogram
+    :param chunk_size: number of streamlines read at once
+    :return: number of written streamlines
+    """
+    header = TckFile(in_files[0]).header
+    with TckWriter(out_file, header=header) as writer:
+        for in_file in in_files:
+            for points, lengths in TckFile(in_file).iter_chunks(chunk_size):
+                writer.write(points, lengths)
+    return writer.count
@@ -0,0 +1,116 @@
+"""Per-subject completion ledger of batch executions
+
+Relaunching a half-finished cohort rebuilds the execution graph of every subject
+and lets Nipype inspect (and hash the inputs of) every node of the finished ones.
+The ledger records each subject once its outputs are produced, together with a
+fingerprint of its input files and the processing parameters. On the next launch,
+subjects whose inputs, parameters and outputs are unchanged are left out of the
+batch workflow without touching their working directories.
+
+Layout: one <subject_id>.json file per finished subject, written atomically so
+that concurrent subjects never corrupt each other's entries. Input files are
+fingerprinted in sampled mode with their modification time (see
+mrproc.cache.fingerprint_file), checking a subject reads about 1 MB per input file
+whatever its size.
+"""
+
+import json
+import os
+import os.path as op
+import tempfile
+
+from mrproc.cache import fingerprint_file
+
+
+class CompletionLedger:
+    """
+    Directory of the subjects whose processing completed
+
+    input_fields are the fields of the subject records holding input files
+    (default: every field but subject_id), fingerprint is their fingerprint mode.
+    """
+
+    def __init__(self, root, input_fields=None, fingerprint="sampled"):
+        self.root = op.abspath(root)
+        self.input_fields = input_fields
+        self.fingerprint = fingerprint
+
+    def entry_file(self, subject_id):
+        return op.join(self.root, subject_id + ".json")
+
+    def fingerprints(self, subject):
+        """
+        Fingerprints of the input files of a subject
+        :param subject: subject record (see mrproc.workflows.batch.read_manifest)
+        :return: dict mapping input fields to fingerprints
+        """
+        fields = self.input_fields or sorted(set(subject) - {"subject_id"})
+        return {
+            field: fingerprint_file(subject[field], self.fingerprint, mtime=True)
+            for field in fields
+        }
+
+    def record(self, subject, parameters, outputs):
+        """
+        Record the completion of a subject
+        :param subject: subject record
+        :param parameters: processing parameters (JSON serializable dict)
+        :param outputs: dict of output files (str or list of str)
+        :return: path of the entry
+        """
+        entry = {
+            "subject_id": subject["subject_id"],
+            "inputs": self.fingerprints(subject),
+            "parameters": parameters,
+            "outputs": outputs,
+        }
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(prefix=".tmp_", dir=self.root)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f, indent=2)
+        entry_file = self.entry_file(subject["subject_id"])
+        os.replace(tmp_file, entry_file)
+        return entry_file
+
+    def is_complete(self, subject, parameters):
+        """
+        Whether a subject was processed from the same inputs with the same
+        parameters and its outputs are still present
+        :param subject: subject record
+        :param parameters: processing parameters
+        :return: bool
+        """
+        try:
+            with open(self.entry_file(subject["subject_id"])) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if entry.get("parameters") != json.loads(json.dumps(parameters)):
+            return False
+        if not all(op.isfile(path) for path in _paths(entry.get("outputs"))):
+            return False
+        try:
+            return entry.get("inputs") == self.fingerprints(subject)
+        except OSError:
+            return False
+
+    def pending(self, subjects, parameters):
+        """
+        Subjects still to process
+        :param subjects: subject records
+        :param parameters: processing parameters
+        :return: list of the subject records not complete
+        """
+        return [
+            subject for subject in subjects if not self.is_complete(subject, parameters)
+        ]
+
+
+def _paths(value):
+    if isinstance(value, dict):
+        return [path for item in value.values() for path in _paths(item)]
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in _paths(item)]
+    if isinstance(value, str):
+        return [value]
+    return []
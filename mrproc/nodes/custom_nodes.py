@@ -1,47 +1,253 @@
 """
-Dirty wrapping of the Mrtrix3 command necessary but not available in Nipype
+Small python steps of the pipelines wrapped with nipype's Function interface
 
-Quick and dirty wrappings using python function and  nipype's Function interface of
-Mrtrix3 commands
+Mrtrix3 commands not available in Nipype are wrapped as proper interfaces in
+mrproc.interfaces
 """
-# TO DO: implement clean wrappings by forking nipype
 
 import nipype.pipeline.engine as pe
 from nipype.interfaces.utility import Function
 
 
-def tcksift(input_tracks, wm_fod, act, filtered_tracks):
-    """Wrapping of the tcksift command
+def split_tracks(nb_tracks, nb_shards, seed=0):
+    """Split a number of streamlines into independently seeded shards
 
-    Default options and stopping criteria with processing mask derived from act tissue file
-    :param input_tracks: path of the tractogram to filter
-    :param wm_fod: path of the white matter fiber orientation distribution volume
-    used to filter the tractogram
-    :param filtered_tracks: path of the filtered tractogram
+    :param nb_tracks: total number of streamlines
+    :param nb_shards: number of shards
+    :param seed: random seed of the first shard, following shards use seed + i
+    :return: number of streamlines and random seed of each shard (lists)
+    """
+    nb_shards = max(1, min(int(nb_shards), int(nb_tracks)))
+    shard_tracks = [
+        nb_tracks // nb_shards + (1 if i < nb_tracks % nb_shards else 0)
+        for i in range(nb_shards)
+    ]
+    shard_seeds = [seed + i for i in range(nb_shards)]
+    return shard_tracks, shard_seeds
+
+
+def create_track_split_node(nb_shards, seed=0):
+    """
+
+    :param nb_shards: number of tractography shards
+    :param seed: random seed of the first shard
     :return:
     """
-    import subprocess
-    from distutils import spawn
+    split_tracks_node = pe.Node(
+        name="split_tracks",
+        interface=Function(
+            input_names=["nb_tracks", "nb_shards", "seed"],
+            output_names=["shard_tracks", "shard_seeds"],
+            function=split_tracks,
+        ),
+    )
+    split_tracks_node.inputs.nb_shards = nb_shards
+    split_tracks_node.inputs.seed = seed
+    return split_tracks_node
+
+
+def average_responses(wm_files, gm_files, csf_files):
+    """Average the tissue response functions of several subjects
+
+    Coefficients are averaged shell by shell (as MRtrix3 responsemean -legacy),
+    the header comments of the first file of each tissue are kept.
+    :param wm_files: white matter response files (one per subject)
+    :param gm_files: grey matter response files
+    :param csf_files: cerebrospinal fluid response files
+    :return: group wm_file, gm_file, csf_file
+    """
+    import os
+
+    import numpy as np
 
-    sift = spawn.find_executable("tcksift")
-    print(sift)
-    cmd = [sift, "-act", act, input_tracks, wm_fod, filtered_tracks]
-    subprocess.run(cmd)
-    pass
+    averaged = []
+    for tissue, files in [("wm", wm_files), ("gm", gm_files), ("csf", csf_files)]:
+        responses = [np.loadtxt(response, ndmin=2) for response in files]
+        if len({response.shape for response in responses}) > 1:
+            raise ValueError(
+                "Inconsistent %s response shapes (different shells?): %s"
+                % (tissue, ", ".join(files))
+            )
+        with open(files[0]) as f:
+            header = [
+                line.rstrip("\n")
+                for line in f
+                if line.startswith("#") and "command_history" not in line
+            ]
+        out_file = os.path.abspath("group_%s.txt" % tissue)
+        np.savetxt(
+            out_file,
+            np.mean(responses, axis=0),
+            header="\n".join(line.lstrip("# ") for line in header),
+        )
+        averaged.append(out_file)
+    return tuple(averaged)
 
 
-def create_sift_filtering_node():
+def create_response_average_node(joinsource):
     """
 
+    :param joinsource: iterables node of the subjects whose responses are averaged
     :return:
     """
-    sift_filtering = pe.Node(
-        name="sift_filtering",
+    return pe.JoinNode(
+        name="group_response",
+        interface=Function(
+            input_names=["wm_files", "gm_files", "csf_files"],
+            output_names=["wm_file", "gm_file", "csf_file"],
+            function=average_responses,
+        ),
+        joinsource=joinsource,
+        joinfield=["wm_files", "gm_files", "csf_files"],
+    )
+
+
+def create_connectome_node():
+    """
+    Connectivity matrix of a tractogram Nipype node (see mrproc.connectome), its
+    n_procs input sets the number of processes scanning the tractogram
+    :return:
+    """
+    from mrproc.connectome import write_connectome
+
+    return pe.Node(
+        name="connectome",
+        interface=Function(
+            input_names=["tractogram", "parcellation", "weights", "n_procs"],
+            output_names=["connectome"],
+            function=write_connectome,
+        ),
+    )
+
+
+def create_qc_node():
+    """
+    Quality control images and summary of a preview run Nipype node (see
+    mrproc.qc)
+    :return:
+    """
+    from mrproc.qc import write_qc_report
+
+    return pe.Node(
+        name="qc",
+        interface=Function(
+            input_names=["fa", "mask", "reference", "registered_t1", "tractogram"],
+            output_names=["summary", "images"],
+            function=write_qc_report,
+        ),
+    )
+
+
+def create_tensor_fit_node():
+    """
+    In-process tensor fit writing the FA Nipype node (see mrproc.tensor)
+    :return:
+    """
+    from mrproc.tensor import write_fa
+
+    return pe.Node(
+        name="diffusion2fa",
+        interface=Function(
+            input_names=["diffusion_volume", "mask", "iterations", "out_file"],
+            output_names=["fa"],
+            function=write_fa,
+        ),
+    )
+
+
+def create_diffusion_header_node():
+    """
+    Header-only .mih referencing the NIfTI diffusion series Nipype node (see
+    mrproc.io.mif.write_diffusion_header)
+    :return:
+    """
+    from mrproc.io.mif import write_diffusion_header
+
+    return pe.Node(
+        name="diffusion_header",
+        interface=Function(
+            input_names=["diffusion_volume", "bvals", "bvecs"],
+            output_names=["out_file"],
+            function=write_diffusion_header,
+        ),
+    )
+
+
+def create_tractogram_compression_node():
+    """
+    Simplification of the streamlines of a tractogram Nipype node (see
+    mrproc.compression), its n_procs input sets the number of processes
+    :return:
+    """
+    from mrproc.compression import write_compressed_tractogram
+
+    return pe.Node(
+        name="tractogram_compression",
+        interface=Function(
+            input_names=["in_file", "tolerance", "max_segment", "n_procs"],
+            output_names=["out_file", "statistics"],
+            function=write_compressed_tractogram,
+        ),
+    )
+
+
+def create_compression_report_node():
+    """
+    Size reduction of the tractogram compression and summary of the SIFT output
+    Nipype node (see mrproc.compression.write_compression_report)
+    :return:
+    """
+    from mrproc.compression import write_compression_report
+
+    return pe.Node(
+        name="compression_report",
+        interface=Function(
+            input_names=[
+                "statistics",
+                "tractogram",
+                "weights",
+                "reference_tractogram",
+                "reference_weights",
+            ],
+            output_names=["report"],
+            function=write_compression_report,
+        ),
+    )
+
+
+def create_mask_split_node(nb_slabs):
+    """
+    Split of the brain mask into slab masks Nipype node (see mrproc.slabs)
+    :param nb_slabs: number of slabs
+    :return:
+    """
+    from mrproc.slabs import split_mask
+
+    split_mask_node = pe.Node(
+        name="split_mask",
+        interface=Function(
+            input_names=["mask", "nb_slabs"],
+            output_names=["slab_masks", "bounds"],
+            function=split_mask,
+        ),
+    )
+    split_mask_node.inputs.nb_slabs = nb_slabs
+    return split_mask_node
+
+
+def create_fod_stitch_node():
+    """
+    Stitch the tissue ODFs estimated on slab masks into full volumes Nipype node
+    (see mrproc.slabs)
+    :return:
+    """
+    from mrproc.slabs import stitch_fods
+
+    return pe.Node(
+        name="stitch_fods",
         interface=Function(
-            input_names=["input_tracks", "wm_fod", "act", "filtered_tracks"],
-            output_names=["filtered_tracks"],
-            function=tcksift,
+            input_names=["wm_files", "gm_files", "csf_files", "bounds"],
+            output_names=["wm_odf", "gm_odf", "csf_odf"],
+            function=stitch_fods,
         ),
     )
-    sift_filtering.inputs.filtered_tracks = "filtered.tck"
-    return sift_filtering
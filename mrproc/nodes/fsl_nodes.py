@@ -1,17 +1,37 @@
 """
+Usual FSL Nipype nodes but with customized parameters
 
+Interfaces are imported by the factories, so that importing the module does not
+load nipype.interfaces.fsl.
 """
 
-from nipype.interfaces import fsl
 import nipype.pipeline.engine as pe
 
+from mrproc.cache import CachedNode
 
-def create_rigid_registration_node():
+
+def create_rigid_registration_node(dof=7, name="rigid_registration"):
     """
 
+    :param dof: degrees of freedom of the linear transformation (6: rigid, 7: rigid
+    + homogenous scaling, 12: affine)
+    :param name: name of the node
     :return:
     """
+    from nipype.interfaces import fsl
+
     # Ensure rigid + homogenous scaling deformation, default cost
-    rigid_registration = pe.Node(fsl.FLIRT(dof=7), name="rigid_registration")
+    rigid_registration = CachedNode(fsl.FLIRT(dof=dof), name=name)
     rigid_registration.inputs.output_type = "NIFTI_GZ"
     return rigid_registration
+
+
+def create_transform_inversion_node(name="invxfm"):
+    """
+    Invert a FLIRT transformation matrix Nipype node
+    :param name: name of the node
+    :return:
+    """
+    from nipype.interfaces import fsl
+
+    return pe.Node(fsl.utils.ConvertXFM(invert_xfm=True), name=name)
@@ -1,9 +1,13 @@
 """
 Usual Mrtrix3 Nipype nodes but with customized parameters
+
+Interfaces are imported by the factories, so that importing the module does not
+load nipype.interfaces.mrtrix3.
 """
 
 import nipype.pipeline.engine as pe
-from nipype.interfaces import mrtrix3
+
+from mrproc.cache import CachedNode
 
 
 def create_tissue_classification_node():
@@ -11,23 +15,84 @@ def create_tissue_classification_node():
     Instanciate T1 volume tissue classification Nipype node
     :return: tissue_classif (Nipype Node)
     """
+    from nipype.interfaces import mrtrix3
+
     # Tissue classification from T1 MRI data
-    tissue_classif = pe.Node(interface=mrtrix3.Generate5tt(), name="tissue_classif")
+    tissue_classif = CachedNode(interface=mrtrix3.Generate5tt(), name="tissue_classif")
     # rely on FSL for T1 tissue segmentation
     tissue_classif.inputs.algorithm = "fsl"
     tissue_classif.inputs.out_file = "5tt.nii.gz"
     return tissue_classif
 
 
-def create_tractography_node():
+def create_tractography_node(sharded=False):
     """
     Generate whole brain probabilistic tractogram Nipype node
+    :param sharded: if True, return a MapNode iterating over the number of
+    streamlines (select) and the random seed (rng_seed) of each shard
     :return:
     """
-    tractography = pe.Node(
-        interface=mrtrix3.tracking.Tractography(), name="tractography"
-    )
+    from mrproc.interfaces.mrtrix3 import Tractography
+
+    if sharded:
+        tractography = pe.MapNode(
+            interface=Tractography(),
+            iterfield=["select", "rng_seed"],
+            name="tractography",
+        )
+    else:
+        tractography = pe.Node(interface=Tractography(), name="tractography")
     tractography.inputs.algorithm = "iFOD2"
     tractography.inputs.crop_at_gmwmi = True
     tractography.inputs.backtrack = True
     return tractography
+
+
+def create_tractogram_merge_node():
+    """
+    Concatenate tractogram shards into a single tractogram Nipype node
+    :return:
+    """
+    from mrproc.interfaces.mrtrix3 import TCKEdit
+
+    merge_shards = pe.Node(interface=TCKEdit(), name="merge_shards")
+    merge_shards.inputs.out_file = "tracked.tck"
+    return merge_shards
+
+
+def create_sift_filtering_node(
+    mode="sift", term_number=None, term_ratio=None, term_mu=None, name="sift_filtering"
+):
+    """
+    Tractogram filtering Nipype node (processing mask derived from the act tissue
+    file)
+    :param mode: "sift" writes the filtered tractogram (tcksift), "sift2" writes one
+    weight per streamline and leaves the tractogram untouched (tcksift2)
+    :param term_number: number of streamlines kept by SIFT
+    :param term_ratio: SIFT termination ratio (reduction of the cost function
+    relative to its initial value)
+    :param term_mu: SIFT termination proportionality factor
+    :param name: name of the node
+    :return:
+    """
+    from mrproc.interfaces.mrtrix3 import TCKSift
+    from mrproc.interfaces.mrtrix3 import TCKSift2
+
+    if mode == "sift":
+        sift_filtering = pe.Node(interface=TCKSift(), name=name)
+        sift_filtering.inputs.out_file = "filtered.tck"
+        for field, value in [
+            ("term_number", term_number),
+            ("term_ratio", term_ratio),
+            ("term_mu", term_mu),
+        ]:
+            if value is not None:
+                setattr(sift_filtering.inputs, field, value)
+    elif mode == "sift2":
+        if (term_number, term_ratio, term_mu) != (None, None, None):
+            raise ValueError("SIFT termination criteria do not apply to sift2")
+        sift_filtering = pe.Node(interface=TCKSift2(), name=name)
+        sift_filtering.inputs.out_weights = "sift2_weights.txt"
+    else:
+        raise ValueError("Unknown SIFT mode %s (sift or sift2)" % mode)
+    return sift_filtering
@@ -0,0 +1,370 @@
+"""Preflight checks of a batch, run before any node is scheduled
+
+Problems that would otherwise surface hours into a run are looked for up front:
++ executables: every command line tool of the workflow (and the tools these
+scripts call, EXTRA_EXECUTABLES) must be on the PATH, the MRtrix3, FSL and
+NiftyReg versions must be at least MINIMUM_VERSIONS
++ subjects: input files must be readable and the NIfTI headers consistent (4D
+diffusion series with as many volumes as bvals and bvecs entries and a b=0
+volume, 3D T1 volume, parcellation on the T1 grid). Only the headers are read,
+never the voxel data
++ resources: the memory of the most demanding node of a subject (resource
+profile, see mrproc.resources) and the disk footprint of its working directory
+are estimated from the header dimensions and compared with the machine
+
+Missing or outdated executables are errors of the whole batch, subjects with bad
+inputs or needs beyond the machine are rejected, the others are processed.
+"""
+
+import math
+import os
+import re
+import shutil
+import subprocess
+
+import numpy as np
+from nipype.pipeline.engine import MapNode
+
+from mrproc.resources import estimate_node_resources
+from mrproc.resources import load_resource_profile
+
+# Tools called by the command line scripts of the workflow (dwibiascorrect ants,
+# 5ttgen fsl)
+EXTRA_EXECUTABLES = {
+    "dwibiascorrect": ["N4BiasFieldCorrection"],
+    "5ttgen": ["fast", "run_first_all"],
+}
+# Minimal version of a package, checked on one of its executables: executable
+# mapped to (version flag, minimal version)
+MINIMUM_VERSIONS = {
+    "mrconvert": ("-version", (3, 0)),
+    "flirt": ("-version", (6, 0)),
+    "reg_f3d": ("--version", (1, 3)),
+}
+# Largest b-value of a b=0 volume (s/mm2)
+B0_THRESHOLD = 50
+# Disk footprint of a subject, in float32 volumes: copies of the diffusion series
+# (mrconvert, unless the series is ingested without copy, bias correction), 3D
+# volumes on the diffusion grid (tensor, FA, wm FOD up to lmax 8, gm and csf FODs,
+# mask) and on the T1 grid (brain extraction, registered T1, 5TT)
+DIFFUSION_SERIES_COPIES = 2
+DIFFUSION_GRID_VOLUMES = 56
+T1_GRID_VOLUMES = 7
+# Volumes of the tissue ODFs (wm FOD up to lmax 8, gm and csf), written full-size
+# by every job of a sharded FOD estimation
+FOD_VOLUMES = 47
+# Size of a streamline of a whole brain tractogram (~200 float32 vertices)
+BYTES_PER_TRACK = 2400
+
+
+def required_executables(workflow):
+    """
+    Command line tools run by a workflow
+    :param workflow: Nipype workflow (sub-workflows included)
+    :return: sorted list of executable names
+    """
+    executables = set()
+    for node_name in workflow.list_node_names():
+        command = getattr(workflow.get_node(node_name).interface, "_cmd", None)
+        if command:
+            executable = command.split()[0]
+            executables.add(executable)
+            executables.update(EXTRA_EXECUTABLES.get(executable, []))
+    return sorted(executables)
+
+
+def parse_version(text):
+    """
+    First dotted version number of a text
+    :param text: output of a version flag
+    :return: tuple of ints, None if no version is found
+    """
+    match = re.search(r"(\d+)\.(\d+)(?:\.(\d+))?", text)
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.groups() if part is not None)
+
+
+def tool_version(executable, flag):
+    """
+    Version of an executable
+    :param executable: path or name of the executable
+    :param flag: command line flag printing the version
+    :return: tuple of ints, None if it can not be determined
+    """
+    try:
+        completed = subprocess.run(
+            [executable, flag],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=30,
+            check=False,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return parse_version(completed.stdout.decode("utf-8", "replace"))
+
+
+def check_executables(executables):
+    """
+    Look for executables on the PATH and check the package versions
+    :param executables: executable names
+    :return: errors, warnings (lists of messages)
+    """
+    errors, warnings = [], []
+    for executable in executables:
+        path = shutil.which(executable)
+        if path is None:
+            errors.append("%s not found on the PATH" % executable)
+            continue
+        if executable not in MINIMUM_VERSIONS:
+            continue
+        flag, minimum = MINIMUM_VERSIONS[executable]
+        version = tool_version(path, flag)
+        if version is None:
+            warnings.append("could not determine the version of %s" % path)
+        elif version < minimum:
+            errors.append(
+                "%s version %s, at least %s is required"
+                % (
+                    path,
+                    ".".join(map(str, version)),
+                    ".".join(map(str, minimum)),
+                )
+            )
+    return errors, warnings
+
+
+def read_shape(path):
+    """
+    Dimensions of an image, read from its header only
+    :param path: path of a NIfTI image
+    :return: shape (tuple)
+    """
+    import nibabel
+
+    return tuple(int(n) for n in nibabel.load(path).header.get_data_shape())
+
+
+def check_subject(subject, fields):
+    """
+    Check the input files of a subject (headers and gradient tables only)
+    :param subject: subject record (see mrproc.workflows.batch.read_manifest)
+    :param fields: input fields of the subject
+    :return: problems (list of messages), shapes of the images by field
+    """
+    problems = []
+    for field in fields:
+        if not os.path.isfile(subject[field]):
+            problems.append("%s %s does not exist" % (field, subject[field]))
+        elif not os.access(subject[field], os.R_OK):
+            problems.append("%s %s is not readable" % (field, subject[field]))
+    if problems:
+        return problems, {}
+
+    shapes = {}
+    for field in ["diffusion_volume", "t1_volume", "parcellation"]:
+        if field not in fields:
+            continue
+        try:
+            shapes[field] = read_shape(subject[field])
+        except Exception as error:
+            problems.append("%s: unreadable header (%s)" % (subject[field], error))
+    if problems:
+        return problems, shapes
+
+    diffusion_shape = shapes["diffusion_volume"]
+    if len(diffusion_shape) != 4:
+        problems.append(
+            "diffusion_volume %s is not 4D (shape %s)"
+            % (subject["diffusion_volume"], diffusion_shape)
+        )
+    try:
+        bvals = np.loadtxt(subject["bvals"], ndmin=1)
+        bvecs = np.loadtxt(subject["bvecs"], ndmin=2)
+    except ValueError as error:
+        problems.append("unreadable gradient table (%s)" % error)
+    else:
+        nb_volumes = diffusion_shape[3] if len(diffusion_shape) == 4 else 1
+        if len(bvals) != nb_volumes:
+            problems.append(
+                "%d bvals for %d diffusion volumes" % (len(bvals), nb_volumes)
+            )
+        if bvecs.shape not in [(3, len(bvals)), (len(bvals), 3)]:
+            problems.append(
+                "bvecs of shape %s for %d bvals" % (bvecs.shape, len(bvals))
+            )
+        if len(bvals) and bvals.min() > B0_THRESHOLD:
+            problems.append("no b=0 volume (b <= %d)" % B0_THRESHOLD)
+    if "t1_volume" not in shapes:
+        return problems, shapes
+    t1_shape = shapes["t1_volume"]
+    # Trailing singleton axes (x, y, z, 1, 1) still describe a 3D volume
+    if len(t1_shape) < 3 or t1_shape[3:] != (1,) * (len(t1_shape) - 3):
+        problems.append(
+            "t1_volume %s is not 3D (shape %s)" % (subject["t1_volume"], t1_shape)
+        )
+    if "parcellation" in shapes and shapes["parcellation"][:3] != t1_shape[:3]:
+        problems.append(
+            "parcellation of shape %s, the T1 volume is %s"
+            % (shapes["parcellation"], t1_shape)
+        )
+    return problems, shapes
+
+
+def estimate_subject_needs(
+    workflow, shapes, profile=None, nb_tracks=None, nb_shards=1, sift_mode="sift"
+):
+    """
+    Memory and disk needs of a subject
+    :param workflow: batch or single subject workflow
+    :param shapes: shapes of the diffusion and T1 volumes (see check_subject)
+    :param profile: resource profile (see mrproc.resources.load_resource_profile)
+    :param nb_tracks: number of streamlines of the tractogram
+    :param nb_shards: number of tractography shards
+    :param sift_mode: tractogram filtering mode ("sift", "sift2" or "none")
+    :return: mem_gb (memory of the most demanding node), disk_gb (working
+    directory of the subject)
+    """
+    profile = load_resource_profile(profile)
+    diffusion_voxels = math.prod(shapes["diffusion_volume"])
+    grid_voxels = math.prod(shapes["diffusion_volume"][:3])
+    t1_voxels = math.prod(shapes["t1_volume"][:3])
+    mem_gb = 0.0
+    series_copies = DIFFUSION_SERIES_COPIES - 1
+    compressed = False
+    referenced = False
+    slab_volumes = 0
+    for node_name in workflow.list_node_names():
+        node = workflow.get_node(node_name)
+        if node.name == "mrconvert":
+            series_copies = DIFFUSION_SERIES_COPIES
+        compressed = compressed or node.name == "tractogram_compression"
+        referenced = referenced or node.name == "reference_sift"
+        if node.name == "split_mask":
+            slab_volumes = FOD_VOLUMES * node.inputs.nb_slabs
+        node_tracks = nb_tracks
+        if nb_tracks and isinstance(node, MapNode):
+            node_tracks = nb_tracks / nb_shards
+        _, node_mem_gb = estimate_node_resources(
+            node.name, profile, nb_tracks=node_tracks, nb_voxels=diffusion_voxels
+        )
+        mem_gb = max(mem_gb, node_mem_gb)
+    # Shards are merged, the compression and SIFT write smaller copies (counted as
+    # full ones), the compression check filters the uncompressed tractogram too
+    tractograms = 1 + (nb_shards > 1) + compressed + (sift_mode == "sift")
+    tractograms += referenced and sift_mode == "sift"
+    disk_bytes = (
+        4 * series_copies * diffusion_voxels
+        + 4 * (DIFFUSION_GRID_VOLUMES + slab_volumes) * grid_voxels
+        + 4 * T1_GRID_VOLUMES * t1_voxels
+        + BYTES_PER_TRACK * tractograms * (nb_tracks or 0)
+    )
+    return mem_gb, round(disk_bytes / 1e9, 2)
+
+
+def machine_capacity(work_dir, memory_gb=None):
+    """
+    Memory and free disk space available to a batch
+    :param work_dir: working directory (created later if missing, the closest
+    existing parent is used)
+    :param memory_gb: memory budget of the batch (default: 90% of the system
+    memory, as the MultiProc plugin)
+    :return: mem_gb, disk_gb (None if unknown)
+    """
+    if memory_gb is None:
+        try:
+            memory_gb = (
+                0.9 * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1e9
+            )
+        except (ValueError, OSError, AttributeError):
+            memory_gb = None
+    directory = os.path.abspath(work_dir)
+    while not os.path.exists(directory):
+        directory = os.path.dirname(directory)
+    disk_gb = shutil.disk_usage(directory).free / 1e9
+    return memory_gb, disk_gb
+
+
+def run_preflight(
+    subjects,
+    workflow,
+    work_dir,
+    fields,
+    nb_tracks=None,
+    nb_shards=1,
+    sift_mode="sift",
+    resource_profile=None,
+    memory_gb=None,
+    intermediates="keep",
+):
+    """
+    Check the executables of a batch and the inputs and needs of its subjects
+    :param subjects: subject records
+    :param workflow: batch workflow (see create_batch_dwi_processing_pipeline)
+    :param work_dir: working directory of the batch
+    :param fields: input fields of the subjects
+    :param nb_tracks: number of streamlines of the tractograms
+    :param nb_shards: number of tractography shards
+    :param sift_mode: tractogram filtering mode ("sift", "sift2" or "none")
+    :param resource_profile: None, dict or JSON path (see mrproc.resources)
+    :param memory_gb: memory budget of the batch
+    :param intermediates: fate of the intermediate files (see
+    mrproc.workflows.batch.run_batch), the footprints of the subjects add up
+    when they are kept
+    :return: accepted subjects, report (dict with the errors and warnings of the
+    batch and the problems of each rejected subject, by subject_id)
+    """
+    errors, warnings = check_executables(required_executables(workflow))
+    profile = load_resource_profile(resource_profile)
+    # .mih headers can only reference the voxels of uncompressed NIfTI files
+    header_ingest = any(
+        workflow.get_node(node_name).name == "diffusion_header"
+        for node_name in workflow.list_node_names()
+    )
+    capacity_mem_gb, capacity_disk_gb = machine_capacity(work_dir, memory_gb)
+
+    accepted, rejected = [], {}
+    total_disk_gb = 0.0
+    for subject in subjects:
+        problems, shapes = check_subject(subject, fields)
+        if header_ingest and not subject["diffusion_volume"].endswith(".nii"):
+            problems.append(
+                "diffusion_volume: %s is compressed, header ingest needs a .nii file"
+                % subject["diffusion_volume"]
+            )
+        if not problems:
+            mem_gb, disk_gb = estimate_subject_needs(
+                workflow,
+                shapes,
+                profile=profile,
+                nb_tracks=nb_tracks,
+                nb_shards=nb_shards,
+                sift_mode=sift_mode,
+            )
+            if capacity_mem_gb is not None and mem_gb > capacity_mem_gb:
+                problems.append(
+                    "needs %.1f GB of memory, %.1f GB available"
+                    % (mem_gb, capacity_mem_gb)
+                )
+            if disk_gb > capacity_disk_gb:
+                problems.append(
+                    "needs %.1f GB of disk, %.1f GB free in %s"
+                    % (disk_gb, capacity_disk_gb, work_dir)
+                )
+        if problems:
+            rejected[subject["subject_id"]] = problems
+        else:
+            accepted.append(subject)
+            total_disk_gb = (
+                total_disk_gb + disk_gb
+                if intermediates == "keep"
+                else max(total_disk_gb, disk_gb)
+            )
+    if total_disk_gb > capacity_disk_gb:
+        warnings.append(
+            "the subjects need about %.1f GB of disk, %.1f GB free in %s (see "
+            "intermediates and scratch_quota_gb)"
+            % (total_disk_gb, capacity_disk_gb, work_dir)
+        )
+    return accepted, {"errors": errors, "warnings": warnings, "rejected": rejected}
@@ -0,0 +1,252 @@
+"""Lightweight quality control artifacts of preview runs
+
+A preview run (see mrproc.workflows.dwi_processing.create_preview_pipeline)
+writes, next to its tractogram, a few images and a summary that can be checked
+in seconds before the full run is launched:
++ fa_mask.png: orthogonal mid slices of the FA with the outline of the brain mask
++ registration.png: the same slices of the registration reference (FA) with the
+edges of the registered T1 volume
++ qc.json: streamline count and lengths, mask volume, FA within the mask and the
+correlation between the reference and the registered T1 volume
+
+Images are written as 8-bit PNG without any plotting library, tractograms are
+streamed by chunks (see mrproc.io.tck).
+"""
+
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from mrproc.io.tck import TckFile
+
+# Red, drawn over the grayscale slices
+OVERLAY_COLOR = (255, 0, 0)
+# Percentile of the gradient magnitude above which a T1 voxel is an edge
+EDGE_PERCENTILE = 90
+
+
+def write_png(path, image):
+    """
+    Write an 8-bit image as PNG
+    :param path: path of the .png file
+    :param image: (H, W) grayscale or (H, W, 3) RGB uint8 array
+    :return:
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    color_type = 0 if image.ndim == 2 else 2
+    # Every scanline starts with its filter type (0: none)
+    raw = b"".join(b"\x00" + row.tobytes() for row in image)
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(
+            chunk(
+                b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+            )
+        )
+        f.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def mid_slices(volume):
+    """
+    Sagittal, coronal and axial slices through the center of a volume
+    :param volume: 3D array (RAS-like voxel order)
+    :return: list of three 2D arrays, superior (or anterior) side up
+    """
+    i, j, k = (n // 2 for n in volume.shape[:3])
+    return [
+        np.rot90(volume[i, :, :]),
+        np.rot90(volume[:, j, :]),
+        np.rot90(volume[:, :, k]),
+    ]
+
+
+def montage(slices):
+    """
+    Place 2D slices side by side (zero padded to the tallest one)
+    :param slices: list of 2D arrays
+    :return: 2D array
+    """
+    height = max(piece.shape[0] for piece in slices)
+    return np.hstack(
+        [np.pad(piece, ((0, height - piece.shape[0]), (0, 0))) for piece in slices]
+    )
+
+
+def to_uint8(image, percentile=99.5):
+    """
+    Scale an image to 0-255 (values above the percentile of the non-zero
+    values are saturated)
+    :param image: array
+    :param percentile: saturation percentile
+    :return: uint8 array
+    """
+    image = np.nan_to_num(np.asarray(image, dtype=float))
+    nonzero = image[image > 0]
+    top = np.percentile(nonzero, percentile) if len(nonzero) else 1.0
+    return (np.clip(image / (top or 1.0), 0, 1) * 255).astype(np.uint8)
+
+
+def outline(mask):
+    """
+    Border of a 2D mask (mask voxels with a 4-neighbour outside of it)
+    :param mask: 2D boolean array
+    :return: 2D boolean array
+    """
+    padded = np.pad(mask, 1)
+    interior = (
+        padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    )
+    return mask & ~interior
+
+
+def edges(image, percentile=EDGE_PERCENTILE):
+    """
+    Strong edges of a 2D image
+    :param image: 2D array
+    :param percentile: percentile of the non-zero gradient magnitudes above which
+    a pixel is an edge
+    :return: 2D boolean array
+    """
+    magnitude = np.hypot(*np.gradient(np.asarray(image, dtype=float)))
+    nonzero = magnitude[magnitude > 0]
+    if not len(nonzero):
+        return np.zeros(magnitude.shape, dtype=bool)
+    return magnitude > np.percentile(nonzero, percentile)
+
+
+def overlay(gray, contour, color=OVERLAY_COLOR):
+    """
+    Draw a contour over a grayscale image
+    :param gray: 2D uint8 array
+    :param contour: 2D boolean array
+    :param color: RGB color of the contour
+    :return: (H, W, 3) uint8 array
+    """
+    rgb = np.repeat(gray[..., None], 3, axis=2)
+    rgb[contour] = color
+    return rgb
+
+
+def streamline_lengths(tractogram, chunk_size=100000):
+    """
+    Length of every streamline of a tractogram
+    :param tractogram: path of the .tck file
+    :param chunk_size: number of streamlines read at once
+    :return: 1D array of lengths (mm), 0 for single vertex streamlines
+    """
+    lengths_mm = []
+    for points, lengths in TckFile(tractogram).iter_chunks(chunk_size=chunk_size):
+        lengths = lengths[lengths > 0]
+        steps = np.linalg.norm(np.diff(points.astype(float), axis=0), axis=1)
+        cumulated = np.concatenate(([0.0], np.cumsum(steps)))
+        ends = np.cumsum(lengths) - 1
+        lengths_mm.append(cumulated[ends] - cumulated[ends - lengths + 1])
+    return np.concatenate(lengths_mm) if lengths_mm else np.empty(0)
+
+
+def summary_statistics(values):
+    """
+    Mean, median, minimum and maximum of values
+    :param values: 1D array
+    :return: dict, None without values
+    """
+    if not len(values):
+        return None
+    return {
+        "mean": float(np.mean(values)),
+        "median": float(np.median(values)),
+        "min": float(np.min(values)),
+        "max": float(np.max(values)),
+    }
+
+
+def _load(path):
+    import nibabel
+
+    image = nibabel.load(path)
+    data = np.asarray(image.dataobj, dtype=float)
+    return data.reshape(data.shape[:3]), image
+
+
+def write_qc_report(fa, mask, reference, registered_t1, tractogram):
+    """
+    Write the quality control images and summary of a preview run (Nipype
+    Function step)
+    :param fa: FA volume (NIfTI, diffusion space)
+    :param mask: brain mask (NIfTI, same grid as fa)
+    :param reference: volume the T1 volume was registered to
+    :param registered_t1: T1 volume resampled onto reference
+    :param tractogram: path of the .tck file
+    :return: summary (path of qc.json), images (paths of the PNG files)
+    """
+    import os
+
+    from mrproc.qc import write_report
+
+    return write_report(
+        fa, mask, reference, registered_t1, tractogram, os.path.abspath(".")
+    )
+
+
+def write_report(fa, mask, reference, registered_t1, tractogram, out_dir):
+    """
+    Write the quality control images and summary of a preview run
+    :param fa, mask, reference, registered_t1, tractogram: see write_qc_report
+    :param out_dir: directory of the outputs
+    :return: summary (path of qc.json), images (paths of the PNG files)
+    """
+    fa_data, _ = _load(fa)
+    mask_data, mask_image = _load(mask)
+    mask_data = mask_data > 0
+    reference_data, _ = _load(reference)
+    t1_data, _ = _load(registered_t1)
+
+    images = [
+        os.path.join(out_dir, "fa_mask.png"),
+        os.path.join(out_dir, "registration.png"),
+    ]
+    write_png(
+        images[0],
+        overlay(
+            to_uint8(montage(mid_slices(fa_data))),
+            montage([outline(piece) for piece in mid_slices(mask_data)]),
+        ),
+    )
+    write_png(
+        images[1],
+        overlay(
+            to_uint8(montage(mid_slices(reference_data))),
+            montage([edges(piece) for piece in mid_slices(t1_data)]),
+        ),
+    )
+
+    lengths = streamline_lengths(tractogram)
+    overlap = (reference_data > 0) & (t1_data > 0)
+    correlation = None
+    if reference_data[overlap].std() > 0 and t1_data[overlap].std() > 0:
+        correlation = float(
+            np.corrcoef(reference_data[overlap], t1_data[overlap])[0, 1]
+        )
+    voxel_volume = float(np.prod(mask_image.header.get_zooms()[:3]))
+    summary = {
+        "tractogram": tractogram,
+        "streamlines": int(len(lengths)),
+        "streamline_length_mm": summary_statistics(lengths),
+        "mask_volume_ml": float(mask_data.sum()) * voxel_volume / 1000.0,
+        "fa_in_mask": summary_statistics(fa_data[mask_data]),
+        "reference_t1_correlation": correlation,
+    }
+    summary_file = os.path.join(out_dir, "qc.json")
+    with open(summary_file, "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary_file, images
@@ -0,0 +1,191 @@
+"""Resource profiles of the processing nodes
+
+A resource profile maps node names to the number of threads (n_procs) and the
+memory estimate (mem_gb) of the corresponding tool. Memory estimates can grow
+with the number of requested streamlines (mem_gb_per_million_tracks) and with the
+size of the diffusion series (mem_gb_per_million_voxels, voxels counted over all
+the volumes of the 4D series). Profiles are stamped onto the nodes of a workflow
+so that the MultiProc scheduler neither oversubscribes nor serializes the
+machine, and the thread count is passed down to the tools themselves (MRtrix3
+-nthreads, NiftyReg -omp, OpenMP/ITK environment variables, n_procs input of the
+Python steps).
+
+Users can override any entry with a JSON file such as:
+{"tractography": {"n_procs": 16}, "sift_filtering": {"mem_gb": 32}}
+"""
+
+import copy
+import json
+import math
+
+from nipype.pipeline.engine import MapNode
+
+# Entries are matched against the node names used in mrproc workflows, the
+# "default" entry applies to every other node
+DEFAULT_PROFILE = {
+    "default": {"n_procs": 1, "mem_gb": 0.2},
+    "mrconvert": {"n_procs": 1, "mem_gb": 0.5, "mem_gb_per_million_voxels": 0.008},
+    "diffusionbiascorrect": {
+        "n_procs": 4,
+        "mem_gb": 1.0,
+        "mem_gb_per_million_voxels": 0.012,
+    },
+    "diffusion2mask": {"n_procs": 1, "mem_gb": 0.5, "mem_gb_per_million_voxels": 0.008},
+    "diffusion2tensor": {
+        "n_procs": 4,
+        "mem_gb": 0.5,
+        "mem_gb_per_million_voxels": 0.012,
+    },
+    "tensor2fa": {"n_procs": 1, "mem_gb": 0.5},
+    "diffusion2fa": {"n_procs": 1, "mem_gb": 1.0},
+    "bet": {"n_procs": 1, "mem_gb": 1.0},
+    "resample_fa": {"n_procs": 1, "mem_gb": 0.5},
+    "reg_f3d": {"n_procs": 4, "mem_gb": 2.0},
+    "linear_registration": {"n_procs": 1, "mem_gb": 1.0},
+    "tissue_classif": {"n_procs": 1, "mem_gb": 2.0},
+    "diffusion2response": {
+        "n_procs": 4,
+        "mem_gb": 1.0,
+        "mem_gb_per_million_voxels": 0.012,
+    },
+    "diffusion2fod": {"n_procs": 8, "mem_gb": 2.0, "mem_gb_per_million_voxels": 0.02},
+    "stitch_fods": {"n_procs": 1, "mem_gb": 0.5, "mem_gb_per_million_voxels": 0.012},
+    "tractography": {"n_procs": 8, "mem_gb": 2.0, "mem_gb_per_million_tracks": 0.05},
+    "merge_shards": {"n_procs": 1, "mem_gb": 0.5},
+    "tractogram_compression": {"n_procs": 4, "mem_gb": 1.0},
+    "sift_filtering": {"n_procs": 8, "mem_gb": 4.0, "mem_gb_per_million_tracks": 2.5},
+    "reference_sift": {"n_procs": 8, "mem_gb": 4.0, "mem_gb_per_million_tracks": 2.5},
+    "connectome": {"n_procs": 4, "mem_gb": 1.0, "mem_gb_per_million_tracks": 0.02},
+    "qc": {"n_procs": 1, "mem_gb": 1.0},
+    "compress_outputs": {"n_procs": 4, "mem_gb": 0.5},
+}
+
+# Environment variables read by the multithreaded libraries used by the tools
+THREAD_ENVIRON = ["OMP_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"]
+
+
+def load_resource_profile(profile=None):
+    """
+    Merge a user resource profile with the default one
+    :param profile: None, a dict or the path of a JSON file mapping node names
+    to partial resource entries
+    :return: resource profile (dict)
+    """
+    merged = copy.deepcopy(DEFAULT_PROFILE)
+    if profile is None:
+        return merged
+    if not isinstance(profile, dict):
+        with open(profile) as f:
+            profile = json.load(f)
+    for node_name, entry in profile.items():
+        unknown = set(entry) - {
+            "n_procs",
+            "mem_gb",
+            "mem_gb_per_million_tracks",
+            "mem_gb_per_million_voxels",
+        }
+        if unknown:
+            raise ValueError(
+                "Unknown resource field(s) %s for node %s"
+                % (", ".join(sorted(unknown)), node_name)
+            )
+        merged.setdefault(node_name, {}).update(entry)
+    return merged
+
+
+def estimate_node_resources(node_name, profile, nb_tracks=None, nb_voxels=None):
+    """
+    Thread count and memory estimate of a node
+    :param node_name: name of the node
+    :param profile: resource profile (see load_resource_profile)
+    :param nb_tracks: number of streamlines requested from the tractography
+    :param nb_voxels: number of voxels of the 4D diffusion series
+    :return: n_procs (int), mem_gb (float)
+    """
+    entry = dict(profile["default"])
+    entry.update(profile.get(node_name, {}))
+    mem_gb = float(entry["mem_gb"])
+    if nb_tracks:
+        mem_gb += entry.get("mem_gb_per_million_tracks", 0.0) * nb_tracks / 1e6
+    if nb_voxels:
+        mem_gb += entry.get("mem_gb_per_million_voxels", 0.0) * nb_voxels / 1e6
+    return int(entry["n_procs"]), round(mem_gb, 2)
+
+
+def count_voxels(volume):
+    """
+    Number of voxels of an image, read from its header only
+    :param volume: path of a NIfTI image
+    :return: number of voxels (int) or None if the header can not be read
+    """
+    try:
+        import nibabel
+
+        shape = nibabel.load(volume).header.get_data_shape()
+    except Exception:
+        return None
+    return int(math.prod(shape))
+
+
+def set_node_threads(node, n_procs):
+    """
+    Declare the thread count of a node and pass it down to the wrapped tool
+    :param node: Nipype node
+    :param n_procs: number of threads
+    :return:
+    """
+    node.n_procs = n_procs
+    inputs = node.interface.inputs
+    trait_names = inputs.copyable_trait_names()
+    # MRtrix3 commands
+    if "nthreads" in trait_names:
+        inputs.nthreads = n_procs
+    # NiftyReg commands (OpenMP)
+    if "omp_core_val" in trait_names:
+        inputs.omp_core_val = n_procs
+    # Python steps running worker processes (Function nodes)
+    if "n_procs" in trait_names:
+        inputs.n_procs = n_procs
+    # FSL, ANTs and MRtrix3 scripts calling multithreaded libraries
+    if "environ" in trait_names:
+        environ = dict(inputs.environ)
+        environ.update({variable: str(n_procs) for variable in THREAD_ENVIRON})
+        inputs.environ = environ
+
+
+def apply_resource_profile(
+    workflow,
+    profile=None,
+    nb_tracks=None,
+    nb_voxels=None,
+    max_procs=None,
+    nb_shards=1,
+):
+    """
+    Stamp every node of a workflow with its thread count and memory estimate
+
+    Note that the NiftyReg thread count (-omp) is part of the node hash, changing it
+    reruns the registration.
+    :param workflow: Nipype workflow (sub-workflows are processed recursively)
+    :param profile: None, dict or JSON path (see load_resource_profile)
+    :param nb_tracks: number of streamlines requested from the tractography
+    :param nb_voxels: number of voxels of the 4D diffusion series
+    :param max_procs: upper bound of the per node thread count
+    :param nb_shards: number of tractography shards, each job of a MapNode only
+    generates its share of the streamlines
+    :return: workflow
+    """
+    profile = load_resource_profile(profile)
+    for node_name in workflow.list_node_names():
+        node = workflow.get_node(node_name)
+        node_tracks = nb_tracks
+        if nb_tracks and isinstance(node, MapNode):
+            node_tracks = nb_tracks / nb_shards
+        n_procs, mem_gb = estimate_node_resources(
+            node.name, profile, nb_tracks=node_tracks, nb_voxels=nb_voxels
+        )
+        if max_procs is not None:
+            n_procs = max(1, min(n_procs, max_procs))
+        set_node_threads(node, n_procs)
+        node._mem_gb = mem_gb
+    return workflow
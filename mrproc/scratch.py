@@ -0,0 +1,333 @@
+"""Scratch space management during workflow executions
+
+Intermediate files (uncompressed .mif conversions, bias corrected series,
+upsampled FA, unfiltered tractograms...) are not needed once every node consuming
+them has run. ScratchManagedMultiProcPlugin follows the consumers of each node in
+the execution graph and, once all of them are done, deletes (or gzips) the output
+files of the node, except the ones declared as workflow outputs (see
+declared_outputs). Nipype metadata (result files, reports) are kept.
+
+Files are deleted or compressed by a background thread, the scheduler loop never
+waits for them; the space released is accounted for as each collection completes.
+
+A scratch quota can also be enforced: while the working directory of the run
+exceeds it, no node of a subject that has not started yet is submitted, so that
+running subjects complete and release their intermediates first. Subjects are
+identified by the subject_id iterable of the batch workflow. The working
+directory is measured at most every scratch_check_interval seconds. Kept
+intermediates are never released, a quota therefore requires the "delete" or
+"compress" policy.
+
+The Nipype hash files of a collected node are deleted along with its outputs, so
+that a later run in the same working directory reruns the node instead of
+handing its missing files to its consumers. Results published to a ResultStore
+are kept.
+
+ScratchManager overrides private methods of the Nipype distributed plugins and
+edits their scheduling state, it checks when created that the installed Nipype
+is in NIPYPE_VERSIONS and still has them.
+"""
+
+import gzip
+import os
+import os.path as op
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import nipype
+import numpy as np
+from nipype import logging
+from nipype.interfaces.base import isdefined
+from nipype.pipeline.plugins import MultiProcPlugin
+
+from mrproc.instrumentation import InstrumentedMultiProcPlugin
+from mrproc.instrumentation import directory_size
+from mrproc.instrumentation import node_subject_id
+
+logger = logging.getLogger("nipype.workflow")
+
+INTERMEDIATE_POLICIES = ["keep", "delete", "compress"]
+# Nipype versions (major, minor) supported by ScratchManager, upper bound excluded
+NIPYPE_VERSIONS = ((1, 8), (2, 0))
+# Methods of DistributedPluginBase overridden by ScratchManager
+PLUGIN_METHODS = ["_remove_node_dirs", "_send_procs_to_workers"]
+# Scheduling state of DistributedPluginBase read or changed by ScratchManager
+PLUGIN_STATE = [
+    "procs",
+    "depidx",
+    "refidx",
+    "mapnodesubids",
+    "proc_done",
+    "proc_pending",
+    "pending_tasks",
+]
+
+
+def check_plugin_internals(plugin):
+    """
+    Check that the installed Nipype is supported by ScratchManager and that its
+    distributed plugins have the internals it relies on
+    :param plugin: instance of a Nipype distributed plugin
+    :raise RuntimeError: on an unsupported Nipype version or missing internals
+    """
+    version = tuple(int(part) for part in nipype.__version__.split(".")[:2])
+    lowest, highest = NIPYPE_VERSIONS
+    if not lowest <= version < highest:
+        raise RuntimeError(
+            "Unsupported Nipype version %s (expected >=%s,<%s)"
+            % (
+                nipype.__version__,
+                ".".join(map(str, lowest)),
+                ".".join(map(str, highest)),
+            )
+        )
+    missing = [
+        name for name in PLUGIN_METHODS if not callable(getattr(plugin, name, None))
+    ] + [name for name in PLUGIN_STATE if not hasattr(plugin, name)]
+    if missing:
+        raise RuntimeError(
+            "Nipype %s plugins lack %s, needed to collect intermediate files"
+            % (nipype.__version__, ", ".join(missing))
+        )
+
+
+def declared_outputs(workflow, fields=None, hierarchy=None):
+    """
+    Nodes and outputs feeding the outputnode of a workflow
+    :param workflow: Nipype workflow with an "outputnode" node
+    :param fields: outputnode fields to follow (default: all connected fields)
+    :param hierarchy: dotted names of the workflows containing workflow, as they
+    appear in the full names of the executed nodes (e.g. the batch workflow name)
+    :return: set of (node full name, output name)
+    """
+    prefix = (hierarchy + "." if hierarchy else "") + workflow.name
+    outputnode = workflow.get_node("outputnode")
+    outputs = set()
+    if outputnode is None:
+        return outputs
+    for source, _, data in workflow._graph.in_edges(outputnode, data=True):
+        for source_field, field in data["connect"]:
+            if fields is not None and field not in fields:
+                continue
+            if not isinstance(source_field, str):
+                # (output, function) connections
+                source_field = source_field[0]
+            if hasattr(source, "_graph"):
+                # Sub-workflow output: "outputnode.<field>"
+                _, _, sub_field = source_field.partition(".")
+                outputs |= declared_outputs(source, [sub_field], hierarchy=prefix)
+            else:
+                outputs.add((prefix + "." + source.name, source_field))
+    return outputs
+
+
+def collect_node_outputs(node, keep=(), policy="delete"):
+    """
+    Delete or compress the output files of an executed node, and its hash files so
+    that Nipype does not take it for cached anymore
+    :param node: Nipype node, executed
+    :param keep: output names whose files are left untouched
+    :param policy: "delete" or "compress" (gzip)
+    :return: number of bytes freed
+    """
+    outdir = op.realpath(node.output_dir())
+    try:
+        outputs = node.result.outputs
+    except Exception:
+        return 0
+    if outputs is None:
+        return 0
+    kept = set()
+    collected = False
+    for name in keep:
+        kept.update(_files(outputs.trait_get().get(name)))
+    freed = 0
+    for name, value in outputs.trait_get().items():
+        for path in _files(value):
+            real_path = op.realpath(path)
+            # Only files written by the node, never its inputs
+            if path in kept or not real_path.startswith(outdir + os.sep):
+                continue
+            if not op.isfile(real_path) or real_path.endswith(".gz"):
+                continue
+            size = op.getsize(real_path)
+            if policy == "compress":
+                with open(real_path, "rb") as f_in:
+                    with gzip.open(real_path + ".gz", "wb", compresslevel=1) as f_out:
+                        shutil.copyfileobj(f_in, f_out)
+                size -= op.getsize(real_path + ".gz")
+            os.remove(real_path)
+            freed += size
+            collected = True
+    if collected:
+        # Not cached anymore (MapNode iterations included)
+        for root, _, files in os.walk(outdir):
+            for filename in files:
+                if filename.startswith("_0x") and filename.endswith(".json"):
+                    os.remove(op.join(root, filename))
+    return freed
+
+
+class ScratchManager:
+    """
+    Mixin of the MultiProc plugins collecting intermediate files
+
+    Accepts the plugin_args of the base plugin plus:
+    + intermediates: "keep" (default), "delete" or "compress"
+    + keep_outputs: (node full name, output name) pairs never collected, usually
+    computed with declared_outputs
+    + scratch_quota_gb: size of the working directory above which no new subject
+    is started (default: no quota, not allowed with "keep")
+    + scratch_check_interval: minimal delay (s) between two measures of the
+    working directory (default: 10)
+    + collect_threads: threads deleting or compressing files (default: 1)
+    """
+
+    def __init__(self, plugin_args=None):
+        plugin_args = dict(plugin_args or {})
+        self.intermediates = plugin_args.pop("intermediates", "keep")
+        if self.intermediates not in INTERMEDIATE_POLICIES:
+            raise ValueError(
+                "Unknown intermediates policy %s (%s)"
+                % (self.intermediates, ", ".join(INTERMEDIATE_POLICIES))
+            )
+        self.keep_outputs = {}
+        for fullname, output in plugin_args.pop("keep_outputs", []):
+            self.keep_outputs.setdefault(fullname, set()).add(output)
+        self.scratch_quota_gb = plugin_args.pop("scratch_quota_gb", None)
+        if self.scratch_quota_gb is not None and self.intermediates == "keep":
+            raise ValueError(
+                "A scratch quota requires the delete or compress intermediates "
+                "policy, kept intermediates are never released"
+            )
+        self.scratch_check_interval = plugin_args.pop("scratch_check_interval", 10)
+        self.collect_threads = plugin_args.pop("collect_threads", 1)
+        super().__init__(plugin_args=plugin_args)
+        check_plugin_internals(self)
+        self._subjects = {}
+        self._work_dirs = []
+        self._usage = None
+        self._collector = None
+        self._collecting = []
+        self.freed_bytes = 0
+
+    def run(self, graph, config, updatehash=False):
+        # Run directories: <base_dir>/<name of the executed workflow>
+        self._work_dirs = sorted(
+            {
+                op.join(node.base_dir, node._hierarchy.split(".")[0])
+                for node in graph.nodes()
+                if node.base_dir
+            }
+        )
+        self._usage = None
+        self._collector = ThreadPoolExecutor(
+            max_workers=self.collect_threads, thread_name_prefix="scratch"
+        )
+        try:
+            return super().run(graph, config, updatehash=updatehash)
+        finally:
+            self._collector.shutdown(wait=True)
+            self._account_collected()
+
+    def scratch_usage(self):
+        """
+        Size of the working directory of the run, measured at most every
+        scratch_check_interval seconds and reduced by the collections completed
+        since the last measure
+        :return: bytes
+        """
+        now = time.time()
+        if self._usage is None or now - self._usage[1] >= self.scratch_check_interval:
+            self._usage = (sum(directory_size(d) for d in self._work_dirs), now)
+        return self._usage[0]
+
+    def _remove_node_dirs(self):
+        super()._remove_node_dirs()
+        if self.intermediates == "keep":
+            return
+        # Finished nodes whose consumers are all done (row of refidx cleared),
+        # collected nodes are marked with -1 on the diagonal as Nipype does
+        indices = np.nonzero((self.refidx.sum(axis=1) == 0).__array__())[0]
+        for idx in indices:
+            if idx in self.mapnodesubids:
+                continue
+            if not self.proc_done[idx] or self.proc_pending[idx]:
+                continue
+            self.refidx[idx, idx] = -1
+            node = self.procs[idx]
+            self._collecting.append(
+                self._collector.submit(
+                    collect_node_outputs,
+                    node,
+                    keep=self.keep_outputs.get(node.fullname, ()),
+                    policy=self.intermediates,
+                )
+            )
+
+    def _account_collected(self):
+        # Harvest the completed collections and release their space
+        collecting = []
+        freed = 0
+        for future in self._collecting:
+            if not future.done():
+                collecting.append(future)
+                continue
+            try:
+                freed += future.result()
+            except OSError as error:
+                logger.warning("Intermediate files not collected: %s", error)
+        self._collecting = collecting
+        self.freed_bytes += freed
+        if freed and self._usage is not None:
+            self._usage = (max(0, self._usage[0] - freed), self._usage[1])
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        self._account_collected()
+        over_quota = (
+            self.scratch_quota_gb is not None
+            and self.scratch_usage() > self.scratch_quota_gb * 1024**3
+        )
+        if not over_quota:
+            return super()._send_procs_to_workers(updatehash=updatehash, graph=graph)
+        started = {self._subject(jobid) for jobid in np.flatnonzero(self.proc_done)}
+        throttled = [
+            jobid
+            for jobid in np.flatnonzero(~self.proc_done)
+            if self._subject(jobid) is not None and self._subject(jobid) not in started
+        ]
+        ready = ~self.proc_done & (np.asarray(self.depidx.sum(axis=0)).ravel() == 0)
+        ready[throttled] = False
+        # Without running nor ready node left, throttling would deadlock the run
+        if not self.pending_tasks and not ready.any():
+            throttled = []
+        # Hide the nodes of the subjects not started yet from the base plugin
+        self.proc_done[throttled] = True
+        try:
+            return super()._send_procs_to_workers(updatehash=updatehash, graph=graph)
+        finally:
+            self.proc_done[throttled] = False
+
+    def _subject(self, jobid):
+        if jobid not in self._subjects:
+            self._subjects[jobid] = node_subject_id(self.procs[jobid])
+        return self._subjects[jobid]
+
+
+class ScratchManagedMultiProcPlugin(ScratchManager, MultiProcPlugin):
+    """MultiProc plugin collecting intermediate files (see ScratchManager)"""
+
+
+class InstrumentedScratchManagedMultiProcPlugin(
+    ScratchManager, InstrumentedMultiProcPlugin
+):
+    """Instrumented MultiProc plugin collecting intermediate files"""
+
+
+def _files(value):
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in _files(item)]
+    if isinstance(value, str) and isdefined(value) and op.isabs(value):
+        return [value]
+    return []
@@ -0,0 +1,147 @@
+"""Spatial sharding of voxelwise MRtrix3 commands across slabs of the brain mask
+
+Multi-shell multi-tissue CSD (dwi2fod msmt_csd) solves every voxel of its mask
+independently: the brain mask is split into slabs of consecutive slices
+(SLAB_AXIS) holding about the same number of mask voxels, the command is run on
+each slab mask as a separate job and the outputs, zero outside their slab, are
+stitched back into full volumes. The stitched volumes are identical, voxel for
+voxel, to the output of a single job run on the whole mask.
+
+Every job reads the whole diffusion series and writes full-size volumes, only
+the voxels of its slab are computed.
+"""
+
+import os
+
+import numpy as np
+
+from mrproc.io.mif import MifFile
+from mrproc.io.mif import write_mif
+
+# Slice axis, the slowest varying spatial axis of the usual layouts
+SLAB_AXIS = 2
+
+
+def slab_bounds(mask, nb_slabs, axis=SLAB_AXIS):
+    """
+    Split a mask into slabs of consecutive slices holding about the same number of
+    mask voxels
+    :param mask: boolean array
+    :param nb_slabs: number of slabs, fewer slabs are returned when the mask spans
+    fewer slices
+    :param axis: axis along which the mask is split
+    :return: list of (start, stop) slice ranges covering the axis, every slab holds
+    mask voxels (a single slab covers an empty mask)
+    """
+    counts = np.asarray(mask, dtype=bool).sum(
+        axis=tuple(i for i in range(np.ndim(mask)) if i != axis)
+    )
+    cumulated = np.cumsum(counts)
+    total = int(cumulated[-1])
+    nb_slices = len(counts)
+    if not total:
+        return [(0, nb_slices)]
+    targets = total * np.arange(1, max(1, int(nb_slabs))) / nb_slabs
+    # A slab ends after the slice reaching its share of the mask voxels
+    stops = np.unique(np.searchsorted(cumulated, targets, side="left") + 1)
+    stops = stops[cumulated[stops - 1] < total]
+    bounds = np.concatenate(([0], stops, [nb_slices]))
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def write_slab_masks(mask, nb_slabs, out_dir):
+    """
+    Write the masks of the slabs of a brain mask (see slab_bounds)
+    :param mask: path of the .mif brain mask
+    :param nb_slabs: number of slabs
+    :param out_dir: directory of the slab masks
+    :return: paths of the slab masks (.mif), slice ranges of the slabs
+    """
+    image = MifFile(mask)
+    brain = np.asarray(image.data).astype(bool)
+    bounds = slab_bounds(brain, nb_slabs)
+    slab_masks = []
+    for i, (start, stop) in enumerate(bounds):
+        slab = np.zeros_like(brain)
+        index = [slice(None)] * brain.ndim
+        index[SLAB_AXIS] = slice(start, stop)
+        slab[tuple(index)] = brain[tuple(index)]
+        slab_masks.append(
+            write_mif(
+                os.path.join(out_dir, "mask_slab%d.mif" % i),
+                slab,
+                image.affine,
+                datatype="UInt8",
+            )
+        )
+    return slab_masks, bounds
+
+
+def stitch_slabs(slab_files, bounds, out_file):
+    """
+    Stitch the outputs of the jobs run on slab masks into a full volume
+    :param slab_files: paths of the .mif outputs of the jobs, in slab order
+    :param bounds: slice ranges of the slabs (see slab_bounds)
+    :param out_file: path of the stitched .mif volume
+    :return: out_file
+    """
+    if len(slab_files) != len(bounds):
+        raise ValueError(
+            "%d slab outputs for %d slabs" % (len(slab_files), len(bounds))
+        )
+    first = MifFile(slab_files[0])
+    data = np.zeros(first.shape, dtype=first.data.dtype)
+    for path, (start, stop) in zip(slab_files, bounds):
+        image = MifFile(path)
+        if image.shape != first.shape:
+            raise ValueError(
+                "%s: dimensions %s, %s has %s"
+                % (path, image.shape, slab_files[0], first.shape)
+            )
+        index = [slice(None)] * len(first.shape)
+        index[SLAB_AXIS] = slice(start, stop)
+        data[tuple(index)] = image.data[tuple(index)]
+    # Scaled values are read as floats
+    header = dict(first.header)
+    datatype = first.datatype
+    if header.pop("scaling", None) is not None:
+        datatype = "Float32LE"
+    return write_mif(out_file, data, first.affine, header=header, datatype=datatype)
+
+
+def split_mask(mask, nb_slabs):
+    """
+    Split a brain mask into slab masks (Nipype Function step)
+    :param mask: path of the .mif brain mask
+    :param nb_slabs: number of slabs
+    :return: slab_masks (paths), bounds (slice ranges of the slabs)
+    """
+    import os
+
+    from mrproc.slabs import write_slab_masks
+
+    return write_slab_masks(mask, nb_slabs, os.path.abspath("."))
+
+
+def stitch_fods(wm_files, gm_files, csf_files, bounds):
+    """
+    Stitch the tissue ODFs estimated on slab masks into full volumes (Nipype
+    Function step)
+    :param wm_files: white matter ODFs of the slabs
+    :param gm_files: grey matter ODFs of the slabs
+    :param csf_files: cerebrospinal fluid ODFs of the slabs
+    :param bounds: slice ranges of the slabs (see split_mask)
+    :return: wm_odf, gm_odf, csf_odf (paths of wm.mif, gm.mif, csf.mif)
+    """
+    import os
+
+    from mrproc.slabs import stitch_slabs
+
+    return tuple(
+        stitch_slabs(files, bounds, os.path.abspath(name))
+        for files, name in [
+            (wm_files, "wm.mif"),
+            (gm_files, "gm.mif"),
+            (csf_files, "csf.mif"),
+        ]
+    )
@@ -0,0 +1,363 @@
+"""SLURM execution of workflows with one job per bundle of nodes
+
+The SLURM plugins of Nipype submit one job per node: a subject of the diffusion
+pipeline becomes some twenty jobs, most of them IdentityInterface nodes or format
+conversions lasting a second, and the scheduler overhead dominates. The
+SLURMBundlePlugin partitions the execution graph into bundles and submits one job
+per bundle, which runs its nodes with the MultiProc plugin inside the allocation.
+
+Bundles:
++ by default, all the nodes of a subject of the batch workflow (subject_id
+iterable, see mrproc.instrumentation.node_subject_id), nodes outside of any
+subject form a shared bundle
++ the "bundles" plugin argument names groups of nodes (dict mapping a group name
+to node names) that are split from the subject bundle into their own job, e.g. to
+run the tractography on a larger allocation than the preprocessing
+Bundles never depend on each other circularly: a bundle whose nodes would both
+precede and follow another bundle (a group-level node between two stages of a
+subject) is split into successive stages.
+
+A job is sized from the resource estimates of its nodes (n_procs and mem_gb, see
+mrproc.resources): the largest node sets the number of CPUs and the memory, the
+nodes of the bundle are scheduled within them. A bundle is submitted once the
+bundles it depends on have completed. The status of all the running jobs is
+polled with a single squeue call; when a job leaves the queue, the status file
+written by its runner (or by the job script, when the runner could not start)
+tells whether it succeeded, the end of the job log is reported with failures. Failed jobs (node errors,
+timeouts, preemptions) are resubmitted up to max_retries times, the nodes already
+done are reused from the Nipype cache.
+
+The sbatch and squeue commands are configurable, the plugin can thus be run
+against local stand-in scripts.
+"""
+
+import getpass
+import json
+import os
+import os.path as op
+import pickle
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from collections import deque
+
+import networkx as nx
+from nipype import logging
+from nipype.pipeline.plugins.base import PluginBase
+
+from mrproc.instrumentation import node_subject_id
+
+logger = logging.getLogger("nipype.workflow")
+
+SHARED_BUNDLE = "shared"
+STATUS_FILE = "status.json"
+# Lines of the job log reported with a failure
+LOG_LINES = 20
+# Job script, writing the status file if the runner exits without it (Python
+# environment or import failure)
+BUNDLE_SCRIPT = """#!/bin/bash
+%(python)s -m mrproc.slurm %(bundle_file)s
+code=$?
+if [ ! -e %(status_file)s ]; then
+    printf '{"status": "error", "error": "runner exited with code %%d"}' $code \\
+        > %(tmp_file)s
+    mv %(tmp_file)s %(status_file)s
+fi
+exit $code
+"""
+
+
+def partition_graph(graph, bundles=None):
+    """
+    Bundles of an execution graph
+    :param graph: execution graph (networkx DiGraph of Nipype nodes)
+    :param bundles: dict mapping group names to node names, these nodes are
+    bundled per subject and group instead of per subject
+    :return: OrderedDict mapping bundle names to their nodes (topological order
+    of the bundles)
+    """
+    groups = {}
+    for group, names in (bundles or {}).items():
+        for name in names:
+            groups[name] = group
+
+    def key(node):
+        subject_id = node_subject_id(node)
+        group = groups.get(node.name)
+        return tuple(part for part in (subject_id, group) if part) or (SHARED_BUNDLE,)
+
+    # A node is staged before the bundles of its successors (as late as
+    # possible, so that nodes shared by all subjects upstream of the iterables do
+    # not split the subjects): the graph of the bundles is acyclic
+    levels = {}
+    for node in reversed(list(nx.topological_sort(graph))):
+        levels[node] = max(
+            [
+                levels[target] + int(key(target) != key(node))
+                for target in graph.successors(node)
+            ],
+            default=0,
+        )
+    key_levels = {}
+    for node, level in levels.items():
+        key_levels.setdefault(key(node), set()).add(level)
+    partition = OrderedDict()
+    for node in sorted(graph.nodes(), key=lambda node: -levels[node]):
+        name = "_".join(key(node))
+        stages = sorted(key_levels[key(node)], reverse=True)
+        if len(stages) > 1:
+            name += "_stage%d" % (stages.index(levels[node]) + 1)
+        partition.setdefault(name, []).append(node)
+    return partition
+
+
+def bundle_resources(nodes):
+    """
+    Allocation of a bundle
+    :param nodes: Nipype nodes of the bundle
+    :return: (number of CPUs, memory in GB)
+    """
+    n_procs = max(node.n_procs or 1 for node in nodes)
+    mem_gb = max(node.mem_gb or 0 for node in nodes)
+    return n_procs, mem_gb
+
+
+def run_bundle(bundle_file):
+    """
+    Execute the nodes of a bundle (entry point of the jobs)
+    :param bundle_file: pickled bundle written by SLURMBundlePlugin
+    :return: exit code
+    """
+    bundle_dir = op.dirname(op.abspath(bundle_file))
+    status = {"status": "done", "error": None}
+    try:
+        from nipype.pipeline.plugins import MultiProcPlugin
+
+        with open(bundle_file, "rb") as f:
+            bundle = pickle.load(f)
+        plugin = MultiProcPlugin(plugin_args=bundle["plugin_args"])
+        plugin.run(bundle["graph"], bundle["config"], updatehash=False)
+    except Exception as e:
+        status = {"status": "error", "error": "%s: %s" % (type(e).__name__, e)}
+    _write_json(op.join(bundle_dir, STATUS_FILE), status)
+    return 0 if status["status"] == "done" else 1
+
+
+class SLURMBundlePlugin(PluginBase):
+    """
+    Execute a workflow on SLURM with one job per bundle of nodes
+
+    Plugin arguments:
+    + bundles: dict mapping group names to node names bundled apart (see
+    partition_graph)
+    + sbatch_args: extra sbatch arguments (str), e.g. "--partition=long --time=4:00:00"
+    + max_retries: number of resubmissions of a failed job (default 2)
+    + poll_interval: seconds between two squeue calls (default 10)
+    + status_timeout: seconds waited for the status file of a job that left the
+    queue before counting it as failed (default 30)
+    + mem_margin: memory requested in addition to the node estimates, as a
+    fraction of them (default 0.1)
+    + bundle_dir: directory of the job scripts, logs and status files (default:
+    bundles in the base directory of the workflow)
+    + sbatch, squeue: commands (default "sbatch", "squeue")
+    + python: interpreter running the bundles (default: the current one)
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.bundles = self.plugin_args.get("bundles")
+        self.sbatch_args = self.plugin_args.get("sbatch_args", "")
+        self.max_retries = self.plugin_args.get("max_retries", 2)
+        self.poll_interval = self.plugin_args.get("poll_interval", 10)
+        self.status_timeout = self.plugin_args.get("status_timeout", 30)
+        self.mem_margin = self.plugin_args.get("mem_margin", 0.1)
+        self.bundle_dir = self.plugin_args.get("bundle_dir")
+        self.sbatch = self.plugin_args.get("sbatch", "sbatch")
+        self.squeue = self.plugin_args.get("squeue", "squeue")
+        self.python = self.plugin_args.get("python", sys.executable)
+
+    def run(self, graph, config, updatehash=False):
+        partition = partition_graph(graph, self.bundles)
+        owner = {node: name for name, nodes in partition.items() for node in nodes}
+        dependencies = {name: set() for name in partition}
+        for source, target in graph.edges():
+            if owner[source] != owner[target]:
+                dependencies[owner[target]].add(owner[source])
+        bundle_dir = self.bundle_dir or op.join(
+            next(iter(graph.nodes())).base_dir or os.getcwd(), "bundles"
+        )
+        logger.info(
+            "[SLURMBundle] %d nodes in %d bundles",
+            graph.number_of_nodes(),
+            len(partition),
+        )
+
+        pending = OrderedDict((name, 0) for name in partition)  # name: submissions
+        running = {}  # job id: (bundle name, time it left the queue or None)
+        done, failed = set(), {}
+        while pending or running:
+            submitted = {name for name, _ in running.values()}
+            for name in list(pending):
+                if name in submitted:
+                    continue
+                if dependencies[name] & set(failed):
+                    failed[name] = "dependency failed"
+                    del pending[name]
+                elif dependencies[name] <= done:
+                    pending[name] += 1
+                    job_id = self._submit(
+                        name,
+                        graph.subgraph(partition[name]).copy(),
+                        config,
+                        op.join(bundle_dir, name),
+                    )
+                    running[job_id] = (name, None)
+            if not running:
+                continue
+            time.sleep(self.poll_interval)
+            queued = self._queued_jobs()
+            if queued is None:
+                continue
+            for job_id, (name, left) in list(running.items()):
+                if job_id in queued:
+                    continue
+                status = _read_json(op.join(bundle_dir, name, STATUS_FILE))
+                if status is None and left is None:
+                    running[job_id] = (name, time.time())
+                    continue
+                if status is None and time.time() - left < self.status_timeout:
+                    continue
+                del running[job_id]
+                if status is not None and status["status"] == "done":
+                    done.add(name)
+                    del pending[name]
+                    logger.info("[SLURMBundle] bundle %s done (job %s)", name, job_id)
+                    continue
+                error = status["error"] if status else "no status (job killed?)"
+                log_file = op.join(bundle_dir, name, "slurm-%s.out" % job_id)
+                log = _tail(log_file)
+                if log:
+                    error += "\nend of %s:\n%s" % (log_file, log)
+                if pending[name] > self.max_retries:
+                    failed[name] = error
+                    del pending[name]
+                    logger.error("[SLURMBundle] bundle %s failed: %s", name, error)
+                else:
+                    logger.warning(
+                        "[SLURMBundle] bundle %s failed (job %s), resubmitting: %s",
+                        name,
+                        job_id,
+                        error,
+                    )
+        if failed:
+            raise RuntimeError(
+                "Bundles did not execute cleanly:\n"
+                + "\n".join("%s: %s" % item for item in failed.items())
+            )
+
+    def _submit(self, name, graph, config, directory):
+        """Write the files of a bundle and submit its job"""
+        os.makedirs(directory, exist_ok=True)
+        status_file = op.join(directory, STATUS_FILE)
+        if op.exists(status_file):
+            os.remove(status_file)
+        n_procs, mem_gb = bundle_resources(list(graph.nodes()))
+        mem_gb = max(mem_gb * (1 + self.mem_margin), 0.1)
+        bundle_file = op.join(directory, "bundle.pklz")
+        with open(bundle_file, "wb") as f:
+            pickle.dump(
+                {
+                    "graph": graph,
+                    "config": config,
+                    "plugin_args": {
+                        "n_procs": n_procs,
+                        "memory_gb": mem_gb,
+                        "raise_insufficient": False,
+                    },
+                },
+                f,
+            )
+        script_file = op.join(directory, "bundle.sh")
+        with open(script_file, "w") as f:
+            f.write(
+                BUNDLE_SCRIPT
+                % {
+                    "python": shlex.quote(self.python),
+                    "bundle_file": shlex.quote(bundle_file),
+                    "status_file": shlex.quote(status_file),
+                    "tmp_file": shlex.quote(status_file + ".tmp"),
+                }
+            )
+        command = (
+            shlex.split(self.sbatch)
+            + [
+                "--parsable",
+                "--job-name=%s" % name,
+                "--cpus-per-task=%d" % n_procs,
+                "--mem=%dM" % int(mem_gb * 1024),
+                "--output=%s" % op.join(directory, "slurm-%j.out"),
+            ]
+            + shlex.split(self.sbatch_args)
+            + [script_file]
+        )
+        output = subprocess.run(
+            command, check=True, capture_output=True, text=True
+        ).stdout
+        # --parsable: "<job id>[;<cluster>]"
+        job_id = output.strip().splitlines()[-1].split(";")[0]
+        logger.info(
+            "[SLURMBundle] bundle %s (%d nodes, %d CPUs, %.1f GB) submitted as job %s",
+            name,
+            graph.number_of_nodes(),
+            n_procs,
+            mem_gb,
+            job_id,
+        )
+        return job_id
+
+    def _queued_jobs(self):
+        """Identifiers of the jobs of the user still queued or running"""
+        command = shlex.split(self.squeue) + [
+            "--noheader",
+            "--format=%i",
+            "--user=%s" % getpass.getuser(),
+        ]
+        try:
+            output = subprocess.run(
+                command, check=True, capture_output=True, text=True
+            ).stdout
+        except subprocess.CalledProcessError as e:
+            # Transient controller errors: consider every job still queued
+            logger.warning("[SLURMBundle] squeue failed: %s", e.stderr)
+            return None
+        return set(output.split())
+
+
+def _write_json(path, content):
+    fd, tmp_file = tempfile.mkstemp(prefix=".tmp_", dir=op.dirname(path))
+    with os.fdopen(fd, "w") as f:
+        json.dump(content, f)
+    os.replace(tmp_file, path)
+
+
+def _tail(path, lines=LOG_LINES):
+    try:
+        with open(path, errors="replace") as f:
+            return "".join(deque(f, maxlen=lines)).rstrip()
+    except OSError:
+        return ""
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    sys.exit(run_bundle(sys.argv[1]))
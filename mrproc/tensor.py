@@ -0,0 +1,151 @@
+"""In-process diffusion tensor and FA estimation
+
+Alternative to dwi2tensor + tensor2metric when only the FA is needed (target of
+the T1 registration): the tensor is fitted by iteratively reweighted linear
+least squares on the log signal, as dwi2tensor does (first weighted by the
+measured signal, then reweighted by the predicted one), and the FA is written
+directly, without any intermediate tensor image.
+
+The diffusion series (.mif, see mrproc.io.mif) is memory-mapped and read by
+slabs of slices; the voxels of the brain mask of a slab are fitted at once by
+batched solves of the 7 x 7 normal equations. The FA is rotation invariant, so
+the gradient table is used in scanner space as it is stored in the image header.
+"""
+
+import numpy as np
+
+from mrproc.io.mif import MifFile
+
+# Signal floor before the log transform
+MIN_SIGNAL = 1e-10
+# Number of signal values (voxels x volumes) read and fitted at once
+CHUNK_VALUES = 1 << 24
+
+
+def design_matrix(scheme):
+    """
+    Log-linear tensor model of a gradient table
+    :param scheme: (N, 4) gradient table (x, y, z, b)
+    :return: (N, 7) matrix mapping (Dxx, Dyy, Dzz, Dxy, Dxz, Dyz, log S0) to the
+    log signal
+    """
+    scheme = np.asarray(scheme, dtype=float)
+    norms = np.linalg.norm(scheme[:, :3], axis=1)
+    directions = scheme[:, :3] / np.where(norms > 0, norms, 1)[:, None]
+    x, y, z = directions.T
+    b = scheme[:, 3]
+    return np.stack(
+        [
+            -b * x * x,
+            -b * y * y,
+            -b * z * z,
+            -2 * b * x * y,
+            -2 * b * x * z,
+            -2 * b * y * z,
+            np.ones_like(b),
+        ],
+        axis=1,
+    )
+
+
+def fit_tensor(signals, design, iterations=2):
+    """
+    Iteratively reweighted least squares fit of the log-linear tensor model
+    :param signals: (V, N) diffusion signals of V voxels
+    :param design: (N, 7) design matrix (see design_matrix)
+    :param iterations: number of reweightings by the predicted signal
+    (dwi2tensor -iter)
+    :return: (V, 7) parameters (Dxx, Dyy, Dzz, Dxy, Dxz, Dyz, log S0)
+    """
+    signals = np.maximum(np.asarray(signals, dtype=float), MIN_SIGNAL)
+    log_signals = np.log(signals)
+    weights = signals
+    nb_parameters = design.shape[1]
+    # Outer products of the design rows, (N, 49)
+    outer = (design[:, :, None] * design[:, None, :]).reshape(len(design), -1)
+    for iteration in range(iterations + 1):
+        squared = weights**2
+        # (V, 7, 7) normal matrices and (V, 7) right-hand sides
+        normal = (squared @ outer).reshape(-1, nb_parameters, nb_parameters)
+        rhs = (squared * log_signals) @ design
+        parameters = np.linalg.solve(normal, rhs[..., None])[..., 0]
+        if iteration < iterations:
+            weights = np.exp(np.clip(parameters @ design.T, None, 700))
+    return parameters
+
+
+def fractional_anisotropy(parameters):
+    """
+    FA of tensors
+    :param parameters: (V, 6+) tensor coefficients (Dxx, Dyy, Dzz, Dxy, Dxz, Dyz)
+    :return: (V,) FA, 0 for null tensors
+    """
+    diagonal = parameters[:, :3]
+    off_diagonal = parameters[:, 3:6]
+    mean = diagonal.mean(axis=1, keepdims=True)
+    # Frobenius norms of the tensor and of its deviatoric part
+    norm = (diagonal**2).sum(axis=1) + 2 * (off_diagonal**2).sum(axis=1)
+    deviation = ((diagonal - mean) ** 2).sum(axis=1) + 2 * (off_diagonal**2).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fa = np.sqrt(1.5 * deviation / norm)
+    return np.nan_to_num(fa)
+
+
+def compute_fa(diffusion_volume, mask=None, iterations=2):
+    """
+    FA map of a diffusion series
+    :param diffusion_volume: path of the .mif series (embedded gradient table)
+    :param mask: optional path of a .mif brain mask, voxels with a non-zero
+    signal are fitted otherwise
+    :param iterations: number of reweightings of the fit
+    :return: FA (3D float32 array), voxel to scanner affine
+    """
+    dwi = MifFile(diffusion_volume)
+    scheme = dwi.dw_scheme
+    if scheme is None:
+        raise ValueError("%s has no gradient table (dw_scheme)" % diffusion_volume)
+    if len(dwi.shape) != 4 or dwi.shape[3] != len(scheme):
+        raise ValueError(
+            "%s: %d gradient directions for dimensions %s"
+            % (diffusion_volume, len(scheme), dwi.shape)
+        )
+    design = design_matrix(scheme)
+    data = dwi.data
+    brain = None if mask is None else np.asarray(MifFile(mask).data).astype(bool)
+    if brain is not None and brain.ndim > 3:
+        brain = brain.reshape(brain.shape[:3])
+    fa = np.zeros(dwi.shape[:3], dtype=np.float32)
+    slice_values = dwi.shape[0] * dwi.shape[1] * dwi.shape[3]
+    slab = max(1, CHUNK_VALUES // slice_values)
+    for start in range(0, dwi.shape[2], slab):
+        stop = min(start + slab, dwi.shape[2])
+        signals = np.asarray(data[:, :, start:stop], dtype=float)
+        if brain is None:
+            inside = signals.any(axis=3)
+        else:
+            inside = brain[:, :, start:stop]
+        if inside.any():
+            parameters = fit_tensor(signals[inside], design, iterations=iterations)
+            fa[:, :, start:stop][inside] = fractional_anisotropy(parameters)
+    return fa, dwi.affine
+
+
+def write_fa(diffusion_volume, mask=None, iterations=2, out_file="fa.nii.gz"):
+    """
+    Fit the tensor model and write the FA as NIfTI (Nipype Function step)
+    :param diffusion_volume: path of the .mif series
+    :param mask: optional path of the brain mask
+    :param iterations: number of reweightings of the fit
+    :param out_file: name of the FA file (.nii or .nii.gz)
+    :return: path of the FA file
+    """
+    import os
+
+    import nibabel
+
+    from mrproc.tensor import compute_fa
+
+    fa, affine = compute_fa(diffusion_volume, mask=mask, iterations=iterations)
+    out_file = os.path.abspath(out_file)
+    nibabel.save(nibabel.Nifti1Image(fa, affine), out_file)
+    return out_file
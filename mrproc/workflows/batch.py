@@ -0,0 +1,700 @@
+"""Multi-subject execution of the diffusion-weighted MRI processing workflow
+
+Subjects are described either by a manifest file (TSV, CSV or JSON) or by a
+BIDS-like directory. Every subject is fanned out through the single subject
+workflow (create_dwi_processing_pipeline) using Nipype iterables, so that the
+whole cohort is expanded into one execution graph and scheduled by the MultiProc
+plugin under a global CPU/memory budget. With a completion ledger (see
+mrproc.ledger), subjects finished by a previous launch are left out of the graph.
+
+In group response mode, the response functions are estimated on a subset of the
+subjects only (response estimation workflow, see
+create_response_estimation_pipeline), averaged, and every subject is deconvolved
+with the group responses. The subset is spread over the whole cohort (subjects
+already processed included) so that it does not change between launches.
+
+In preview mode, every subject goes through the preview profile (small
+unfiltered tractogram and QC artifacts, see create_preview_pipeline) so that the
+cohort can be checked before the full run, which reuses the upstream stages.
+
+Intermediate volumes can be left uncompressed (see apply_intermediate_format),
+and the copies of the outputs in the output directory gzipped instead, by a pool
+of threads per subject (compress_output_copies) running alongside the other
+subjects.
+"""
+
+import csv
+import glob
+import gzip
+import json
+import os
+import shutil
+
+import nipype.pipeline.engine as pe
+from nipype.interfaces import io as nio
+from nipype.interfaces import utility
+from nipype.interfaces.utility import Function
+
+from mrproc.cache import ResultStore
+from mrproc.cache import attach_result_store
+from mrproc.ledger import CompletionLedger
+from mrproc.nodes.custom_nodes import create_response_average_node
+from mrproc.resources import apply_resource_profile
+from mrproc.resources import count_voxels
+from mrproc.resources import estimate_node_resources
+from mrproc.resources import load_resource_profile
+from mrproc.resources import set_node_threads
+from mrproc.workflows.dwi_processing import PREVIEW_TRACKS
+from mrproc.workflows.dwi_processing import WORKFLOW_OPTIONS
+from mrproc.workflows.dwi_processing import apply_intermediate_format
+from mrproc.workflows.dwi_processing import create_dwi_processing_pipeline
+from mrproc.workflows.dwi_processing import create_response_estimation_pipeline
+from mrproc.workflows.dwi_processing import workflow_options
+
+# Per-subject files expected in a manifest (in addition to subject_id)
+SUBJECT_FIELDS = ["diffusion_volume", "bvals", "bvecs", "t1_volume"]
+# Per-subject files required by the connectome stage (T1 space parcellation)
+CONNECTOME_FIELDS = ["parcellation"]
+# Response functions of the group response mode
+RESPONSE_FIELDS = ["wm_response", "gm_response", "csf_response"]
+# Outputs of the diffusion pipeline that are copied to the output directory
+OUTPUT_FIELDS = [
+    "corrected_diffusion_volume",
+    "wm_fod",
+    "tractogram",
+    "tractogram_weights",
+    "diffusion_to_t1_transform",
+    "connectome",
+    "qc_summary",
+    "qc_images",
+    "compression_report",
+]
+# Workflow options given as such to the subjects (group_response, qc and
+# response_only follow the group response and preview modes of the batch)
+BATCH_OPTIONS = [
+    name
+    for name in WORKFLOW_OPTIONS
+    if name not in ("group_response", "qc", "sweep", "response_only")
+]
+# Output copies gzipped by compress_outputs (read as such by MRtrix3 and FSL)
+COMPRESSED_EXTENSIONS = [".nii", ".mif"]
+COMPRESSION_LEVEL = 6
+
+
+def read_manifest(manifest):
+    """
+    Read a subject manifest
+
+    The manifest is either a JSON file holding a list of subject records or a
+    delimited text file (.tsv or .csv) with a header line. Each record must
+    provide a subject_id and the diffusion_volume, bvals, bvecs and t1_volume
+    paths, and optionally a parcellation (connectome stage). Relative paths are
+    resolved against the manifest directory.
+    :param manifest: path of the manifest file
+    :return: subjects (list of dict)
+    """
+    manifest = os.path.abspath(manifest)
+    root = os.path.dirname(manifest)
+    if manifest.endswith(".json"):
+        with open(manifest) as f:
+            records = json.load(f)
+    else:
+        delimiter = "," if manifest.endswith(".csv") else "\t"
+        with open(manifest, newline="") as f:
+            records = list(csv.DictReader(f, delimiter=delimiter))
+
+    subjects = []
+    for record in records:
+        missing = [
+            field for field in ["subject_id"] + SUBJECT_FIELDS if not record.get(field)
+        ]
+        if missing:
+            raise ValueError(
+                "Manifest %s: record %r lacks field(s) %s"
+                % (manifest, record, ", ".join(missing))
+            )
+        subject = {key: value for key, value in record.items() if value}
+        for field in SUBJECT_FIELDS + CONNECTOME_FIELDS:
+            if field in subject:
+                subject[field] = os.path.join(root, subject[field])
+        subjects.append(subject)
+    _check_unique_ids(subjects)
+    return subjects
+
+
+def find_bids_subjects(bids_dir, participant_label=None):
+    """
+    Collect the subjects of a BIDS-like directory
+
+    Diffusion data are searched as sub-<label>[/ses-<label>]/dwi/*_dwi.nii[.gz]
+    with the matching .bval/.bvec files and the T1 volume as
+    sub-<label>[/ses-<label>]/anat/*_T1w.nii[.gz], and the optional parcellation
+    as sub-<label>[/ses-<label>]/anat/*_dseg.nii[.gz]. When a session has no T1
+    volume (or parcellation) the subject-level (session-less) one is used.
+    :param bids_dir: root directory of the dataset
+    :param participant_label: optional list of labels (with or without "sub-")
+    to restrict the search to
+    :return: subjects (list of dict)
+    """
+    bids_dir = os.path.abspath(bids_dir)
+    if participant_label:
+        labels = [label.replace("sub-", "") for label in participant_label]
+        subject_dirs = [os.path.join(bids_dir, "sub-" + label) for label in labels]
+    else:
+        subject_dirs = sorted(glob.glob(os.path.join(bids_dir, "sub-*")))
+
+    subjects = []
+    for subject_dir in subject_dirs:
+        if not os.path.isdir(subject_dir):
+            continue
+        session_dirs = sorted(glob.glob(os.path.join(subject_dir, "ses-*")))
+        for session_dir in session_dirs or [subject_dir]:
+            dwi = _glob_first(session_dir, "dwi", "*_dwi.nii*")
+            t1 = _glob_first(session_dir, "anat", "*_T1w.nii*")
+            if t1 is None:
+                t1 = _glob_first(subject_dir, "anat", "*_T1w.nii*")
+            if dwi is None or t1 is None:
+                continue
+            stem = dwi.split(".nii")[0]
+            if not (os.path.exists(stem + ".bval") and os.path.exists(stem + ".bvec")):
+                continue
+            subject_id = os.path.basename(subject_dir)
+            if session_dir != subject_dir:
+                subject_id += "_" + os.path.basename(session_dir)
+            subject = {
+                "subject_id": subject_id,
+                "diffusion_volume": dwi,
+                "bvals": stem + ".bval",
+                "bvecs": stem + ".bvec",
+                "t1_volume": t1,
+            }
+            parcellation = _glob_first(
+                session_dir, "anat", "*_dseg.nii*"
+            ) or _glob_first(subject_dir, "anat", "*_dseg.nii*")
+            if parcellation is not None:
+                subject["parcellation"] = parcellation
+            subjects.append(subject)
+    return subjects
+
+
+def load_subjects(source, participant_label=None):
+    """
+    Load subjects either from a manifest file or a BIDS-like directory
+    :param source: manifest path or dataset directory
+    :param participant_label: optional subject labels to keep
+    :return: subjects (list of dict)
+    """
+    if os.path.isdir(source):
+        return find_bids_subjects(source, participant_label=participant_label)
+    subjects = read_manifest(source)
+    if participant_label:
+        labels = {label.replace("sub-", "") for label in participant_label}
+        subjects = [
+            subject
+            for subject in subjects
+            if subject["subject_id"].split("_")[0].replace("sub-", "") in labels
+        ]
+    return subjects
+
+
+def select_subject_files(subject_id, subjects, fields=None):
+    """
+    Return the input files of one subject of the batch
+    :param subject_id: identifier of the subject
+    :param subjects: mapping from subject identifiers to subject records
+    :param fields: fields to return (default: SUBJECT_FIELDS)
+    :return: diffusion_volume, bvals, bvecs, t1_volume (and the other fields)
+    """
+    from mrproc.workflows.batch import SUBJECT_FIELDS
+
+    subject = subjects[subject_id]
+    return tuple(subject[field] for field in fields or SUBJECT_FIELDS)
+
+
+def compress_file(path, compresslevel=COMPRESSION_LEVEL):
+    """
+    Gzip a file, the original is removed
+    :param path: path of the file
+    :param compresslevel: gzip compression level
+    :return: path of the compressed file
+    """
+    compressed = path + ".gz"
+    if not os.path.exists(path) and os.path.exists(compressed):
+        # Compressed by a previous run
+        return compressed
+    with open(path, "rb") as f_in:
+        with gzip.open(compressed, "wb", compresslevel=compresslevel) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+    os.remove(path)
+    return compressed
+
+
+def compress_output_copies(files, n_procs=1):
+    """
+    Gzip the copies of the outputs of a subject (Nipype Function step)
+    :param files: paths of the copied outputs (DataSink out_file)
+    :param n_procs: number of files compressed at once (zlib releases the GIL)
+    :return: paths of the outputs, with the names of the compressed files
+    """
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    from mrproc.workflows.batch import COMPRESSED_EXTENSIONS
+    from mrproc.workflows.batch import compress_file
+
+    if isinstance(files, str):
+        files = [files]
+    files = [
+        path
+        for item in files
+        for path in (item if isinstance(item, (list, tuple)) else [item])
+    ]
+    selected = [
+        path for path in files if os.path.splitext(path)[1] in COMPRESSED_EXTENSIONS
+    ]
+    with ThreadPoolExecutor(max_workers=max(1, int(n_procs))) as pool:
+        compressed = dict(zip(selected, pool.map(compress_file, selected)))
+    return [compressed.get(path, path) for path in files]
+
+
+def select_response_subjects(subjects, nb_subjects):
+    """
+    Subjects whose responses are averaged in group response mode
+    :param subjects: subject records of the whole cohort
+    :param nb_subjects: number of subjects of the subset
+    :return: subset of the subjects, evenly spread over the cohort (in order)
+    """
+    if nb_subjects < 1:
+        raise ValueError("The group response needs at least one subject")
+    nb_subjects = min(nb_subjects, len(subjects))
+    step = len(subjects) / nb_subjects
+    return [subjects[int(i * step)] for i in range(nb_subjects)]
+
+
+def record_completion(
+    ledger,
+    parameters,
+    subject_id,
+    diffusion_volume,
+    bvals,
+    bvecs,
+    t1_volume,
+    parcellation=None,
+    **outputs,
+):
+    """
+    Record a processed subject in the completion ledger
+    :param ledger: ledger directory (see mrproc.ledger)
+    :param parameters: processing parameters
+    :param subject_id: identifier of the subject
+    :param diffusion_volume, bvals, bvecs, t1_volume: input files of the subject
+    :param parcellation: parcellation of the subject (connectome stage)
+    :param outputs: output files of the subject, by output name, and the copies
+    of the output directory (sinked)
+    :return: path of the ledger entry
+    """
+    from mrproc.ledger import CompletionLedger
+    from mrproc.workflows.batch import CONNECTOME_FIELDS
+    from mrproc.workflows.batch import SUBJECT_FIELDS
+
+    # Copies of the output directory outlive the working directory
+    if "sinked" in outputs:
+        outputs = {"sinked": outputs["sinked"]}
+
+    subject = {
+        "subject_id": subject_id,
+        "diffusion_volume": diffusion_volume,
+        "bvals": bvals,
+        "bvecs": bvecs,
+        "t1_volume": t1_volume,
+    }
+    input_fields = SUBJECT_FIELDS
+    if parcellation is not None:
+        subject["parcellation"] = parcellation
+        input_fields = SUBJECT_FIELDS + CONNECTOME_FIELDS
+    ledger = CompletionLedger(ledger, input_fields=input_fields)
+    return ledger.record(subject, parameters, outputs)
+
+
+def create_batch_dwi_processing_pipeline(
+    subjects,
+    nb_tracks=None,
+    min_length=None,
+    max_length=None,
+    seed=None,
+    group_response=None,
+    preview=False,
+    intermediate_format="nifti_gz",
+    output_dir=None,
+    compress_outputs=False,
+    resource_profile=None,
+    max_procs=None,
+    result_store=None,
+    result_store_max_gb=None,
+    ledger=None,
+    name="batch_dwi_processing_pipeline",
+    **options,
+):
+    """
+    Fan a list of subjects out through the diffusion processing workflow
+    :param subjects: list of subject records (see read_manifest)
+    :param nb_tracks: number of streamlines of the whole brain tractogram
+    :param min_length: minimal streamline length (mm)
+    :param max_length: maximal streamline length (mm)
+    :param seed: random seed of the tractography (shards use seed + i)
+    :param group_response: if given, number of subjects whose response functions
+    are averaged into the group responses used by every subject (see
+    select_response_subjects), per subject responses if None
+    :param preview: if True, the tractograms are not filtered (sift_mode, the
+    SIFT termination criteria and compression_check are ignored), nb_tracks
+    defaults to PREVIEW_TRACKS and QC artifacts are written (qc_summary and
+    qc_images outputs). A full run launched with the same options reuses every
+    stage up to the tractography (registration="rigid" and
+    registration_resolution=None give the fastest preview but are not reused)
+    :param intermediate_format: format of the intermediate volumes ("nifti_gz",
+    "nifti" or "mif", see
+    mrproc.workflows.dwi_processing.apply_intermediate_format)
+    :param output_dir: if given, final outputs are copied to
+    output_dir/<subject_id>
+    :param compress_outputs: if True, the NIfTI and .mif copies of the output
+    directory are gzipped (COMPRESSED_EXTENSIONS), requires output_dir
+    :param resource_profile: None, dict or JSON path overriding the default node
+    resource profile (see mrproc.resources)
+    :param max_procs: upper bound of the per node thread count
+    :param result_store: directory of the result store shared across runs (see
+    mrproc.cache), disabled if None
+    :param result_store_max_gb: size cap of the result store
+    :param ledger: directory of the completion ledger (see mrproc.ledger):
+    subjects completed with the same inputs and parameters are skipped, the
+    others are recorded once processed. Disabled if None
+    :param name: name of the batch workflow
+    :param options: options of the diffusion processing workflow (see
+    mrproc.workflows.dwi_processing.create_dwi_processing_pipeline),
+    BATCH_OPTIONS only
+    :return: batch workflow, None if the ledger holds every subject
+    """
+    if not subjects:
+        raise ValueError("No subject to process")
+    if compress_outputs and output_dir is None:
+        raise ValueError("Compressing the outputs requires an output directory")
+    _check_unique_ids(subjects)
+    options = workflow_options(options, BATCH_OPTIONS)
+    if preview:
+        options.update(
+            sift_mode="none",
+            term_number=None,
+            term_ratio=None,
+            term_mu=None,
+            compression_check=False,
+        )
+        if nb_tracks is None:
+            nb_tracks = PREVIEW_TRACKS
+    subject_fields = SUBJECT_FIELDS
+    if options["connectome"]:
+        subject_fields = SUBJECT_FIELDS + CONNECTOME_FIELDS
+        missing = [
+            subject["subject_id"]
+            for subject in subjects
+            if not all(subject.get(field) for field in CONNECTOME_FIELDS)
+        ]
+        if missing:
+            raise ValueError(
+                "The connectome stage needs a parcellation, missing for %s"
+                % ", ".join(missing)
+            )
+    # Parameters changing the outputs of a subject
+    # nb_slabs is left out: sharded FODs are identical to single job ones
+    parameters = dict(
+        {name: value for name, value in options.items() if name != "nb_slabs"},
+        nb_tracks=nb_tracks,
+        min_length=min_length,
+        max_length=max_length,
+        seed=seed,
+        group_response=None,
+        preview=preview,
+    )
+    if group_response is not None:
+        response_subjects = select_response_subjects(subjects, group_response)
+        parameters["group_response"] = [
+            subject["subject_id"] for subject in response_subjects
+        ]
+    if ledger is not None:
+        ledger = os.path.abspath(ledger)
+        subjects = CompletionLedger(ledger, input_fields=subject_fields).pending(
+            subjects, parameters
+        )
+        if not subjects:
+            return None
+
+    infosource = pe.Node(
+        utility.IdentityInterface(fields=["subject_id"]), name="infosource"
+    )
+    infosource.iterables = (
+        "subject_id",
+        [subject["subject_id"] for subject in subjects],
+    )
+    selectfiles = pe.Node(
+        interface=Function(
+            input_names=["subject_id", "subjects", "fields"],
+            output_names=subject_fields,
+            function=select_subject_files,
+        ),
+        name="selectfiles",
+    )
+    selectfiles.inputs.subjects = {
+        subject["subject_id"]: {field: subject[field] for field in subject_fields}
+        for subject in subjects
+    }
+    selectfiles.inputs.fields = subject_fields
+    dwi_processing_pipeline = create_dwi_processing_pipeline(
+        group_response=group_response is not None, qc=preview, **options
+    )
+    workflows = [dwi_processing_pipeline]
+    if group_response is not None:
+        response_pipeline = create_response_estimation_pipeline(**options)
+        workflows.append(response_pipeline)
+    inputnode = dwi_processing_pipeline.get_node("inputnode")
+    for field, value in [
+        ("nb_tracks", nb_tracks),
+        ("min_length", min_length),
+        ("max_length", max_length),
+        ("seed", seed),
+    ]:
+        if value is not None:
+            setattr(inputnode.inputs, field, value)
+    # Nodes are shared by all subjects: size them for the largest diffusion series
+    nb_voxels = [count_voxels(subject["diffusion_volume"]) for subject in subjects]
+    nb_voxels = [n for n in nb_voxels if n is not None]
+    if result_store is not None:
+        result_store = ResultStore(result_store, max_size_gb=result_store_max_gb)
+    for workflow in workflows:
+        apply_resource_profile(
+            workflow,
+            profile=resource_profile,
+            nb_tracks=nb_tracks,
+            nb_voxels=max(nb_voxels) if nb_voxels else None,
+            max_procs=max_procs,
+            nb_shards=options["nb_shards"],
+        )
+        if result_store is not None:
+            attach_result_store(workflow, result_store)
+        apply_intermediate_format(workflow, intermediate_format)
+
+    batch = pe.Workflow(name=name)
+    batch.connect(infosource, "subject_id", selectfiles, "subject_id")
+    batch.connect(
+        [
+            (
+                selectfiles,
+                dwi_processing_pipeline,
+                [(field, "inputnode." + field) for field in subject_fields],
+            )
+        ]
+    )
+    if group_response is not None:
+        _connect_group_response(batch, response_subjects, response_pipeline)
+    if output_dir is not None:
+        datasink = pe.Node(
+            nio.DataSink(
+                base_directory=os.path.abspath(output_dir), parameterization=False
+            ),
+            name="datasink",
+        )
+        batch.connect(infosource, "subject_id", datasink, "container")
+        batch.connect(
+            [
+                (
+                    dwi_processing_pipeline,
+                    datasink,
+                    [("outputnode." + field, field) for field in OUTPUT_FIELDS],
+                )
+            ]
+        )
+        sinked = (datasink, "out_file")
+        if compress_outputs:
+            compress = pe.Node(
+                interface=Function(
+                    input_names=["files", "n_procs"],
+                    output_names=["out_files"],
+                    function=compress_output_copies,
+                ),
+                name="compress_outputs",
+            )
+            n_procs, compress._mem_gb = estimate_node_resources(
+                "compress_outputs", load_resource_profile(resource_profile)
+            )
+            if max_procs is not None:
+                n_procs = max(1, min(n_procs, max_procs))
+            set_node_threads(compress, n_procs)
+            batch.connect(datasink, "out_file", compress, "files")
+            sinked = (compress, "out_files")
+    if ledger is not None:
+        record = pe.Node(
+            interface=Function(
+                input_names=["ledger", "parameters", "subject_id"]
+                + subject_fields
+                + OUTPUT_FIELDS
+                + (["sinked"] if output_dir is not None else []),
+                output_names=["entry_file"],
+                function=record_completion,
+            ),
+            name="record_completion",
+        )
+        record.inputs.ledger = ledger
+        record.inputs.parameters = parameters
+        batch.connect(infosource, "subject_id", record, "subject_id")
+        batch.connect(
+            [
+                (selectfiles, record, [(field, field) for field in subject_fields]),
+                (
+                    dwi_processing_pipeline,
+                    record,
+                    [("outputnode." + field, field) for field in OUTPUT_FIELDS],
+                ),
+            ]
+        )
+        if output_dir is not None:
+            # Recorded once the outputs are copied (and compressed)
+            batch.connect(sinked[0], sinked[1], record, "sinked")
+    return batch
+
+
+def run_batch(
+    batch,
+    n_procs=None,
+    memory_gb=None,
+    plugin="MultiProc",
+    report_dir=None,
+    intermediates="keep",
+    scratch_quota_gb=None,
+):
+    """
+    Execute a batch workflow under a global CPU and memory budget
+    :param batch: workflow returned by create_batch_dwi_processing_pipeline
+    :param n_procs: number of processors shared by all subjects (default: all)
+    :param memory_gb: memory (GB) shared by all subjects (default: 90% of the
+    system memory)
+    :param plugin: Nipype execution plugin, "Asyncio" for the event-driven
+    execution of mrproc.asyncio_plugin
+    :param report_dir: if given, nodes are instrumented and a run report is
+    written in this directory (MultiProc plugin only, see mrproc.instrumentation)
+    :param intermediates: "keep", "delete" or "compress" the intermediate files
+    once their consumers are done, outputs of the pipeline (OUTPUT_FIELDS) are
+    always kept (MultiProc plugin only, see mrproc.scratch)
+    :param scratch_quota_gb: size of the working directory above which no new
+    subject is started (MultiProc plugin only, requires intermediates "delete" or
+    "compress")
+    :return: execution graph
+    """
+    plugin_args = {"raise_insufficient": False}
+    if n_procs is not None:
+        plugin_args["n_procs"] = n_procs
+    if memory_gb is not None:
+        plugin_args["memory_gb"] = memory_gb
+    scratch_managed = intermediates != "keep" or scratch_quota_gb is not None
+    if (report_dir is not None or scratch_managed) and plugin != "MultiProc":
+        raise ValueError(
+            "Instrumentation and scratch management require the MultiProc plugin"
+        )
+    if report_dir is not None:
+        plugin_args["report_dir"] = report_dir
+    if scratch_managed:
+        from mrproc.scratch import InstrumentedScratchManagedMultiProcPlugin
+        from mrproc.scratch import ScratchManagedMultiProcPlugin
+        from mrproc.scratch import declared_outputs
+
+        plugin_args["intermediates"] = intermediates
+        plugin_args["scratch_quota_gb"] = scratch_quota_gb
+        plugin_args["keep_outputs"] = declared_outputs(
+            batch.get_node("dwi_processing_pipeline"),
+            OUTPUT_FIELDS,
+            hierarchy=batch.name,
+        )
+        if batch.get_node("group_response") is not None:
+            plugin_args["keep_outputs"] |= {
+                (batch.name + ".group_response", tissue + "_file")
+                for tissue in ["wm", "gm", "csf"]
+            }
+        if report_dir is not None:
+            plugin = InstrumentedScratchManagedMultiProcPlugin(plugin_args=plugin_args)
+        else:
+            plugin = ScratchManagedMultiProcPlugin(plugin_args=plugin_args)
+    elif report_dir is not None:
+        from mrproc.instrumentation import InstrumentedMultiProcPlugin
+
+        plugin = InstrumentedMultiProcPlugin(plugin_args=plugin_args)
+    elif plugin == "Asyncio":
+        from mrproc.asyncio_plugin import AsyncioPlugin
+
+        plugin = AsyncioPlugin(plugin_args=plugin_args)
+    return batch.run(plugin=plugin, plugin_args=plugin_args)
+
+
+def _connect_group_response(batch, response_subjects, response_pipeline):
+    """
+    Estimate the responses of a subset of the subjects and feed their average to
+    the diffusion processing workflow of every subject
+    :param batch: batch workflow holding the dwi_processing_pipeline workflow
+    :param response_subjects: subject records of the subset
+    :param response_pipeline: response estimation workflow
+    :return:
+    """
+    response_infosource = pe.Node(
+        utility.IdentityInterface(fields=["subject_id"]), name="response_infosource"
+    )
+    response_infosource.iterables = (
+        "subject_id",
+        [subject["subject_id"] for subject in response_subjects],
+    )
+    response_selectfiles = pe.Node(
+        interface=Function(
+            input_names=["subject_id", "subjects"],
+            output_names=SUBJECT_FIELDS,
+            function=select_subject_files,
+        ),
+        name="response_selectfiles",
+    )
+    response_selectfiles.inputs.subjects = {
+        subject["subject_id"]: {field: subject[field] for field in SUBJECT_FIELDS}
+        for subject in response_subjects
+    }
+    group_response = create_response_average_node("response_infosource")
+    batch.connect(
+        [
+            (response_infosource, response_selectfiles, [("subject_id", "subject_id")]),
+            (
+                response_selectfiles,
+                response_pipeline,
+                [(field, "inputnode." + field) for field in SUBJECT_FIELDS],
+            ),
+            (
+                response_pipeline,
+                group_response,
+                [
+                    ("outputnode." + field, tissue + "_files")
+                    for field, tissue in zip(RESPONSE_FIELDS, ["wm", "gm", "csf"])
+                ],
+            ),
+            (
+                group_response,
+                batch.get_node("dwi_processing_pipeline"),
+                [
+                    (tissue + "_file", "inputnode." + field)
+                    for field, tissue in zip(RESPONSE_FIELDS, ["wm", "gm", "csf"])
+                ],
+            ),
+        ]
+    )
+
+
+def _glob_first(directory, datatype, pattern):
+    matches = sorted(glob.glob(os.path.join(directory, datatype, pattern)))
+    return matches[0] if matches else None
+
+
+def _check_unique_ids(subjects):
+    seen = set()
+    for subject in subjects:
+        if subject["subject_id"] in seen:
+            raise ValueError("Duplicated subject_id %s" % subject["subject_id"])
+        seen.add(subject["subject_id"])
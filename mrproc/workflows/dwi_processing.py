@@ -4,41 +4,282 @@ The workflows cover the following steps:
 + Bias field correction
 + Gross mask extraction
 + Tensor and FA computation
-+ Multi-Tissue Multi-Shell Constrained Spherical Deconvolution
++ Multi-Tissue Multi-Shell Constrained Spherical Deconvolution (optionally
+sharded across slabs of the brain mask, see mrproc.slabs)
 + Whole brain probabilistic anatomicaly constrained tractography
++ Tractogram compression (optional, see mrproc.compression)
 + Tractogram filtering (SIFT)
++ Quality control images and summary (optional, preview runs)
++ Structural connectome (optional)
 + T1 tissue classification
 + diffusion to T1 registration
 Pipelines rely on MRtrix3, FSL, Ants and Nipype package
+
+The workflows are built from keyword options (WORKFLOW_OPTIONS, documented by
+create_dwi_processing_pipeline), once per set of options: later calls return a
+copy of the cached template. create_preview_pipeline and
+create_response_estimation_pipeline are variants of the full workflow.
 """
 
+import itertools
+import pickle
+
 import nipype.pipeline.engine as pe
 from nipype.interfaces import utility
-from nipype.interfaces import mrtrix3
-from nipype.interfaces import fsl
-from nipype.interfaces import niftyreg
 
+from mrproc.cache import CachedNode
+from mrproc.cache import apply_fingerprints
+from mrproc.nodes.fsl_nodes import create_rigid_registration_node
+from mrproc.nodes.fsl_nodes import create_transform_inversion_node
 from mrproc.nodes.mrtrix_nodes import create_tractography_node
+from mrproc.nodes.mrtrix_nodes import create_tractogram_merge_node
+from mrproc.nodes.mrtrix_nodes import create_sift_filtering_node
 from mrproc.nodes.mrtrix_nodes import create_tissue_classification_node
+from mrproc.nodes.custom_nodes import create_compression_report_node
+from mrproc.nodes.custom_nodes import create_connectome_node
+from mrproc.nodes.custom_nodes import create_diffusion_header_node
+from mrproc.nodes.custom_nodes import create_fod_stitch_node
+from mrproc.nodes.custom_nodes import create_mask_split_node
+from mrproc.nodes.custom_nodes import create_qc_node
+from mrproc.nodes.custom_nodes import create_tensor_fit_node
+from mrproc.nodes.custom_nodes import create_tractogram_compression_node
+from mrproc.nodes.custom_nodes import create_track_split_node
+
+# Diffusion to T1 registration modes, linear ones map to FLIRT degrees of freedom,
+# nonlinear ones to reg_f3d (cubic B-spline, or velocity field for diffeomorphic)
+REGISTRATION_MODES = ["rigid", "affine", "nonlinear", "diffeomorphic"]
+LINEAR_REGISTRATION_DOF = {"rigid": 6, "affine": 12}
+# Tensor fitting: MRtrix3 commands or in-process NumPy fit (FA only)
+TENSOR_BACKENDS = ["mrtrix", "numpy"]
+# Entry of the NIfTI diffusion series: copy into a .mif, -fslgrad on the original
+# file or .mih header over its voxels
+INGEST_MODES = ["convert", "fslgrad", "header"]
+# Tractography parameters a sweep can vary (see create_tractogram_generation_pipeline)
+SWEEP_FIELDS = ["nb_tracks", "min_length", "max_length", "seed", "algorithm"]
+# Number of streamlines of the tractogram of preview runs
+PREVIEW_TRACKS = 100000
+# Format of the intermediate volumes: compressed NIfTI, uncompressed NIfTI, .mif
+# where only MRtrix3 reads the volume
+INTERMEDIATE_FORMATS = ["nifti_gz", "nifti", "mif"]
+# Intermediate volumes by node name: file name input, file name stem, whether the
+# volume is only read by MRtrix3 commands
+INTERMEDIATE_FILES = {
+    "tissue_classif": ("out_file", "5tt", True),
+    "tensor2fa": ("out_fa", "fa", False),
+    "diffusion2fa": ("out_file", "fa", False),
+    "mask2nifti": ("out_file", "mask", False),
+    "reg_f3d": ("res_file", "t1_registered", False),
+}
+# Options of the diffusion processing workflows and their defaults (see
+# create_dwi_processing_pipeline)
+WORKFLOW_OPTIONS = {
+    "nb_shards": 1,
+    "sift_mode": "sift",
+    "term_number": None,
+    "term_ratio": None,
+    "term_mu": None,
+    "registration": "nonlinear",
+    "registration_resolution": 1.0,
+    "registration_levels": None,
+    "group_response": False,
+    "connectome": False,
+    "qc": False,
+    "tensor_backend": "mrtrix",
+    "ingest": "convert",
+    "compression_tolerance": None,
+    "compression_check": False,
+    "nb_slabs": 1,
+    "sweep": None,
+    "response_only": False,
+}
+# Options of the core workflow, which takes the diffusion series already ingested
+CORE_OPTIONS = [name for name in WORKFLOW_OPTIONS if name != "ingest"]
+# Options changing the stages up to the response estimation
+RESPONSE_OPTIONS = [
+    "registration",
+    "registration_resolution",
+    "registration_levels",
+    "tensor_backend",
+    "ingest",
+]
+# Pickled workflows keyed by builder and options (see _from_template)
+_TEMPLATES = {}
+# Fingerprint mode of the input files of each node, by node name (other nodes
+# follow the Nipype hash_method): nodes reading the 4D diffusion series or
+# tractograms sample their inputs rather than hashing their whole content
+FINGERPRINTS = {
+    "mrconvert": "sampled",
+    "diffusion_header": "sampled",
+    "diffusionbiascorrect": "sampled",
+    "diffusion2mask": "sampled",
+    "diffusion2tensor": "sampled",
+    "diffusion2fa": "sampled",
+    "diffusion2response": "sampled",
+    "diffusion2fod": "sampled",
+    "stitch_fods": "sampled",
+    "tractography": "sampled",
+    "merge_shards": "sampled",
+    "tractogram_compression": "sampled",
+    "compression_report": "sampled",
+    "sift_filtering": "sampled",
+    "reference_sift": "sampled",
+    "connectome": "sampled",
+    "qc": "sampled",
+}
+
+
+def _from_template(build, options):
+    """
+    Build a workflow once per set of options and return private copies of it
 
-# from mrproc.nodes.fsl_nodes import create_rigid_registration_node
-from mrproc.nodes.custom_nodes import create_sift_filtering_node
+    Copying the pickled template is much cheaper than rebuilding every node when
+    workflows are created for hundreds of subjects, and interfaces (MRtrix3, FSL,
+    NiftyReg) are only imported when a workflow is first built.
+    :param build: function building the workflow from a dict of options
+    :param options: dict of options, hashable values (see workflow_options)
+    :return: workflow, independent of the template and of previous copies
+    """
+    key = (build.__name__,) + tuple(sorted(options.items()))
+    if key not in _TEMPLATES:
+        _TEMPLATES[key] = pickle.dumps(
+            build(dict(options)), protocol=pickle.HIGHEST_PROTOCOL
+        )
+    return pickle.loads(_TEMPLATES[key])
+
+
+def workflow_options(options, names=None):
+    """
+    Check workflow options and complete them with their defaults
+    :param options: dict of options (WORKFLOW_OPTIONS, see
+    create_dwi_processing_pipeline)
+    :param names: accepted options, every WORKFLOW_OPTIONS if None
+    :return: dict of the accepted options, the sweep in its hashable form
+    """
+    names = list(WORKFLOW_OPTIONS) if names is None else names
+    unknown = sorted(set(options) - set(names))
+    if unknown:
+        raise TypeError("Unexpected workflow option %s" % ", ".join(unknown))
+    options = dict({name: WORKFLOW_OPTIONS[name] for name in names}, **options)
+    for name, modes in [("registration", REGISTRATION_MODES), ("ingest", INGEST_MODES)]:
+        if name in options and options[name] not in modes:
+            raise ValueError(
+                "Unknown %s mode %s (expected one of %s)"
+                % (name, options[name], ", ".join(modes))
+            )
+    if "sweep" in options:
+        options["sweep"] = normalize_sweep(options["sweep"])
+    return options
+
+
+def apply_intermediate_format(workflow, intermediate_format="nifti_gz"):
+    """
+    Set the format of the intermediate volumes of a workflow
+
+    The intermediate volumes written as NIfTI (5TT image, FA, FSL outputs...) are
+    compressed NIfTI (default), uncompressed NIfTI, or .mif for the volumes only
+    read by MRtrix3 (uncompressed NIfTI for the others). Skipping the compression
+    saves a gzip pass by the writer and a gunzip pass by every reader.
+    :param workflow: Nipype workflow (sub-workflows are processed recursively)
+    :param intermediate_format: one of INTERMEDIATE_FORMATS
+    :return: names of the configured nodes
+    """
+    from nipype.interfaces.fsl.base import FSLCommand
+
+    if intermediate_format not in INTERMEDIATE_FORMATS:
+        raise ValueError(
+            "Unknown intermediate format %s (expected one of %s)"
+            % (intermediate_format, ", ".join(INTERMEDIATE_FORMATS))
+        )
+    compressed = intermediate_format == "nifti_gz"
+    configured = []
+    for node_name in workflow.list_node_names():
+        node = workflow.get_node(node_name)
+        if isinstance(node.interface, FSLCommand):
+            node.inputs.output_type = "NIFTI_GZ" if compressed else "NIFTI"
+        elif node.name in INTERMEDIATE_FILES:
+            field, stem, mrtrix_only = INTERMEDIATE_FILES[node.name]
+            # reg_f3d names its resampled volume after the T1 volume (.nii.gz)
+            if compressed and node.name == "reg_f3d":
+                continue
+            if intermediate_format == "mif" and mrtrix_only:
+                extension = ".mif"
+            else:
+                extension = ".nii.gz" if compressed else ".nii"
+            setattr(node.inputs, field, stem + extension)
+        else:
+            continue
+        configured.append(node_name)
+    return configured
+
+
+def normalize_sweep(sweep):
+    """
+    Check a parameter grid and put it in a hashable form
+    :param sweep: None, dict or sequence of (field, values) pairs, fields among
+    SWEEP_FIELDS, a single value (string included) stands for a list of one value
+    :return: None, or tuple of (field, tuple of values) pairs in SWEEP_FIELDS order
+    """
+    if not sweep:
+        return None
+    grid = {}
+    for field, values in dict(sweep).items():
+        if field not in SWEEP_FIELDS:
+            raise ValueError(
+                "Unknown sweep parameter %s (expected one of %s)"
+                % (field, ", ".join(SWEEP_FIELDS))
+            )
+        if isinstance(values, str) or not hasattr(values, "__iter__"):
+            values = [values]
+        grid[field] = tuple(values)
+        if not grid[field]:
+            raise ValueError(
+                "Empty list of values to sweep for %s, give at least one value" % field
+            )
+    return tuple((field, grid[field]) for field in SWEEP_FIELDS if field in grid)
+
+
+def _create_sweep_node(sweep):
+    """
+    Node iterating over every combination of a parameter grid
+    :param sweep: parameter grid (see normalize_sweep)
+    :return: sweep node, whose fields are the swept parameters
+    """
+    fields = [field for field, _ in sweep]
+    combinations = list(itertools.product(*(values for _, values in sweep)))
+    sweep_node = pe.Node(utility.IdentityInterface(fields=fields), name="sweep")
+    # Synchronized iterables: one expansion per combination, not per value
+    sweep_node.iterables = [
+        (field, [combination[i] for combination in combinations])
+        for i, field in enumerate(fields)
+    ]
+    sweep_node.synchronize = True
+    return sweep_node
 
 
 def create_preprocessing_pipeline():
     """
     Bias correction and gross masking of a distortion corrected diffusion weighted volume
+
+    The gradient table is read from the header of the diffusion volume, or from
+    the bvals and bvecs inputnode fields when they are given (FSL format).
     :return:
     """
+    from nipype.interfaces import mrtrix3
 
     # Nodes in
     inputnode = pe.Node(
-        utility.IdentityInterface(fields=["diffusion_volume"], mandatory_inputs=False),
+        utility.IdentityInterface(
+            fields=["diffusion_volume", "bvals", "bvecs"], mandatory_inputs=False
+        ),
         name="inputnode",
     )
-    # Bias correction of the diffusion MRI data (for more quantitative approach)
+    # Bias correction of the diffusion MRI data (for more quantitative approach).
+    # The output name is explicit: upstream DWIBiasCorrect leaves out_file undefined
+    # otherwise, and the downstream nodes never receive the corrected volume
     diffusionbiascorrect = pe.Node(
-        interface=mrtrix3.preprocess.DWIBiasCorrect(use_ants=True),
+        interface=mrtrix3.preprocess.DWIBiasCorrect(
+            use_ants=True, out_file="dwi_biascorr.mif"
+        ),
         name="diffusionbiascorrect",
     )
     # Gross brain mask stemming from diffusion data
@@ -54,6 +295,8 @@ def create_preprocessing_pipeline():
     # Workflow connections
     preproc = pe.Workflow(name="preprocessing")
     preproc.connect(inputnode, "diffusion_volume", diffusionbiascorrect, "in_file")
+    preproc.connect(inputnode, "bvals", diffusionbiascorrect, "in_bval")
+    preproc.connect(inputnode, "bvecs", diffusionbiascorrect, "in_bvec")
     preproc.connect(diffusionbiascorrect, "out_file", diffusion2mask, "in_file")
     preproc.connect(
         diffusionbiascorrect, "out_file", outputnode, "corrected_diffusion_volume"
@@ -63,11 +306,21 @@ def create_preprocessing_pipeline():
     return preproc
 
 
-def create_tensor_pipeline():
+def create_tensor_pipeline(backend="mrtrix"):
     """
     Estimate diffusion tensor coefficients and compute FA
+    :param backend: "mrtrix" runs dwi2tensor and tensor2metric, "numpy" fits the
+    tensor in-process and writes the FA only (see mrproc.tensor), which saves two
+    command launches and the tensor image, tensor_coeff is then left undefined
     :return:
     """
+    from nipype.interfaces import mrtrix3
+
+    if backend not in TENSOR_BACKENDS:
+        raise ValueError(
+            "Unknown tensor backend %s (expected one of %s)"
+            % (backend, ", ".join(TENSOR_BACKENDS))
+        )
     # Nodes
     inputnode = pe.Node(
         utility.IdentityInterface(
@@ -75,6 +328,27 @@ def create_tensor_pipeline():
         ),
         name="inputnode",
     )
+    outputnode = pe.Node(
+        utility.IdentityInterface(
+            fields=["tensor_coeff", "fa"], mandatory_inputs=False
+        ),
+        name="outputnode",
+    )
+    tensor = pe.Workflow(name="tensor")
+    if backend == "numpy":
+        # FA written directly from the memory-mapped series
+        diffusion2fa = create_tensor_fit_node()
+        tensor.connect(
+            [
+                (
+                    inputnode,
+                    diffusion2fa,
+                    [("diffusion_volume", "diffusion_volume"), ("mask", "mask")],
+                ),
+                (diffusion2fa, outputnode, [("fa", "fa")]),
+            ]
+        )
+        return tensor
     # tensor coefficients estimation
     diffusion2tensor = pe.Node(
         interface=mrtrix3.reconst.FitTensor(), name="diffusion2tensor"
@@ -83,15 +357,8 @@ def create_tensor_pipeline():
     tensor2fa = pe.Node(
         interface=mrtrix3.TensorMetrics(out_fa="fa.nii.gz"), name="tensor2fa"
     )
-    outputnode = pe.Node(
-        utility.IdentityInterface(
-            fields=["tensor_coeff", "fa"], mandatory_inputs=False
-        ),
-        name="outputnode",
-    )
 
     # Workflow structure
-    tensor = pe.Workflow(name="tensor")
     tensor.connect(inputnode, "diffusion_volume", diffusion2tensor, "in_file")
     tensor.connect(inputnode, "mask", diffusion2tensor, "in_mask")
     tensor.connect(diffusion2tensor, "out_file", tensor2fa, "in_file")
@@ -101,77 +368,180 @@ def create_tensor_pipeline():
     return tensor
 
 
-def create_spherical_deconvolution_pipeline():
+def create_spherical_deconvolution_pipeline(group_response=False, nb_slabs=1, fod=True):
     """
     Estimate impulsional response and derived multi-shell multi tissue fiber
     orientation distribution (FOD)
+    :param group_response: if True, the responses are not estimated but read from
+    the wm_response, gm_response and csf_response inputnode fields (group average,
+    see mrproc.nodes.custom_nodes.average_responses)
+    :param nb_slabs: number of parallel FOD estimation jobs. The brain mask is
+    split into slabs of slices, the FODs are estimated on each slab and stitched
+    back into full volumes, identical to the ones of a single job (see
+    mrproc.slabs). The jobs are MapNode jobs and do not use the result store
+    :param fod: if False, only the responses are estimated (the wm_fod outputnode
+    field is left undefined)
     :return:
+
+    FODs are estimated within the brain mask (mask inputnode field).
     """
+    from nipype.interfaces import mrtrix3
 
+    if nb_slabs < 1:
+        raise ValueError("Number of slabs must be at least 1 (got %s)" % nb_slabs)
+    if group_response and not fod:
+        raise ValueError("Group responses are given, there is nothing to estimate")
     # Input and output nodes
     inputnode = pe.Node(
         utility.IdentityInterface(
-            fields=["diffusion_volume", "mask", "5tt_file"], mandatory_inputs=False
+            fields=[
+                "diffusion_volume",
+                "mask",
+                "5tt_file",
+                "wm_response",
+                "gm_response",
+                "csf_response",
+            ],
+            mandatory_inputs=False,
         ),
         name="inputnode",
     )
-    diffusion2response = pe.Node(
-        interface=mrtrix3.preprocess.ResponseSD(), name="diffusion2response"
-    )
-    diffusion2response.inputs.gm_file = "gm.txt"
-    diffusion2response.inputs.csf_file = "csf.txt"
-    diffusion2response.inputs.algorithm = "msmt_5tt"
+    if not group_response:
+        diffusion2response = CachedNode(
+            interface=mrtrix3.preprocess.ResponseSD(), name="diffusion2response"
+        )
+        diffusion2response.inputs.gm_file = "gm.txt"
+        diffusion2response.inputs.csf_file = "csf.txt"
+        diffusion2response.inputs.algorithm = "msmt_5tt"
 
     # Multi-shell multi tissue spherical deconvolution of the diffusion MRI data
-    diffusion2fod = pe.Node(
-        interface=mrtrix3.reconst.ConstrainedSphericalDeconvolution(),
-        name="diffusion2fod",
-    )
-    diffusion2fod.inputs.algorithm = "msmt_csd"
-    diffusion2fod.inputs.csf_odf = "csf.mif"
-    diffusion2fod.inputs.gm_odf = "gm.mif"
+    if fod and nb_slabs > 1:
+        split_mask = create_mask_split_node(nb_slabs)
+        diffusion2fod = pe.MapNode(
+            interface=mrtrix3.reconst.ConstrainedSphericalDeconvolution(),
+            iterfield=["mask_file"],
+            name="diffusion2fod",
+        )
+        stitch_fods = create_fod_stitch_node()
+    elif fod:
+        diffusion2fod = CachedNode(
+            interface=mrtrix3.reconst.ConstrainedSphericalDeconvolution(),
+            name="diffusion2fod",
+        )
+    if fod:
+        diffusion2fod.inputs.algorithm = "msmt_csd"
+        diffusion2fod.inputs.csf_odf = "csf.mif"
+        diffusion2fod.inputs.gm_odf = "gm.mif"
     outputnode = pe.Node(
-        utility.IdentityInterface(fields=["wm_fod"], mandatory_inputs=False),
+        utility.IdentityInterface(
+            fields=["wm_fod", "wm_response", "gm_response", "csf_response"],
+            mandatory_inputs=False,
+        ),
         name="outputnode",
     )
 
     # Workflow structure
     csd = pe.Workflow(name="msmt_csd")
+    response_fields = ["wm_response", "gm_response", "csf_response"]
+    if group_response:
+        source, source_fields = inputnode, response_fields
+    else:
+        csd.connect(
+            [
+                (
+                    inputnode,
+                    diffusion2response,
+                    [
+                        ("diffusion_volume", "in_file"),
+                        ("mask", "in_mask"),
+                        ("5tt_file", "mtt_file"),
+                    ],
+                )
+            ]
+        )
+        source = diffusion2response
+        source_fields = ["wm_file", "gm_file", "csf_file"]
+    csd.connect([(source, outputnode, list(zip(source_fields, response_fields)))])
+    if not fod:
+        return csd
     csd.connect(
         [
             (
-                inputnode,
-                diffusion2response,
-                [
-                    ("diffusion_volume", "in_file"),
-                    ("mask", "in_mask"),
-                    ("5tt_file", "mtt_file"),
-                ],
-            )
-        ]
-    )
-    csd.connect(
-        [
-            (
-                diffusion2response,
+                source,
                 diffusion2fod,
-                [("wm_file", "wm_txt"), ("gm_file", "gm_txt"), ("csf_file", "csf_txt")],
+                list(zip(source_fields, ["wm_txt", "gm_txt", "csf_txt"])),
             )
         ]
     )
     csd.connect(inputnode, "diffusion_volume", diffusion2fod, "in_file")
-    csd.connect(diffusion2fod, "wm_odf", outputnode, "wm_fod")
+    if nb_slabs > 1:
+        csd.connect(inputnode, "mask", split_mask, "mask")
+        csd.connect(split_mask, "slab_masks", diffusion2fod, "mask_file")
+        csd.connect(
+            [
+                (
+                    diffusion2fod,
+                    stitch_fods,
+                    [
+                        ("wm_odf", "wm_files"),
+                        ("gm_odf", "gm_files"),
+                        ("csf_odf", "csf_files"),
+                    ],
+                )
+            ]
+        )
+        csd.connect(split_mask, "bounds", stitch_fods, "bounds")
+        csd.connect(stitch_fods, "wm_odf", outputnode, "wm_fod")
+    else:
+        csd.connect(inputnode, "mask", diffusion2fod, "mask_file")
+        csd.connect(diffusion2fod, "wm_odf", outputnode, "wm_fod")
 
     return csd
 
 
-def create_tractogram_generation_pipeline():
+def create_tractogram_generation_pipeline(
+    nb_shards=1,
+    sift_mode="sift",
+    term_number=None,
+    term_ratio=None,
+    term_mu=None,
+    compression_tolerance=None,
+    compression_check=False,
+    sweep=None,
+):
     """
     Whole brain probabilistic anatomically constrained tractogram generation and
     sift filtering
+    :param nb_shards: number of parallel tractography jobs. The requested number of
+    streamlines is split across independently seeded shards whose tractograms are
+    concatenated before SIFT filtering (same streamline distribution as a single
+    job since streamlines are drawn independently)
+    :param sift_mode: "sift" outputs the filtered tractogram, "sift2" outputs the
+    unfiltered tractogram with one weight per streamline (tractogram_weights),
+    "none" outputs the unfiltered tractogram (preview runs)
+    :param term_number: number of streamlines kept by SIFT
+    :param term_ratio: SIFT termination ratio
+    :param term_mu: SIFT termination proportionality factor
+    :param compression_tolerance: if given, the vertices of the tractogram are
+    simplified within this distance (mm) before SIFT (see mrproc.compression), the
+    size reduction and a summary of the SIFT output are written to the
+    compression_report outputnode field
+    :param compression_check: if True, the uncompressed tractogram is filtered too
+    (reference_sift node, doubling the SIFT cost) and the report compares both
+    SIFT outputs (see mrproc.compression.compare_sift)
+    :param sweep: grid of tractography parameters (dict mapping SWEEP_FIELDS to
+    lists of values). The tractogram branch is expanded once per combination, its
+    nodes are laid out in one directory per parameter set
+    (_<field>_<value>..., Nipype iterables), swept parameters override the
+    inputnode fields
     :return:
+
+    The seed inputnode field sets the random seed of the tractography (of the first
+    shard, following shards use seed + i), draw independent replicates by changing
+    it.
     """
 
+    sweep = normalize_sweep(sweep)
     # Nodes in processing order
     inputnode = pe.Node(
         utility.IdentityInterface(
@@ -182,15 +552,56 @@ def create_tractogram_generation_pipeline():
                 "nb_tracks",
                 "min_length",
                 "max_length",
+                "seed",
             ],
             mandatory_inputs=False,
         ),
         name="inputnode",
     )
-    tractography = create_tractography_node()
-    sift_filtering = create_sift_filtering_node()
+    # Swept parameters are given by the sweep node, the others by the inputnode
+    sources = dict.fromkeys(
+        ["nb_tracks", "min_length", "max_length", "seed"], inputnode
+    )
+    if sweep is not None:
+        sweep_node = _create_sweep_node(sweep)
+        sources.update(dict.fromkeys(dict(sweep), sweep_node))
+    tractography = create_tractography_node(sharded=nb_shards > 1)
+    if sift_mode != "none":
+        sift_filtering = create_sift_filtering_node(
+            mode=sift_mode,
+            term_number=term_number,
+            term_ratio=term_ratio,
+            term_mu=term_mu,
+        )
+    elif (term_number, term_ratio, term_mu) != (None, None, None):
+        raise ValueError("SIFT termination criteria do not apply without SIFT")
+    if compression_tolerance is not None:
+        if compression_tolerance <= 0:
+            raise ValueError(
+                "Compression tolerance must be positive (got %s)"
+                % compression_tolerance
+            )
+        compression = create_tractogram_compression_node()
+        compression.inputs.tolerance = compression_tolerance
+        compression_report = create_compression_report_node()
+    if compression_check:
+        if compression_tolerance is None or sift_mode == "none":
+            raise ValueError(
+                "The compression check compares SIFT outputs, it requires a "
+                "compression tolerance and SIFT"
+            )
+        reference_sift = create_sift_filtering_node(
+            mode=sift_mode,
+            term_number=term_number,
+            term_ratio=term_ratio,
+            term_mu=term_mu,
+            name="reference_sift",
+        )
     outputnode = pe.Node(
-        utility.IdentityInterface(fields=["tractogram"], mandatory_inputs=False),
+        utility.IdentityInterface(
+            fields=["tractogram", "tractogram_weights", "compression_report"],
+            mandatory_inputs=False,
+        ),
         name="outputnode",
     )
 
@@ -207,48 +618,211 @@ def create_tractogram_generation_pipeline():
                     ("mask", "roi_mask"),
                     ("act_file", "act_file"),
                     ("mask", "seed_gmwmi"),
-                    ("nb_tracks", "select"),
-                    ("min_length", "min_length"),
-                    ("max_length", "max_length"),
                 ],
             )
         ]
     )
+    for field in ["min_length", "max_length"]:
+        tractogram_pipeline.connect(sources[field], field, tractography, field)
+    if "algorithm" in sources:
+        tractogram_pipeline.connect(
+            sources["algorithm"], "algorithm", tractography, "algorithm"
+        )
 
-    tractogram_pipeline.connect(
-        tractography, "out_file", sift_filtering, "input_tracks"
-    )
+    if nb_shards > 1:
+        split_tracks = create_track_split_node(nb_shards)
+        merge_shards = create_tractogram_merge_node()
+        tractogram_pipeline.connect(
+            sources["nb_tracks"], "nb_tracks", split_tracks, "nb_tracks"
+        )
+        tractogram_pipeline.connect(sources["seed"], "seed", split_tracks, "seed")
+        tractogram_pipeline.connect(
+            [
+                (
+                    split_tracks,
+                    tractography,
+                    [("shard_tracks", "select"), ("shard_seeds", "rng_seed")],
+                )
+            ]
+        )
+        tractogram_pipeline.connect(tractography, "out_file", merge_shards, "in_files")
+        tracks = (merge_shards, "out_file")
+    else:
+        tractogram_pipeline.connect(
+            sources["nb_tracks"], "nb_tracks", tractography, "select"
+        )
+        tractogram_pipeline.connect(sources["seed"], "seed", tractography, "rng_seed")
+        tracks = (tractography, "out_file")
+    if compression_check:
+        tractogram_pipeline.connect(*tracks, reference_sift, "in_file")
+        tractogram_pipeline.connect(
+            [
+                (
+                    inputnode,
+                    reference_sift,
+                    [("wm_fod", "in_fod"), ("act_file", "act_file")],
+                )
+            ]
+        )
+    if compression_tolerance is not None:
+        tractogram_pipeline.connect(*tracks, compression, "in_file")
+        tracks = (compression, "out_file")
+        tractogram_pipeline.connect(
+            compression, "statistics", compression_report, "statistics"
+        )
+        tractogram_pipeline.connect(
+            compression_report, "report", outputnode, "compression_report"
+        )
+    if sift_mode == "none":
+        tractogram_pipeline.connect(*tracks, outputnode, "tractogram")
+        return tractogram_pipeline
+    tractogram_pipeline.connect(*tracks, sift_filtering, "in_file")
     tractogram_pipeline.connect(
         [
             (
                 inputnode,
                 sift_filtering,
-                [("wm_fod", "wm_fod"), ("act_file", "act")],
+                [("wm_fod", "in_fod"), ("act_file", "act_file")],
             )
         ]
     )
-    tractogram_pipeline.connect(
-        sift_filtering, "filtered_tracks", outputnode, "tractogram"
-    )
+    if sift_mode == "sift2":
+        tractogram_pipeline.connect(*tracks, outputnode, "tractogram")
+        tractogram_pipeline.connect(
+            sift_filtering, "out_weights", outputnode, "tractogram_weights"
+        )
+        sift_output, report_input = "out_weights", "weights"
+    else:
+        tractogram_pipeline.connect(
+            sift_filtering, "out_file", outputnode, "tractogram"
+        )
+        sift_output, report_input = "out_file", "tractogram"
+    if compression_tolerance is not None:
+        # Summary of the SIFT output, to be compared with uncompressed runs
+        tractogram_pipeline.connect(
+            sift_filtering, sift_output, compression_report, report_input
+        )
+    if compression_check:
+        tractogram_pipeline.connect(
+            reference_sift,
+            sift_output,
+            compression_report,
+            "reference_" + report_input,
+        )
 
     return tractogram_pipeline
 
 
-def create_core_dwi_processing_pipeline():
+def create_connectome_pipeline(registration="nonlinear"):
+    """
+    Structural connectome of a tractogram: the parcellation (T1 space) is brought
+    into diffusion space with the T1 to diffusion transformation estimated by the
+    registration (nearest neighbour interpolation) and the streamline endpoints
+    are assigned to its parcels (see mrproc.connectome)
+    :param registration: registration mode the transform inputnode field comes
+    from (REGISTRATION_MODES): FLIRT matrix for the linear modes, NiftyReg control
+    point grid otherwise
+    :return:
+
+    The tractogram_weights inputnode field (SIFT2 weights) is optional, the
+    streamlines are counted without it.
     """
+    from nipype.interfaces import fsl
+    from nipype.interfaces import niftyreg
 
+    inputnode = pe.Node(
+        utility.IdentityInterface(
+            fields=[
+                "tractogram",
+                "tractogram_weights",
+                "parcellation",
+                "reference",
+                "transform",
+            ],
+            mandatory_inputs=False,
+        ),
+        name="inputnode",
+    )
+    if registration not in LINEAR_REGISTRATION_DOF:
+        parcellation2diffusion = pe.Node(
+            niftyreg.RegResample(inter_val="NN"), name="parcellation2diffusion"
+        )
+        fields = [
+            ("parcellation", "flo_file"),
+            ("reference", "ref_file"),
+            ("transform", "trans_file"),
+        ]
+    else:
+        parcellation2diffusion = pe.Node(
+            fsl.ApplyXFM(apply_xfm=True, interp="nearestneighbour"),
+            name="parcellation2diffusion",
+        )
+        parcellation2diffusion.inputs.output_type = "NIFTI_GZ"
+        fields = [
+            ("parcellation", "in_file"),
+            ("reference", "reference"),
+            ("transform", "in_matrix_file"),
+        ]
+    connectome = create_connectome_node()
+    outputnode = pe.Node(
+        utility.IdentityInterface(
+            fields=["connectome", "parcellation"], mandatory_inputs=False
+        ),
+        name="outputnode",
+    )
+
+    connectome_pipeline = pe.Workflow(name="connectome_pipeline")
+    connectome_pipeline.connect(
+        [
+            (inputnode, parcellation2diffusion, fields),
+            (
+                inputnode,
+                connectome,
+                [("tractogram", "tractogram"), ("tractogram_weights", "weights")],
+            ),
+            (parcellation2diffusion, connectome, [("out_file", "parcellation")]),
+            (parcellation2diffusion, outputnode, [("out_file", "parcellation")]),
+            (connectome, outputnode, [("connectome", "connectome")]),
+        ]
+    )
+
+    return connectome_pipeline
+
+
+def create_core_dwi_processing_pipeline(**options):
+    """
+    Diffusion processing workflow from the .mif diffusion series (inputnode field
+    diffusion_volume, with bvals and bvecs in "fslgrad" ingest mode)
+    :param options: workflow options but ingest (see create_dwi_processing_pipeline)
     :return:
     """
+    return _from_template(
+        _build_core_dwi_processing_pipeline, workflow_options(options, CORE_OPTIONS)
+    )
+
+
+def _build_core_dwi_processing_pipeline(options):
+    from nipype.interfaces import fsl
+    from nipype.interfaces import mrtrix3
+    from nipype.interfaces import niftyreg
+
     # Pipeline Nodes
     # Inputs params
     inputnode = pe.Node(
         utility.IdentityInterface(
             fields=[
                 "diffusion_volume",
+                "bvals",
+                "bvecs",
                 "t1_volume",
                 "nb_tracks",
                 "min_length",
                 "max_length",
+                "seed",
+                "wm_response",
+                "gm_response",
+                "csf_response",
+                "parcellation",
             ],
             mandatory_inputs=False,
         ),
@@ -257,25 +831,53 @@ def create_core_dwi_processing_pipeline():
     # Processing steps
     preprocessing = create_preprocessing_pipeline()
     # tensor and derived metrics (FA)
-    tensor = create_tensor_pipeline()
+    tensor = create_tensor_pipeline(backend=options["tensor_backend"])
     # t1 brain extraction
     bet = pe.Node(fsl.preprocess.BET(robust=True), name="bet")
     # tissue classification (T1 volume)
     tissue_classif = create_tissue_classification_node()
-    # rigid registration between diffusion and structural space
-    # rigid_registration = create_rigid_registration_node()
-    # fa (dwi space) upsampling to 1mm to ease rigid registration
-    resample_fa = pe.Node(fsl.preprocess.FLIRT(apply_isoxfm=1), name="resample_fa")
-    # apply rigid transformation
-    # applyxfm = pe.Node(fsl.preprocess.ApplyXFM(), name="applyxfm")
-    # inverse rigid transformation
-    # invxfm = pe.Node(fsl.utils.ConvertXFM(invert_xfm=True), name="invxfm")
-    # non rigid registration with
-    reg_f3d = pe.Node(niftyreg.RegF3D(), name="reg_f3d")
+    # fa (dwi space) resampling to ease the registration (1mm is roughly the T1
+    # resolution)
+    registration = options["registration"]
+    registration_resolution = options["registration_resolution"]
+    if registration_resolution is not None:
+        resample_fa = pe.Node(
+            fsl.preprocess.FLIRT(apply_isoxfm=registration_resolution),
+            name="resample_fa",
+        )
+    if registration not in LINEAR_REGISTRATION_DOF:
+        # non rigid registration, a velocity field also gives the backward
+        # (diffusion to T1) transformation
+        t1_registration = CachedNode(
+            niftyreg.RegF3D(vel_flag=registration == "diffeomorphic"), name="reg_f3d"
+        )
+        if options["registration_levels"] is not None:
+            t1_registration.inputs.lp_val = options["registration_levels"]
+    else:
+        # rigid or affine registration between structural and diffusion space
+        t1_registration = create_rigid_registration_node(
+            dof=LINEAR_REGISTRATION_DOF[registration], name="linear_registration"
+        )
+        # inverse transformation (diffusion to T1)
+        invxfm = create_transform_inversion_node()
     # Multi shell multi tissue spherical deconvolution
-    csd = create_spherical_deconvolution_pipeline()
+    csd = create_spherical_deconvolution_pipeline(
+        group_response=options["group_response"],
+        nb_slabs=options["nb_slabs"],
+        fod=not options["response_only"],
+    )
     # Whole brain anatomically constrained probabilistic tractogram
-    tractogram_pipeline = create_tractogram_generation_pipeline()
+    if not options["response_only"]:
+        tractogram_pipeline = create_tractogram_generation_pipeline(
+            nb_shards=options["nb_shards"],
+            sift_mode=options["sift_mode"],
+            term_number=options["term_number"],
+            term_ratio=options["term_ratio"],
+            term_mu=options["term_mu"],
+            compression_tolerance=options["compression_tolerance"],
+            compression_check=options["compression_check"],
+            sweep=options["sweep"],
+        )
     # Outputs params
     outputnode = pe.Node(
         utility.IdentityInterface(
@@ -283,7 +885,15 @@ def create_core_dwi_processing_pipeline():
                 "corrected_diffusion_volume",
                 "wm_fod",
                 "tractogram",
+                "tractogram_weights",
                 "diffusion_to_t1_transform",
+                "wm_response",
+                "gm_response",
+                "csf_response",
+                "connectome",
+                "qc_summary",
+                "qc_images",
+                "compression_report",
             ],
             mandatory_inputs=False,
         ),
@@ -292,7 +902,17 @@ def create_core_dwi_processing_pipeline():
     # mandatory steps of the diffusion pipeline (for the sake of modularity)
     core_pipeline = pe.Workflow(name="core_dwi_processing_pipeline")
     core_pipeline.connect(
-        inputnode, "diffusion_volume", preprocessing, "inputnode.diffusion_volume"
+        [
+            (
+                inputnode,
+                preprocessing,
+                [
+                    ("diffusion_volume", "inputnode.diffusion_volume"),
+                    ("bvals", "inputnode.bvals"),
+                    ("bvecs", "inputnode.bvecs"),
+                ],
+            )
+        ]
     )
     core_pipeline.connect(
         preprocessing,
@@ -307,18 +927,53 @@ def create_core_dwi_processing_pipeline():
         csd,
         "inputnode.diffusion_volume",
     )
-    # Upsample FA to 1mm which is roughly the T1 resolution
-    core_pipeline.connect(tensor, "outputnode.fa", resample_fa, "in_file")
-    core_pipeline.connect(tensor, "outputnode.fa", resample_fa, "reference")
-    # Estimate rigid transform (T1 --> FA directly)
+    # Resample FA to the registration resolution
+    if registration_resolution is not None:
+        core_pipeline.connect(tensor, "outputnode.fa", resample_fa, "in_file")
+        core_pipeline.connect(tensor, "outputnode.fa", resample_fa, "reference")
+        fa = (resample_fa, "out_file")
+    else:
+        fa = (tensor, "outputnode.fa")
+    # Estimate the transform (T1 --> FA directly)
     # brain masked T1 volume
     core_pipeline.connect(inputnode, "t1_volume", bet, "in_file")
-    core_pipeline.connect(bet, "out_file", reg_f3d, "flo_file")
-    core_pipeline.connect(resample_fa, "in_file", reg_f3d, "ref_file")
-    core_pipeline.connect(reg_f3d, "res_file", tissue_classif, "in_file")
+    if registration not in LINEAR_REGISTRATION_DOF:
+        core_pipeline.connect(bet, "out_file", t1_registration, "flo_file")
+        core_pipeline.connect(*fa, t1_registration, "ref_file")
+        core_pipeline.connect(t1_registration, "res_file", tissue_classif, "in_file")
+        registered_t1 = (t1_registration, "res_file")
+        if registration == "diffeomorphic":
+            core_pipeline.connect(
+                t1_registration, "invcpp_file", outputnode, "diffusion_to_t1_transform"
+            )
+        transform = (t1_registration, "cpp_file")
+    else:
+        core_pipeline.connect(bet, "out_file", t1_registration, "in_file")
+        core_pipeline.connect(*fa, t1_registration, "reference")
+        core_pipeline.connect(t1_registration, "out_file", tissue_classif, "in_file")
+        registered_t1 = (t1_registration, "out_file")
+        core_pipeline.connect(t1_registration, "out_matrix_file", invxfm, "in_file")
+        core_pipeline.connect(
+            invxfm, "out_file", outputnode, "diffusion_to_t1_transform"
+        )
+        transform = (t1_registration, "out_matrix_file")
 
     core_pipeline.connect(preprocessing, "outputnode.mask", csd, "inputnode.mask")
     core_pipeline.connect(tissue_classif, "out_file", csd, "inputnode.5tt_file")
+    for field in ["wm_response", "gm_response", "csf_response"]:
+        if options["group_response"]:
+            core_pipeline.connect(inputnode, field, csd, "inputnode." + field)
+        core_pipeline.connect(csd, "outputnode." + field, outputnode, field)
+    core_pipeline.connect(
+        preprocessing,
+        "outputnode.corrected_diffusion_volume",
+        outputnode,
+        "corrected_diffusion_volume",
+    )
+    if options["response_only"]:
+        apply_fingerprints(core_pipeline, FINGERPRINTS)
+        return core_pipeline
+
     core_pipeline.connect(
         csd, "outputnode.wm_fod", tractogram_pipeline, "inputnode.wm_fod"
     )
@@ -331,6 +986,7 @@ def create_core_dwi_processing_pipeline():
     core_pipeline.connect(
         inputnode, "max_length", tractogram_pipeline, "inputnode.max_length"
     )
+    core_pipeline.connect(inputnode, "seed", tractogram_pipeline, "inputnode.seed")
     core_pipeline.connect(
         tissue_classif, "out_file", tractogram_pipeline, "inputnode.act_file"
     )
@@ -341,18 +997,143 @@ def create_core_dwi_processing_pipeline():
     core_pipeline.connect(
         tractogram_pipeline, "outputnode.tractogram", outputnode, "tractogram"
     )
-    core_pipeline.connect(csd, "outputnode.wm_fod", outputnode, "wm_fod")
     core_pipeline.connect(
-        preprocessing,
-        "outputnode.corrected_diffusion_volume",
+        tractogram_pipeline,
+        "outputnode.tractogram_weights",
         outputnode,
-        "corrected_diffusion_volume",
+        "tractogram_weights",
     )
+    core_pipeline.connect(
+        tractogram_pipeline,
+        "outputnode.compression_report",
+        outputnode,
+        "compression_report",
+    )
+    core_pipeline.connect(csd, "outputnode.wm_fod", outputnode, "wm_fod")
+    if options["connectome"]:
+        # Structural connectome of the final tractogram
+        connectome_pipeline = create_connectome_pipeline(registration=registration)
+        core_pipeline.connect(
+            [
+                (
+                    inputnode,
+                    connectome_pipeline,
+                    [("parcellation", "inputnode.parcellation")],
+                ),
+                (
+                    tractogram_pipeline,
+                    connectome_pipeline,
+                    [
+                        ("outputnode.tractogram", "inputnode.tractogram"),
+                        (
+                            "outputnode.tractogram_weights",
+                            "inputnode.tractogram_weights",
+                        ),
+                    ],
+                ),
+                (
+                    connectome_pipeline,
+                    outputnode,
+                    [("outputnode.connectome", "connectome")],
+                ),
+            ]
+        )
+        core_pipeline.connect(*fa, connectome_pipeline, "inputnode.reference")
+        core_pipeline.connect(*transform, connectome_pipeline, "inputnode.transform")
+    if options["qc"]:
+        # Quality control images and summary, the mask is converted to NIfTI
+        mask2nifti = pe.Node(
+            mrtrix3.MRConvert(out_file="mask.nii.gz"), name="mask2nifti"
+        )
+        qc_node = create_qc_node()
+        core_pipeline.connect(
+            [
+                (preprocessing, mask2nifti, [("outputnode.mask", "in_file")]),
+                (mask2nifti, qc_node, [("out_file", "mask")]),
+                (tensor, qc_node, [("outputnode.fa", "fa")]),
+                (
+                    tractogram_pipeline,
+                    qc_node,
+                    [("outputnode.tractogram", "tractogram")],
+                ),
+                (
+                    qc_node,
+                    outputnode,
+                    [("summary", "qc_summary"), ("images", "qc_images")],
+                ),
+            ]
+        )
+        core_pipeline.connect(*fa, qc_node, "reference")
+        core_pipeline.connect(*registered_t1, qc_node, "registered_t1")
 
+    apply_fingerprints(core_pipeline, FINGERPRINTS)
     return core_pipeline
 
 
-def create_dwi_processing_pipeline():
+def create_dwi_processing_pipeline(**options):
+    """
+    Diffusion processing workflow from the NIfTI diffusion series, built from
+    keyword options whose defaults are the WORKFLOW_OPTIONS
+
+    The expensive stages (5TT, response and FOD estimation, registration) are
+    CachedNode nodes, which reuse results across runs once a ResultStore is
+    attached (see mrproc.cache.attach_result_store).
+    :param nb_shards: number of parallel tractography jobs
+    :param sift_mode: tractogram filtering mode ("sift" or "sift2")
+    :param term_number: number of streamlines kept by SIFT
+    :param term_ratio: SIFT termination ratio
+    :param term_mu: SIFT termination proportionality factor
+    :param registration: diffusion to T1 registration mode (REGISTRATION_MODES):
+    "rigid" (FLIRT, 6 degrees of freedom, minutes faster per subject), "affine"
+    (FLIRT, 12 degrees of freedom), "nonlinear" (NiftyReg reg_f3d, cubic B-spline)
+    or "diffeomorphic" (reg_f3d velocity field, slower). The
+    diffusion_to_t1_transform output is a FLIRT matrix for the linear modes, the
+    backward NiftyReg control point grid for the diffeomorphic mode; the
+    nonlinear mode gives none, reg_f3d does not invert its B-spline grid
+    :param registration_resolution: voxel size (mm) of the FA the T1 volume is
+    registered to, None keeps the diffusion resolution
+    :param registration_levels: number of pyramid levels performed by the
+    nonlinear registration (coarse to fine, default: all the levels of reg_f3d),
+    fewer levels stop at a coarser resolution
+    :param group_response: if True, the response functions are inputs of the
+    workflow (wm_response, gm_response and csf_response inputnode fields) instead
+    of being estimated for the subject, typically averaged over a subset of the
+    cohort processed with create_response_estimation_pipeline: FODs of the cohort
+    are then comparable
+    :param connectome: if True, the structural connectome of the tractogram is
+    computed from the parcellation inputnode field (T1 space)
+    :param qc: if True, quality control images and summary are written (qc_summary
+    and qc_images outputnode fields, see mrproc.qc)
+    :param tensor_backend: tensor fitting backend (TENSOR_BACKENDS, see
+    create_tensor_pipeline)
+    :param ingest: entry of the diffusion series (INGEST_MODES): "convert" copies
+    it into a .mif with its gradient table embedded (mrconvert), "fslgrad" gives
+    it as such, with bvals/bvecs, to the bias correction, "header" references its
+    voxels from a .mih header with the gradient table embedded (uncompressed NIfTI
+    only, see mrproc.io.mif.write_nifti_header). The last two modes save writing
+    and reading a full copy of the series
+    :param compression_tolerance: if given, the tractogram is compressed within
+    this distance (mm) before SIFT (see create_tractogram_generation_pipeline)
+    :param compression_check: if True, the uncompressed tractogram is filtered
+    too and the compression report compares both SIFT outputs
+    :param nb_slabs: number of parallel FOD estimation jobs (see
+    create_spherical_deconvolution_pipeline)
+    :param sweep: grid of tractography parameters (dict mapping SWEEP_FIELDS to
+    lists of values), only the tractogram branch and its consumers (connectome,
+    QC, outputnode) are expanded per combination, the upstream stages run once
+    (see create_tractogram_generation_pipeline). A DataSink connected with
+    parameterization=True lays the outputs out per parameter set
+    :param response_only: if True, the workflow stops after the response
+    estimation, the FOD estimation and the tractogram branch are left out (see
+    create_response_estimation_pipeline)
+    :return:
+    """
+    return _from_template(_build_dwi_processing_pipeline, workflow_options(options))
+
+
+def _build_dwi_processing_pipeline(options):
+    from nipype.interfaces import mrtrix3
+
     # Nodes
     inputnode = pe.Node(
         utility.IdentityInterface(
@@ -364,15 +1145,28 @@ def create_dwi_processing_pipeline():
                 "nb_tracks",
                 "min_length",
                 "max_length",
+                "seed",
+                "wm_response",
+                "gm_response",
+                "csf_response",
+                "parcellation",
             ],
             mandatory_inputs=False,
         ),
         name="inputnode",
     )
-    # Data conversion from .nii to .mif file (allows to embed diffusion bvals et bvecs)
-    mrconvert = pe.Node(interface=mrtrix3.MRConvert(), name="mrconvert")
+    ingest = options["ingest"]
+    if ingest == "convert":
+        # Data conversion from .nii to .mif file (allows to embed diffusion bvals et
+        # bvecs)
+        diffusion_entry = pe.Node(interface=mrtrix3.MRConvert(), name="mrconvert")
+    elif ingest == "header":
+        # .mih header over the NIfTI voxels, gradient table embedded
+        diffusion_entry = create_diffusion_header_node()
     # Main processing steps
-    core_pipeline = create_core_dwi_processing_pipeline()
+    core_pipeline = create_core_dwi_processing_pipeline(
+        **{name: options[name] for name in CORE_OPTIONS}
+    )
     # Outputs params
     outputnode = pe.Node(
         utility.IdentityInterface(
@@ -380,27 +1174,72 @@ def create_dwi_processing_pipeline():
                 "corrected_diffusion_volume",
                 "wm_fod",
                 "tractogram",
+                "tractogram_weights",
                 "diffusion_to_t1_transform",
+                "wm_response",
+                "gm_response",
+                "csf_response",
+                "connectome",
+                "qc_summary",
+                "qc_images",
+                "compression_report",
             ],
             mandatory_inputs=False,
         ),
         name="outputnode",
     )
 
-    dwi_processing_pipeline = pe.Workflow(name="dwi_processing_pipeline")
-    dwi_processing_pipeline.connect(
-        [
-            (
-                inputnode,
-                mrconvert,
-                [
-                    ("diffusion_volume", "in_file"),
-                    ("bvals", "in_bval"),
-                    ("bvecs", "in_bvec"),
-                ],
-            )
-        ]
-    )
+    if options["response_only"]:
+        dwi_processing_pipeline = pe.Workflow(name="response_estimation_pipeline")
+    else:
+        dwi_processing_pipeline = pe.Workflow(name="dwi_processing_pipeline")
+    if ingest == "convert":
+        dwi_processing_pipeline.connect(
+            [
+                (
+                    inputnode,
+                    diffusion_entry,
+                    [
+                        ("diffusion_volume", "in_file"),
+                        ("bvals", "in_bval"),
+                        ("bvecs", "in_bvec"),
+                    ],
+                )
+            ]
+        )
+    elif ingest == "header":
+        dwi_processing_pipeline.connect(
+            [
+                (
+                    inputnode,
+                    diffusion_entry,
+                    [
+                        ("diffusion_volume", "diffusion_volume"),
+                        ("bvals", "bvals"),
+                        ("bvecs", "bvecs"),
+                    ],
+                )
+            ]
+        )
+    if ingest == "fslgrad":
+        # The bias correction reads the NIfTI series and the FSL gradient table
+        dwi_processing_pipeline.connect(
+            [
+                (
+                    inputnode,
+                    core_pipeline,
+                    [
+                        ("diffusion_volume", "inputnode.diffusion_volume"),
+                        ("bvals", "inputnode.bvals"),
+                        ("bvecs", "inputnode.bvecs"),
+                    ],
+                )
+            ]
+        )
+    else:
+        dwi_processing_pipeline.connect(
+            diffusion_entry, "out_file", core_pipeline, "inputnode.diffusion_volume"
+        )
     dwi_processing_pipeline.connect(
         [
             (
@@ -411,13 +1250,11 @@ def create_dwi_processing_pipeline():
                     ("nb_tracks", "inputnode.nb_tracks"),
                     ("min_length", "inputnode.min_length"),
                     ("max_length", "inputnode.max_length"),
+                    ("seed", "inputnode.seed"),
                 ],
             )
         ]
     )
-    dwi_processing_pipeline.connect(
-        mrconvert, "out_file", core_pipeline, "inputnode.diffusion_volume"
-    )
     dwi_processing_pipeline.connect(
         core_pipeline,
         "outputnode.corrected_diffusion_volume",
@@ -430,15 +1267,96 @@ def create_dwi_processing_pipeline():
     dwi_processing_pipeline.connect(
         core_pipeline, "outputnode.tractogram", outputnode, "tractogram"
     )
+    dwi_processing_pipeline.connect(
+        core_pipeline,
+        "outputnode.tractogram_weights",
+        outputnode,
+        "tractogram_weights",
+    )
+    dwi_processing_pipeline.connect(
+        core_pipeline,
+        "outputnode.compression_report",
+        outputnode,
+        "compression_report",
+    )
     dwi_processing_pipeline.connect(
         core_pipeline,
         "outputnode.diffusion_to_t1_transform",
         outputnode,
         "diffusion_to_t1_transform",
     )
+    for field in ["wm_response", "gm_response", "csf_response"]:
+        if options["group_response"]:
+            dwi_processing_pipeline.connect(
+                inputnode, field, core_pipeline, "inputnode." + field
+            )
+        dwi_processing_pipeline.connect(
+            core_pipeline, "outputnode." + field, outputnode, field
+        )
+    if options["connectome"]:
+        dwi_processing_pipeline.connect(
+            inputnode, "parcellation", core_pipeline, "inputnode.parcellation"
+        )
+        dwi_processing_pipeline.connect(
+            core_pipeline, "outputnode.connectome", outputnode, "connectome"
+        )
+    if options["qc"]:
+        dwi_processing_pipeline.connect(
+            [
+                (
+                    core_pipeline,
+                    outputnode,
+                    [
+                        ("outputnode.qc_summary", "qc_summary"),
+                        ("outputnode.qc_images", "qc_images"),
+                    ],
+                )
+            ]
+        )
 
+    apply_fingerprints(dwi_processing_pipeline, FINGERPRINTS)
     return dwi_processing_pipeline
 
 
+def create_preview_pipeline(**options):
+    """
+    Preview profile of the diffusion processing workflow, which checks a subject
+    in minutes: PREVIEW_TRACKS streamlines (nb_tracks inputnode field), no SIFT
+    and lightweight QC artifacts (qc_summary and qc_images outputnode fields, see
+    mrproc.qc)
+
+    A full run launched with the same options in the same working directory
+    reuses every stage up to the tractography. registration="rigid" and
+    registration_resolution=None give the fastest preview, whose registration, 5TT
+    and CSD the full run then recomputes.
+    :param options: workflow options (see create_dwi_processing_pipeline),
+    sift_mode, compression_check and qc are set by the profile
+    :return:
+    """
+    workflow = create_dwi_processing_pipeline(
+        **dict(options, sift_mode="none", compression_check=False, qc=True)
+    )
+    workflow.get_node("inputnode").inputs.nb_tracks = PREVIEW_TRACKS
+    return workflow
+
+
+def create_response_estimation_pipeline(**options):
+    """
+    Diffusion processing workflow stopped after the response estimation (first
+    phase of the group response mode)
+
+    The wm_response, gm_response and csf_response outputnode fields hold the
+    response functions of the subject, the FOD estimation and the tractography are
+    left out.
+    :param options: workflow options (see create_dwi_processing_pipeline), only
+    the RESPONSE_OPTIONS are used
+    :return:
+    """
+    options = workflow_options(options)
+    return create_dwi_processing_pipeline(
+        response_only=True, **{name: options[name] for name in RESPONSE_OPTIONS}
+    )
+
+
 if __name__ == "__main__":
     pass
@@ -3,9 +3,13 @@
 from setuptools import setup, find_packages
 
 BASE_REQUIREMENTS = [
-    "nipype@git+https://github.com/GalBenZvi/nipype@patch-1#egg" "=nipype"
+    # Nipype >=1.8,<2.0, see mrproc.scratch.NIPYPE_VERSIONS
+    "nipype@git+https://github.com/GalBenZvi/nipype@patch-1#egg" "=nipype",
+    "numpy",
 ]
 DEV_REQUIREMENTS = ["black", "flake8", "pytest", "pytest-cov", "codecov"]
+# Per-node memory and thread sampling of the run reports (mrproc.instrumentation)
+MONITORING_REQUIREMENTS = ["psutil>=5.0"]
 
 
 setup(
@@ -18,7 +22,8 @@ setup(
     license="MIT",
     # python_requires='>=3.6',  # enforce Python 3.6 as minimum
     install_requires=BASE_REQUIREMENTS,
-    extras_require={"dev": DEV_REQUIREMENTS},
+    extras_require={"dev": DEV_REQUIREMENTS, "monitoring": MONITORING_REQUIREMENTS},
+    entry_points={"console_scripts": ["mrproc-batch=mrproc.cli:main"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,51 @@
+import nipype.pipeline.engine as pe
+import pytest
+from nipype.interfaces import utility
+from nipype.interfaces.utility import Function
+
+
+def add(value, increment):
+    return value + increment
+
+
+@pytest.fixture
+def add_node():
+    """
+    Factory of nodes adding their increment input (default 1) to their value,
+    MapNode nodes when an iterfield is given
+    """
+
+    def create(name, iterfield=None, **node_args):
+        interface = Function(
+            input_names=["value", "increment"], output_names=["out"], function=add
+        )
+        if iterfield is not None:
+            node = pe.MapNode(interface, iterfield=iterfield, name=name, **node_args)
+        else:
+            node = pe.Node(interface, name=name, **node_args)
+        node.inputs.increment = 1
+        return node
+
+    return create
+
+
+@pytest.fixture
+def subject_workflow():
+    """
+    Factory of workflows iterating over subjects, crash files are written to their
+    base directory
+    :return: function of (name, base_dir, subjects) returning the workflow and its
+    infosource node (subject_id iterable)
+    """
+
+    def create(name, base_dir, subjects):
+        infosource = pe.Node(
+            utility.IdentityInterface(fields=["subject_id"]), name="infosource"
+        )
+        infosource.iterables = ("subject_id", subjects)
+        workflow = pe.Workflow(name=name, base_dir=str(base_dir))
+        workflow.config["execution"]["crashdump_dir"] = str(base_dir)
+        workflow.add_nodes([infosource])
+        return workflow, infosource
+
+    return create
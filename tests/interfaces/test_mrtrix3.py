@@ -0,0 +1,19 @@
+from mrproc.interfaces.mrtrix3 import TCKEdit
+from mrproc.interfaces.mrtrix3 import Tractography
+
+
+def test_tractography_rng_seed():
+    tractography = Tractography()
+    assert "MRTRIX_RNG_SEED" not in tractography._get_environ()
+    tractography.inputs.rng_seed = 3
+    assert tractography._get_environ()["MRTRIX_RNG_SEED"] == "3"
+
+
+def test_tckedit_cmdline(tmp_path):
+    shards = []
+    for i in range(2):
+        shard = tmp_path / ("shard%d.tck" % i)
+        shard.write_text("")
+        shards.append(str(shard))
+    merge = TCKEdit(in_files=shards)
+    assert merge.cmdline == "tckedit %s %s edited.tck" % tuple(shards)
@@ -0,0 +1,109 @@
+import nibabel
+import numpy as np
+import pytest
+
+from mrproc.io.mif import MifFile
+from mrproc.io.mif import fsl_gradient_table
+from mrproc.io.mif import write_diffusion_header
+from mrproc.io.mif import write_mif
+
+AFFINE = np.array([[2.0, 0, 0, -10], [0, 2.0, 0, -20], [0, 0, 2.5, 5], [0, 0, 0, 1]])
+
+
+def _write_raw(path, header_lines, payload):
+    text = "\n".join(["mrtrix image"] + header_lines) + "\n"
+    offset = len(text) + len("file: . 000\nEND\n")
+    text += "file: . %03d\nEND\n" % offset
+    with open(path, "wb") as f:
+        f.write(text.encode("latin-1") + payload)
+    return str(path)
+
+
+def test_round_trip(tmp_path):
+    data = np.random.default_rng(0).normal(size=(4, 5, 3, 6)).astype(np.float32)
+    scheme = "\n".join("0,0,1,%d" % b for b in [0, 1000, 1000, 1000, 2000, 2000])
+    path = write_mif(str(tmp_path / "dwi.mif"), data, AFFINE, {"dw_scheme": scheme})
+    image = MifFile(path)
+    assert image.shape == (4, 5, 3, 6)
+    np.testing.assert_array_equal(image.data, data)
+    np.testing.assert_allclose(image.affine, AFFINE)
+    assert image.vox == (2.0, 2.0, 2.5)
+    assert image.dw_scheme.shape == (6, 4)
+
+
+def test_layout(tmp_path):
+    data = np.arange(24, dtype="<i2").reshape(2, 3, 4)
+    # Volume-like axis 2 fastest, axis 0 stored reversed
+    stored = data[::-1]
+    path = _write_raw(
+        tmp_path / "layout.mif",
+        [
+            "dim: 2,3,4",
+            "vox: 1,1,1",
+            "layout: -2,+1,+0",
+            "datatype: Int16LE",
+            "transform: 1,0,0,0",
+            "transform: 0,1,0,0",
+            "transform: 0,0,1,0",
+            "scaling: 1,2",
+        ],
+        np.ascontiguousarray(stored).tobytes(),
+    )
+    np.testing.assert_array_equal(MifFile(path).data, data * 2 + 1)
+
+
+def test_bit_image_and_mih(tmp_path):
+    mask = np.zeros((3, 3, 2), dtype=bool)
+    mask[1, :, 1] = True
+    (tmp_path / "mask.dat").write_bytes(np.packbits(mask.flatten(order="F")).tobytes())
+    header = tmp_path / "mask.mih"
+    header.write_text(
+        "mrtrix image\ndim: 3,3,2\nvox: 1,1,1\nlayout: +0,+1,+2\ndatatype: Bit\n"
+        "transform: 1,0,0,0\ntransform: 0,1,0,0\ntransform: 0,0,1,0\n"
+        "file: mask.dat 0\nEND\n"
+    )
+    np.testing.assert_array_equal(MifFile(str(header)).data, mask)
+
+
+def test_not_an_image(tmp_path):
+    (tmp_path / "image.mif").write_text("mrtrix tracks\nEND\n")
+    with pytest.raises(ValueError, match="not a MRtrix3 image"):
+        MifFile(str(tmp_path / "image.mif"))
+
+
+def test_fsl_gradient_table(tmp_path):
+    (tmp_path / "dwi.bval").write_text("0 1000 1000\n")
+    (tmp_path / "dwi.bvec").write_text("0 1 0\n0 0 1\n0 0 0\n")
+    bvals, bvecs = str(tmp_path / "dwi.bval"), str(tmp_path / "dwi.bvec")
+    # Radiological storage: the bvecs frame is the voxel frame
+    scheme = fsl_gradient_table(bvals, bvecs, np.diag([-2.0, 2.0, 2.0, 1.0]))
+    np.testing.assert_allclose(
+        scheme, [[0, 0, 0, 0], [-1, 0, 0, 1000], [0, 1, 0, 1000]]
+    )
+    # Neurological storage: the first axis is flipped
+    scheme = fsl_gradient_table(bvals, bvecs, AFFINE)
+    np.testing.assert_allclose(scheme[1:, :3], [[-1, 0, 0], [0, 1, 0]])
+    # Axes swapped by the transformation
+    swap = np.array([[0, 2.0, 0, 0], [2.0, 0, 0, 0], [0, 0, 2.0, 0], [0, 0, 0, 1]])
+    scheme = fsl_gradient_table(bvals, bvecs, swap)
+    np.testing.assert_allclose(scheme[1:, :3], [[0, 1, 0], [1, 0, 0]])
+    with pytest.raises(ValueError, match="gradient directions"):
+        fsl_gradient_table(str(tmp_path / "dwi.bval"), bvals, AFFINE)
+
+
+def test_write_diffusion_header(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = np.arange(4 * 3 * 2 * 3, dtype="<i2").reshape(4, 3, 2, 3)
+    image = nibabel.Nifti1Image(data, AFFINE)
+    image.header.set_slope_inter(0.5, 10)
+    nibabel.save(image, "dwi.nii")
+    (tmp_path / "dwi.bval").write_text("0 1000 1000\n")
+    (tmp_path / "dwi.bvec").write_text("0 1 0\n0 0 1\n0 0 0\n")
+    header = MifFile(write_diffusion_header("dwi.nii", "dwi.bval", "dwi.bvec"))
+    assert header.data_file == str(tmp_path / "dwi.nii")
+    np.testing.assert_allclose(header.data, data * 0.5 + 10)
+    np.testing.assert_allclose(header.affine, AFFINE)
+    assert header.dw_scheme.shape == (3, 4)
+    nibabel.save(image, "dwi.nii.gz")
+    with pytest.raises(ValueError, match="uncompressed"):
+        write_diffusion_header("dwi.nii.gz", "dwi.bval", "dwi.bvec")
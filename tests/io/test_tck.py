@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from mrproc.io.tck import TckFile
+from mrproc.io.tck import TckWriter
+from mrproc.io.tck import chunk_streamlines
+from mrproc.io.tck import concatenate
+
+
+def _random_streamlines(nb_streamlines, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        rng.normal(size=(n, 3)).astype(np.float32)
+        for n in rng.integers(2, 50, size=nb_streamlines)
+    ]
+
+
+def _write(path, streamlines, header=None):
+    with TckWriter(str(path), header=header) as writer:
+        writer.write_streamlines(streamlines)
+    return str(path)
+
+
+def test_round_trip_by_chunks(tmp_path):
+    streamlines = _random_streamlines(1000)
+    path = _write(tmp_path / "tracks.tck", streamlines, header={"step_size": "0.5"})
+    tck = TckFile(path)
+    assert tck.count == 1000
+    assert tck.header["step_size"] == "0.5"
+    chunks = list(tck.iter_chunks(chunk_size=128, block_size=100))
+    assert [len(lengths) for _, lengths in chunks[:-1]] == [128] * 7
+    read = [s for points, lengths in chunks for s in chunk_streamlines(points, lengths)]
+    assert len(read) == len(streamlines)
+    for expected, actual in zip(streamlines, read):
+        np.testing.assert_array_equal(expected, actual)
+
+
+def test_readable_by_nibabel(tmp_path):
+    nibabel = pytest.importorskip("nibabel")
+    streamlines = _random_streamlines(50)
+    path = _write(tmp_path / "tracks.tck", streamlines)
+    tractogram = nibabel.streamlines.load(path)
+    assert int(tractogram.header["count"]) == 50
+    np.testing.assert_allclose(tractogram.streamlines[7], streamlines[7], atol=1e-6)
+
+
+def test_empty_tractogram(tmp_path):
+    path = _write(tmp_path / "empty.tck", [])
+    tck = TckFile(path)
+    assert tck.count == 0
+    assert list(tck.iter_chunks()) == []
+
+
+def test_concatenate(tmp_path):
+    first = _write(tmp_path / "a.tck", _random_streamlines(30, seed=1))
+    second = _write(tmp_path / "b.tck", _random_streamlines(20, seed=2))
+    out = str(tmp_path / "merged.tck")
+    assert concatenate([first, second], out, chunk_size=7) == 50
+    merged = list(TckFile(out).iter_streamlines())
+    np.testing.assert_array_equal(merged[30], _random_streamlines(20, seed=2)[0])
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from mrproc.nodes.custom_nodes import average_responses
+
+
+def _write_responses(directory, scale):
+    files = []
+    for tissue in ["wm", "gm", "csf"]:
+        path = directory / ("%s_%s.txt" % (tissue, scale))
+        path.write_text(
+            "# Shells: 0,1000\n# command_history: dwi2response\n"
+            + "%f 0 0\n%f %f 0\n" % (scale, scale / 2, -scale / 4)
+        )
+        files.append(str(path))
+    return files
+
+
+def test_average_responses(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first, second = _write_responses(tmp_path, 1.0), _write_responses(tmp_path, 3.0)
+    wm_file, gm_file, csf_file = average_responses(*zip(first, second))
+    np.testing.assert_allclose(np.loadtxt(wm_file), [[2.0, 0, 0], [1.0, -0.5, 0]])
+    header = open(gm_file).read().splitlines()[0]
+    assert header == "# Shells: 0,1000"
+
+
+def test_average_responses_different_shells(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = _write_responses(tmp_path, 1.0)
+    other = tmp_path / "single_shell.txt"
+    other.write_text("1 0 0\n")
+    with pytest.raises(ValueError, match="Inconsistent wm response"):
+        average_responses([first[0], str(other)], [first[1]] * 2, [first[2]] * 2)
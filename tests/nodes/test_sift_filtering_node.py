@@ -1,10 +1,40 @@
-from mrproc.nodes.custom_nodes import create_sift_filtering_node
+import pytest
 
-sift_node = create_sift_filtering_node()
-sift_node.inputs.input_tracks = "/home/alex/recherche/tests/diffusion_pipeline/core_diffusion_pipeline/tractogram_pipeline/tractography/tracked.tck"
-sift_node.inputs.wm_fod = "/home/alex/recherche/tests/diffusion_pipeline/core_diffusion_pipeline/msmt_csd/diffusion2fod/wm.mif"
-sift_node.inputs.filtered_tracks = (
-    "/home/alex/recherche/tests/nodes/default_filtered_tracks_node.tck"
-)
+from mrproc.interfaces.mrtrix3 import TCKSift
+from mrproc.interfaces.mrtrix3 import TCKSift2
+from mrproc.nodes.mrtrix_nodes import create_sift_filtering_node
+from mrproc.workflows.dwi_processing import create_tractogram_generation_pipeline
 
-sift_node.run()
+
+def test_create_sift_filtering_node():
+    sift_node = create_sift_filtering_node()
+    assert isinstance(sift_node.interface, TCKSift)
+    assert sift_node.inputs.out_file == "filtered.tck"
+    sift2_node = create_sift_filtering_node(mode="sift2")
+    assert isinstance(sift2_node.interface, TCKSift2)
+    with pytest.raises(ValueError):
+        create_sift_filtering_node(mode="sift3")
+
+
+def test_sift2_tractogram_pipeline():
+    pipeline = create_tractogram_generation_pipeline(sift_mode="sift2")
+    tractography = pipeline.get_node("tractography")
+    outputnode = pipeline.get_node("outputnode")
+    sources = {
+        (u.name, v.name): data["connect"]
+        for u, v, data in pipeline._graph.edges(data=True)
+    }
+    assert ("out_file", "tractogram") in sources[(tractography.name, outputnode.name)]
+    assert ("out_weights", "tractogram_weights") in sources[
+        ("sift_filtering", "outputnode")
+    ]
+
+
+def test_sift_termination_criteria():
+    sift_node = create_sift_filtering_node(term_number=1000000, term_ratio=0.1)
+    assert sift_node.inputs.term_number == 1000000
+    assert sift_node.inputs.term_ratio == 0.1
+    with pytest.raises(ValueError):
+        create_sift_filtering_node(mode="sift2", term_mu=0.5)
+    pipeline = create_tractogram_generation_pipeline(term_mu=0.5)
+    assert pipeline.get_node("sift_filtering").inputs.term_mu == 0.5
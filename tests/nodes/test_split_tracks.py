@@ -0,0 +1,14 @@
+from mrproc.nodes.custom_nodes import split_tracks
+
+
+def test_split_tracks():
+    shard_tracks, shard_seeds = split_tracks(10000003, 4, 7)
+    assert sum(shard_tracks) == 10000003
+    assert max(shard_tracks) - min(shard_tracks) <= 1
+    assert shard_seeds == [7, 8, 9, 10]
+
+
+def test_split_tracks_more_shards_than_tracks():
+    shard_tracks, shard_seeds = split_tracks(2, 4, 0)
+    assert shard_tracks == [1, 1]
+    assert len(shard_seeds) == 2
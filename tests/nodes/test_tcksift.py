@@ -1,10 +1,32 @@
-from mrproc.nodes.custom_nodes import tcksift
+from mrproc.interfaces.mrtrix3 import TCKSift
+from mrproc.interfaces.mrtrix3 import TCKSift2
 
-input_tracks = (
-    "/home/alex/recherche/tests/diffusion_pipeline/core_diffusion_pipeline"
-    "/tractogram_pipeline/tractography/tracked.tck"
-)
-wm_fod = "/home/alex/recherche/tests/diffusion_pipeline/core_diffusion_pipeline/msmt_csd/diffusion2fod/wm.mif"
-filtered_tracks = "/home/alex/recherche/tests/nodes/default_filtered_tracks.tck"
 
-tcksift(input_tracks, wm_fod, filtered_tracks)
+def _touch(tmp_path, name):
+    path = tmp_path / name
+    path.write_text("")
+    return str(path)
+
+
+def test_tcksift_cmdline(tmp_path):
+    input_tracks = _touch(tmp_path, "tracked.tck")
+    wm_fod = _touch(tmp_path, "wm.mif")
+    act = _touch(tmp_path, "5tt.nii.gz")
+    sift = TCKSift(in_file=input_tracks, in_fod=wm_fod, act_file=act)
+    sift.inputs.nthreads = 8
+    sift.inputs.term_number = 1000000
+    assert sift.cmdline == (
+        "tcksift -act %s -nthreads 8 -term_number 1000000 %s %s filtered.tck"
+        % (act, input_tracks, wm_fod)
+    )
+    assert sift._list_outputs()["out_file"].endswith("filtered.tck")
+
+
+def test_tcksift2_cmdline(tmp_path):
+    input_tracks = _touch(tmp_path, "tracked.tck")
+    wm_fod = _touch(tmp_path, "wm.mif")
+    sift2 = TCKSift2(in_file=input_tracks, in_fod=wm_fod)
+    assert sift2.cmdline == "tcksift2 %s %s sift2_weights.txt" % (
+        input_tracks,
+        wm_fod,
+    )
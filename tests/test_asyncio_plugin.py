@@ -0,0 +1,119 @@
+import os
+import threading
+
+import nipype.pipeline.engine as pe
+import pytest
+from nipype.interfaces.base import CommandLine
+from nipype.interfaces.base import core
+from nipype.interfaces.utility import Function
+from nipype.utils.subprocess import run_command
+
+from mrproc.asyncio_plugin import AsyncioPlugin
+
+
+def to_text(value):
+    return str(value)
+
+
+def fail(value):
+    raise RuntimeError("node fails")
+
+
+@pytest.fixture
+def create_workflow(subject_workflow, add_node):
+    """Factory of workflows mixing Python steps, a MapNode and a command line node"""
+
+    def create(base_dir, subjects, extra=None):
+        workflow, infosource = subject_workflow("asyncio", base_dir, subjects)
+        first = add_node("first")
+        mapped = add_node("mapped", iterfield=["increment"])
+        mapped.inputs.increment = [1, 2, 3]
+        command = pe.Node(CommandLine("echo"), name="command")
+        command.inputs.args = "progress; echo warning >&2"
+        workflow.connect(infosource, "subject_id", first, "value")
+        workflow.connect(first, "out", mapped, "value")
+        workflow.connect(infosource, ("subject_id", to_text), command, "args")
+        if extra is not None:
+            workflow.connect(mapped, "out", extra, "value")
+        return workflow
+
+    return create
+
+
+def test_asyncio_plugin(tmp_path, create_workflow):
+    workflow = create_workflow(tmp_path, [1, 10])
+    graph = workflow.run(plugin=AsyncioPlugin(plugin_args={"n_procs": 2}))
+
+    results = {
+        node.itername: node.result.outputs
+        for node in graph.nodes()
+        if node.name in ["mapped", "command"]
+    }
+    assert results["asyncio.mapped.a0"].out == [3, 4, 5]
+    assert results["asyncio.mapped.a1"].out == [12, 13, 14]
+    command_dirs = [
+        root for root, dirs, _ in os.walk(tmp_path) if root.endswith("command")
+    ]
+    assert len(command_dirs) == 2
+    for directory in command_dirs:
+        subject = directory.split("_subject_id_")[1].split(os.sep)[0]
+        with open(os.path.join(directory, "_report", "stdout.log")) as f:
+            assert f.read() == subject + "\n"
+    # Commands are run by the plugin only while it executes a workflow
+    assert core.run_command is run_command
+
+
+def test_asyncio_plugin_scoped_commands(tmp_path, monkeypatch, create_workflow):
+    commands = []
+
+    def patched_run_command(runtime, **kwargs):
+        commands.append(runtime.cmdline)
+        return run_command(runtime, **kwargs)
+
+    monkeypatch.setattr(core, "run_command", patched_run_command)
+    graphs = {}
+
+    def run(name):
+        workflow = create_workflow(tmp_path / name, [1, 2])
+        graphs[name] = workflow.run(plugin=AsyncioPlugin(plugin_args={"n_procs": 2}))
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in ["a", "b"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(graphs) == ["a", "b"]
+    # The commands of the plugin nodes never reach the replaced run_command,
+    # which is back in place once both runs are over
+    assert commands == []
+    assert core.run_command is patched_run_command
+    CommandLine("echo", args="outside", terminal_output="allatonce").run()
+    assert commands == ["echo outside"]
+
+
+def test_asyncio_plugin_command_streams(tmp_path):
+    command = pe.Node(CommandLine("echo"), name="command", base_dir=str(tmp_path))
+    command.inputs.args = "progress; echo warning >&2; exit 3"
+    workflow = pe.Workflow(name="streams", base_dir=str(tmp_path))
+    workflow.config["execution"]["crashdump_dir"] = str(tmp_path)
+    workflow.add_nodes([command])
+    with pytest.raises(RuntimeError, match="command"):
+        workflow.run(plugin=AsyncioPlugin())
+    directory = tmp_path / "streams" / "command"
+    assert (directory / "_report" / "stdout.log").read_text() == "progress\n"
+    assert (directory / "_report" / "stderr.log").read_text() == "warning\n"
+    assert len(list(tmp_path.glob("crash-*.pklz"))) == 1
+
+
+def test_asyncio_plugin_failure(tmp_path, create_workflow, add_node):
+    failing = pe.Node(
+        Function(input_names=["value"], output_names=["out"], function=fail),
+        name="failing",
+    )
+    workflow = create_workflow(tmp_path, [1], extra=failing)
+    after = add_node("after")
+    workflow.connect(failing, "out", after, "value")
+    with pytest.raises(RuntimeError, match="node fails"):
+        workflow.run(plugin=AsyncioPlugin())
+    assert not list(tmp_path.rglob("result_after.pklz"))
+    assert list(tmp_path.rglob("result_command.pklz"))
@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+
+import nibabel
+
+from benchmarks.run_benchmarks import REPO_ROOT
+from benchmarks.run_benchmarks import benchmark_import
+from benchmarks.run_benchmarks import compare
+from benchmarks.stubs import install_stubs
+from benchmarks.synthetic import make_dataset
+from mrproc.workflows.batch import read_manifest
+
+
+def test_install_stubs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    env = install_stubs(str(tmp_path / "bin"), {"tckgen": {"output_mb": 0.01}})
+    out_file = tmp_path / "tracks.tck"
+    subprocess.run(
+        ["tckgen", "fod.mif", str(out_file)],
+        env=dict(os.environ, **env),
+        check=True,
+    )
+    assert out_file.stat().st_size == int(0.01 * 1024**2)
+    # every missing argument with an output extension is written
+    assert (tmp_path / "fod.mif").exists()
+
+
+def test_make_dataset(tmp_path):
+    subjects = read_manifest(make_dataset(str(tmp_path / "a"), 2))
+    assert [subject["subject_id"] for subject in subjects] == [
+        "sub-0000",
+        "sub-0001",
+    ]
+    assert nibabel.load(subjects[0]["diffusion_volume"]).shape == (8, 8, 4, 7)
+    # the content of a subject does not depend on the interpreter hash seed
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from benchmarks.synthetic import make_dataset; "
+            "make_dataset(%r, 1)" % str(tmp_path / "b"),
+        ],
+        env=dict(os.environ, PYTHONHASHSEED="1", PYTHONPATH=REPO_ROOT),
+        check=True,
+    )
+    other = read_manifest(str(tmp_path / "b" / "subjects.tsv"))
+    assert (
+        nibabel.load(subjects[0]["diffusion_volume"]).get_fdata()
+        == nibabel.load(other[0]["diffusion_volume"]).get_fdata()
+    ).all()
+
+
+def test_compare():
+    baseline = {"10": {"run": 1.0, "expand": 0.01, "nb_nodes": 100}}
+    results = {"10": {"run": 1.5, "expand": 0.04, "nb_nodes": 200}}
+    assert compare(results, baseline, tolerance=0.25) == [("10", "run", 1.0, 1.5)]
+    assert compare(results, baseline, tolerance=0.6) == []
+
+
+def test_benchmark_import_outside_repository(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert benchmark_import(repeat=1)["import"] > 0
@@ -0,0 +1,159 @@
+import os
+
+import pytest
+from nipype.interfaces.base import BaseInterfaceInputSpec
+from nipype.interfaces.base import File
+from nipype.interfaces.base import SimpleInterface
+from nipype.interfaces.base import TraitedSpec
+from nipype.interfaces.base import traits
+
+from mrproc.cache import CachedNode
+from mrproc.cache import ResultStore
+from mrproc.cache import apply_fingerprints
+from mrproc.cache import attach_result_store
+from mrproc.cache import fingerprint_file
+from mrproc.workflows.dwi_processing import create_dwi_processing_pipeline
+
+
+class UpperCaseInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True)
+    out_file = File("upper.txt", usedefault=True)
+    nthreads = traits.Int()
+
+
+class UpperCaseOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class UpperCase(SimpleInterface):
+    input_spec = UpperCaseInputSpec
+    output_spec = UpperCaseOutputSpec
+
+    def _run_interface(self, runtime):
+        out_file = os.path.join(runtime.cwd, self.inputs.out_file)
+        with open(self.inputs.in_file) as f, open(out_file, "w") as g:
+            g.write(f.read().upper())
+        self._results["out_file"] = out_file
+        return runtime
+
+
+def _node(store, in_file, base_dir):
+    node = CachedNode(UpperCase(), name="upper_case", result_store=store)
+    node.inputs.in_file = in_file
+    node.base_dir = base_dir
+    return node
+
+
+def test_result_shared_across_directories(tmp_path):
+    store = ResultStore(str(tmp_path / "store"))
+    for run in ["a", "b"]:
+        (tmp_path / run).mkdir()
+        (tmp_path / run / "t1.txt").write_text("same content")
+    first = _node(store, str(tmp_path / "a" / "t1.txt"), str(tmp_path / "a")).run()
+    assert not hasattr(first.runtime, "result_store_key")
+    second = _node(store, str(tmp_path / "b" / "t1.txt"), str(tmp_path / "b")).run()
+    assert second.runtime.result_store_key
+    assert second.outputs.out_file.startswith(str(tmp_path / "b"))
+    with open(second.outputs.out_file) as f:
+        assert f.read() == "SAME CONTENT"
+
+
+def test_sampled_key_ignores_modification_time(tmp_path):
+    store = ResultStore(str(tmp_path / "store"))
+    for i, run in enumerate(["a", "b"]):
+        (tmp_path / run).mkdir()
+        # upstream output regenerated with the same content by a rerun
+        in_file = tmp_path / run / "dwi_biascorr.mif"
+        in_file.write_text("same content")
+        os.utime(in_file, ns=(i, i))
+        node = _node(store, str(in_file), str(tmp_path / run))
+        node.fingerprint = "sampled"
+        result = node.run()
+    assert result.runtime.result_store_key
+    with open(result.outputs.out_file) as f:
+        assert f.read() == "SAME CONTENT"
+
+
+def test_key_depends_on_content(tmp_path):
+    store = ResultStore(str(tmp_path / "store"))
+    in_file = tmp_path / "t1.txt"
+    in_file.write_text("content")
+    node = _node(store, str(in_file), str(tmp_path))
+    key = store.key(node.interface)
+    in_file.write_text("other content")
+    os.utime(in_file, ns=(1, 1))
+    assert store.key(node.interface) != key
+
+
+def test_key_ignores_output_names_and_threads(tmp_path, monkeypatch):
+    store = ResultStore(str(tmp_path / "store"))
+    in_file = tmp_path / "t1.txt"
+    in_file.write_text("content")
+    node = _node(store, str(in_file), str(tmp_path))
+    key = store.key(node.interface)
+    node.inputs.nthreads = 8
+    assert store.key(node.interface) == key
+    # an output name matching a file of the current directory is not hashed
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "upper.txt").write_text("previous output")
+    assert store.key(node.interface) == key
+
+
+def test_lru_eviction(tmp_path):
+    store = ResultStore(str(tmp_path / "store"), max_size_gb=1.5e-9)
+    for i, name in enumerate(["old", "new"]):
+        out = tmp_path / (name + ".txt")
+        out.write_text("x")
+        os.utime(out, (i, i))
+        store.publish(name, {"out_file": str(out)})
+        os.utime(os.path.join(store.objects_dir, name, "manifest.json"), (i, i))
+    store.publish("newest", {"out_file": str(tmp_path / "new.txt")})
+    assert [key for key, _, _ in store.entries()] == ["newest"]
+
+
+def test_attach_result_store(tmp_path):
+    pipeline = create_dwi_processing_pipeline()
+    attached = attach_result_store(pipeline, ResultStore(str(tmp_path)))
+    assert {name.split(".")[-1] for name in attached} == {
+        "tissue_classif",
+        "diffusion2response",
+        "diffusion2fod",
+        "reg_f3d",
+    }
+
+
+def test_sampled_fingerprint(tmp_path, monkeypatch):
+    monkeypatch.setattr("mrproc.cache.SAMPLED_BLOCK_SIZE", 4)
+    big_file = tmp_path / "dwi.nii"
+    big_file.write_bytes(bytes(range(256)) * 4)
+    os.utime(big_file, ns=(1, 1))
+    fingerprint = fingerprint_file(str(big_file), "sampled")
+    content = big_file.read_bytes()
+    # bytes outside of the sampled blocks are not read
+    big_file.write_bytes(content[:10] + b"x" + content[11:])
+    os.utime(big_file, ns=(1, 1))
+    fingerprint_outside = fingerprint_file(str(big_file), "sampled")
+    assert fingerprint_outside == fingerprint
+    # the modification time is only hashed on request (ledger)
+    with_mtime = fingerprint_file(str(big_file), "sampled", mtime=True)
+    os.utime(big_file, ns=(2, 2))
+    assert fingerprint_file(str(big_file), "sampled") == fingerprint_outside
+    assert fingerprint_file(str(big_file), "sampled", mtime=True) != with_mtime
+    big_file.write_bytes(b"x" + content[1:])
+    os.utime(big_file, ns=(1, 1))
+    assert fingerprint_file(str(big_file), "sampled") != fingerprint_outside
+    assert fingerprint_file(str(big_file), "content") != fingerprint
+
+
+def test_apply_fingerprints():
+    pipeline = create_dwi_processing_pipeline()
+    core_pipeline = pipeline.get_node("core_dwi_processing_pipeline")
+    diffusion2fod = core_pipeline.get_node("msmt_csd.diffusion2fod")
+    assert diffusion2fod.fingerprint == "sampled"
+    assert diffusion2fod.config["execution"]["hash_method"] == "timestamp"
+    assert core_pipeline.get_node("reg_f3d").fingerprint == "content"
+    apply_fingerprints(pipeline, {"diffusion2fod": "content"})
+    assert diffusion2fod.fingerprint == "content"
+    assert diffusion2fod.config["execution"]["hash_method"] == "content"
+    with pytest.raises(ValueError):
+        apply_fingerprints(pipeline, {"diffusion2fod": "partial"})
@@ -0,0 +1,147 @@
+import json
+
+import numpy as np
+
+from mrproc.compression import compress_tractogram
+from mrproc.compression import simplify
+from mrproc.compression import write_compression_report
+from mrproc.io.tck import TckFile
+from mrproc.io.tck import TckWriter
+
+
+def _curves(nb_streamlines, seed=0, step=0.5):
+    rng = np.random.default_rng(seed)
+    streamlines = []
+    for n in rng.integers(2, 200, size=nb_streamlines):
+        t = np.arange(n) * step
+        phase = rng.uniform(0, 2 * np.pi)
+        curve = np.stack([t, 5 * np.sin(t / 10 + phase), 3 * np.cos(t / 7)], axis=1)
+        streamlines.append(curve.astype(np.float32))
+    return streamlines
+
+
+def _deviation(original, kept):
+    """Largest distance between the dropped vertices and the kept segments"""
+    indices = np.flatnonzero(kept)
+    worst = 0.0
+    for start, stop in zip(indices[:-1], indices[1:]):
+        chord = original[stop] - original[start]
+        for point in original[start + 1 : stop]:
+            relative = point - original[start]
+            position = np.clip(relative @ chord / max(chord @ chord, 1e-12), 0, 1)
+            worst = max(worst, np.linalg.norm(relative - position * chord))
+    return worst
+
+
+def test_simplify():
+    streamlines = _curves(200) + [np.zeros((1, 3), dtype=np.float32)]
+    lengths = [len(streamline) for streamline in streamlines]
+    keep = simplify(np.concatenate(streamlines), lengths, 0.1, max_segment=2.0)
+    assert keep.mean() < 0.5
+    for streamline, kept in zip(streamlines, np.split(keep, np.cumsum(lengths)[:-1])):
+        assert kept[0] and kept[-1]
+        assert _deviation(streamline, kept) <= 0.1 + 1e-5
+        segments = np.diff(streamline[kept], axis=0)
+        assert np.linalg.norm(segments, axis=1).max(initial=0) <= 2.0 + 1e-5
+    # A straight line is cut into segments of at most max_segment
+    line = np.stack([np.arange(21) * 0.5, np.zeros(21), np.zeros(21)], axis=1)
+    keep = simplify(line, [21], 0.1, max_segment=2.0)
+    assert np.diff(line[keep, 0]).max() <= 2.0
+    assert keep.sum() < 11
+
+
+def test_compress_tractogram(tmp_path):
+    streamlines = _curves(500)
+    in_file = str(tmp_path / "tracked.tck")
+    with TckWriter(in_file, header={"step_size": "0.5"}) as writer:
+        writer.write_streamlines(streamlines)
+    outputs = []
+    for n_procs in [1, 2]:
+        out_file = str(tmp_path / ("compressed%d.tck" % n_procs))
+        statistics = compress_tractogram(
+            in_file, out_file, 0.05, n_procs=n_procs, chunk_size=64
+        )
+        assert statistics["streamlines"] == 500
+        assert statistics["compressed_vertices"] < statistics["vertices"] / 2
+        assert statistics["compressed_bytes"] < statistics["bytes"] / 2
+        assert TckFile(out_file).header["output_step_size"] == "2"
+        outputs.append(list(TckFile(out_file).iter_streamlines(chunk_size=64)))
+    for compressed, parallel, original in zip(*outputs, streamlines):
+        np.testing.assert_array_equal(compressed, parallel)
+        np.testing.assert_array_equal(compressed[[0, -1]], original[[0, -1]])
+
+
+def test_write_compression_report(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    statistics = {
+        "tolerance_mm": 0.1,
+        "max_segment_mm": 2.0,
+        "streamlines": 3,
+        "vertices": 400,
+        "compressed_vertices": 100,
+        "bytes": 6000,
+        "compressed_bytes": 1600,
+    }
+    weights = tmp_path / "sift2_weights.txt"
+    weights.write_text("# command history\n1 1 2\n")
+    with open(write_compression_report(statistics, weights=str(weights))) as f:
+        report = json.load(f)
+    assert report["vertex_ratio"] == 0.25
+    assert report["sift"]["streamlines"] == 3
+    assert report["sift"]["effective_streamlines"] == 16 / 6
+
+    tractogram = str(tmp_path / "filtered.tck")
+    with TckWriter(tractogram) as writer:
+        writer.write_streamlines([np.array([[0, 0, 0], [0, 0, 3]], dtype=np.float32)])
+    with open(write_compression_report(statistics, tractogram=tractogram)) as f:
+        report = json.load(f)
+    assert report["sift"]["streamline_length_mm"]["mean"] == 3.0
+    with open(write_compression_report(statistics)) as f:
+        assert json.load(f)["sift"] is None
+
+
+def test_compression_report_against_reference(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    statistics = {
+        "vertices": 4,
+        "compressed_vertices": 2,
+        "bytes": 2,
+        "compressed_bytes": 1,
+    }
+    weights = tmp_path / "sift2_weights.txt"
+    weights.write_text("1 1 2\n")
+    reference = tmp_path / "reference_weights.txt"
+    reference.write_text("1 2 3\n")
+    with open(
+        write_compression_report(
+            statistics, weights=str(weights), reference_weights=str(reference)
+        )
+    ) as f:
+        report = json.load(f)
+    assert report["reference_sift"]["streamlines"] == 3
+    comparison = report["sift_comparison"]
+    assert comparison["streamline_ratio"] == 1.0
+    assert comparison["effective_streamline_ratio"] == (16 / 6) / (36 / 14)
+    assert comparison["weight_difference"]["max"] == 1.0
+    assert np.isclose(comparison["weight_correlation"], np.sqrt(3) / 2)
+
+    tractograms = []
+    for name, lengths in [("filtered.tck", [3, 5]), ("reference.tck", [4, 4, 4])]:
+        tractograms.append(str(tmp_path / name))
+        with TckWriter(tractograms[-1]) as writer:
+            writer.write_streamlines(
+                [
+                    np.array([[0, 0, 0], [0, 0, length]], dtype=np.float32)
+                    for length in lengths
+                ]
+            )
+    with open(
+        write_compression_report(
+            statistics, tractogram=tractograms[0], reference_tractogram=tractograms[1]
+        )
+    ) as f:
+        comparison = json.load(f)["sift_comparison"]
+    assert comparison == {
+        "streamline_ratio": 2 / 3,
+        "median_length_difference_mm": 0.0,
+    }
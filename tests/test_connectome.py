@@ -0,0 +1,93 @@
+import nibabel
+import numpy as np
+import pytest
+
+from mrproc import connectome
+from mrproc.connectome import assign_points
+from mrproc.connectome import compute_connectome
+from mrproc.connectome import write_connectome
+from mrproc.io.tck import TckWriter
+
+AFFINE = np.diag([2.0, 2.0, 2.0, 1.0])
+
+
+def _parcellation(path):
+    labels = np.zeros((10, 10, 10), dtype=np.int16)
+    labels[:5] = 1
+    labels[5:] = 2
+    labels[:, :, 9] = 3
+    nibabel.save(nibabel.Nifti1Image(labels, AFFINE), str(path))
+    return labels
+
+
+def _tractogram(path, nb_streamlines, seed=0):
+    rng = np.random.default_rng(seed)
+    streamlines = [
+        rng.uniform(-1, 19, size=(n, 3)).astype(np.float32)
+        for n in rng.integers(1, 30, size=nb_streamlines)
+    ]
+    with TckWriter(str(path)) as writer:
+        writer.write_streamlines(streamlines)
+    return streamlines
+
+
+def _expected(streamlines, labels, weights=None):
+    matrix = np.zeros((3, 3))
+    for i, streamline in enumerate(streamlines):
+        first, last = assign_points(streamline[[0, -1]].astype(float), labels, AFFINE)
+        if first and last:
+            low, high = sorted((first, last))
+            matrix[low - 1, high - 1] += 1 if weights is None else weights[i]
+    return matrix + np.triu(matrix, 1).T
+
+
+def test_assign_points():
+    labels = np.zeros((10, 10, 10), dtype=np.int32)
+    labels[1, 2, 3] = 7
+    points = np.array([[2.0, 4.0, 6.0], [2.9, 4.9, 5.1], [-3.0, 0.0, 0.0]])
+    assert list(assign_points(points, labels, AFFINE)) == [7, 7, 0]
+
+
+@pytest.mark.parametrize("n_procs", [1, 3])
+def test_compute_connectome(tmp_path, monkeypatch, n_procs):
+    # Small ranges: many streamlines straddle two ranges
+    monkeypatch.setattr(connectome, "BLOCK_SIZE", 1000)
+    labels = _parcellation(tmp_path / "parcellation.nii.gz")
+    streamlines = _tractogram(tmp_path / "tracks.tck", 5000)
+    matrix = compute_connectome(
+        str(tmp_path / "tracks.tck"),
+        str(tmp_path / "parcellation.nii.gz"),
+        n_procs=n_procs,
+    )
+    np.testing.assert_array_equal(matrix, _expected(streamlines, labels))
+    assert (matrix == matrix.T).all()
+
+
+def test_compute_connectome_weights(tmp_path):
+    labels = _parcellation(tmp_path / "parcellation.nii.gz")
+    streamlines = _tractogram(tmp_path / "tracks.tck", 500)
+    weights = np.random.default_rng(1).uniform(size=len(streamlines))
+    np.savetxt(tmp_path / "weights.txt", weights[None], header="SIFT2 weights")
+    matrix = compute_connectome(
+        str(tmp_path / "tracks.tck"),
+        str(tmp_path / "parcellation.nii.gz"),
+        weights=str(tmp_path / "weights.txt"),
+    )
+    np.testing.assert_allclose(matrix, _expected(streamlines, labels, weights))
+    np.savetxt(tmp_path / "weights.txt", weights[:-1])
+    with pytest.raises(ValueError, match="weights for 500 streamlines"):
+        compute_connectome(
+            str(tmp_path / "tracks.tck"),
+            str(tmp_path / "parcellation.nii.gz"),
+            weights=str(tmp_path / "weights.txt"),
+        )
+
+
+def test_write_connectome(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _parcellation(tmp_path / "parcellation.nii.gz")
+    _tractogram(tmp_path / "tracks.tck", 100)
+    out_file = write_connectome(
+        str(tmp_path / "tracks.tck"), str(tmp_path / "parcellation.nii.gz")
+    )
+    assert np.loadtxt(out_file, delimiter=",").shape == (3, 3)
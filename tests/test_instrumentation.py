@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+import nipype.pipeline.engine as pe
+from nipype.interfaces import utility
+from nipype.interfaces.utility import Function
+
+from mrproc.instrumentation import InstrumentedMultiProcPlugin
+from mrproc.instrumentation import aggregate_reports
+from mrproc.instrumentation import suggest_resource_profile
+
+
+def busy(value):
+    import subprocess
+
+    subprocess.run(["sleep", "0.2"], check=True)
+    with open("out.txt", "w") as f:
+        f.write("x" * 1000)
+    return value + 1
+
+
+def label_length(label):
+    return len(label)
+
+
+def _busy_node(name):
+    return pe.Node(
+        Function(input_names=["value"], output_names=["value"], function=busy),
+        name=name,
+    )
+
+
+def test_instrumented_run(tmp_path):
+    infosource = pe.Node(
+        utility.IdentityInterface(fields=["subject_id"]), name="infosource"
+    )
+    infosource.iterables = ("subject_id", ["sub-01", "sub-02"])
+    first, second = _busy_node("first"), _busy_node("second")
+    workflow = pe.Workflow(name="instrumented", base_dir=str(tmp_path))
+    workflow.connect(first, "value", second, "value")
+    workflow.connect(infosource, ("subject_id", label_length), first, "value")
+
+    report_dir = tmp_path / "report"
+    plugin = InstrumentedMultiProcPlugin(
+        plugin_args={"n_procs": 2, "report_dir": str(report_dir)}
+    )
+    workflow.run(plugin=plugin)
+
+    with open(report_dir / "run_report.json") as f:
+        report = json.load(f)
+    records = [r for r in report["nodes"] if r["name"] == "second"]
+    assert len(records) == 2
+    assert {r["subject_id"] for r in records} == {"sub-01", "sub-02"}
+    assert all(r["status"] == "done" and r["wall_time"] >= 0.2 for r in records)
+    assert all(r["output_size"] >= 1000 for r in records)
+    assert [n["node"].split(".")[-1] for n in report["critical_path"]["nodes"]] == [
+        "first",
+        "second",
+    ]
+    assert (report_dir / "run_report.csv").exists()
+
+    aggregate = aggregate_reports([str(report_dir / "run_report.json")])
+    assert aggregate["second"]["count"] == 2
+    assert suggest_resource_profile(aggregate)["second"]["n_procs"] >= 1
+
+
+def allocate(size_mb):
+    import subprocess
+    import sys
+
+    code = "import time; x = bytearray(%d * 1024 ** 2); time.sleep(1)" % size_mb
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return size_mb
+
+
+def test_peak_memory_of_launched_commands(tmp_path, monkeypatch):
+    pytest.importorskip("psutil")
+    monkeypatch.chdir(tmp_path)
+    node = pe.Node(
+        Function(input_names=["size_mb"], output_names=["size_mb"], function=allocate),
+        name="allocate",
+    )
+    node.inputs.size_mb = 300
+    workflow = pe.Workflow(name="monitored", base_dir=str(tmp_path))
+    workflow.add_nodes([node])
+    report_dir = tmp_path / "report"
+    plugin = InstrumentedMultiProcPlugin(
+        plugin_args={"n_procs": 1, "report_dir": str(report_dir)}
+    )
+    workflow.run(plugin=plugin)
+
+    with open(report_dir / "run_report.json") as f:
+        (record,) = json.load(f)["nodes"]
+    # worker process plus the launched command
+    assert record["peak_rss_gb"] >= 0.3
+    assert record["peak_threads"] is not None
+    # monitor logs are removed
+    assert not list(tmp_path.glob(".proc-*"))
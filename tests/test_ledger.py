@@ -0,0 +1,76 @@
+import json
+
+from mrproc.ledger import CompletionLedger
+from mrproc.workflows.batch import SUBJECT_FIELDS
+from mrproc.workflows.batch import create_batch_dwi_processing_pipeline
+from mrproc.workflows.batch import record_completion
+
+
+def _subject(directory, subject_id):
+    subject = {"subject_id": subject_id}
+    for field in SUBJECT_FIELDS:
+        path = directory / ("%s_%s" % (subject_id, field))
+        path.write_text(field)
+        subject[field] = str(path)
+    return subject
+
+
+def test_completion_ledger(tmp_path):
+    ledger = CompletionLedger(str(tmp_path / "ledger"))
+    subjects = [_subject(tmp_path, "sub-01"), _subject(tmp_path, "sub-02")]
+    output = tmp_path / "tractogram.tck"
+    output.write_text("tracks")
+    parameters = {"nb_tracks": 1000}
+    ledger.record(subjects[0], parameters, {"tractogram": str(output)})
+    assert ledger.pending(subjects, parameters) == [subjects[1]]
+    # other parameters, modified input or missing output: processed again
+    assert len(ledger.pending(subjects, {"nb_tracks": 2000})) == 2
+    with open(subjects[0]["t1_volume"], "a") as f:
+        f.write(" modified")
+    assert len(ledger.pending(subjects, parameters)) == 2
+    ledger.record(subjects[0], parameters, {"tractogram": str(output)})
+    output.unlink()
+    assert len(ledger.pending(subjects, parameters)) == 2
+
+
+def test_batch_skips_completed_subjects(tmp_path):
+    subjects = [_subject(tmp_path, "sub-%02d" % i) for i in range(2)]
+    ledger = str(tmp_path / "ledger")
+    batch = create_batch_dwi_processing_pipeline(subjects, ledger=ledger)
+    assert batch.get_node("infosource").iterables[1] == ["sub-00", "sub-01"]
+    record = batch.get_node("record_completion")
+    parameters = record.inputs.parameters
+    output = tmp_path / "wm_fod.mif"
+    output.write_text("fod")
+    entry_file = record_completion(
+        ledger,
+        parameters,
+        "sub-00",
+        **{field: subjects[0][field] for field in SUBJECT_FIELDS},
+        wm_fod=str(output),
+    )
+    with open(entry_file) as f:
+        assert json.load(f)["outputs"] == {"wm_fod": str(output)}
+    batch = create_batch_dwi_processing_pipeline(subjects, ledger=ledger)
+    assert batch.get_node("infosource").iterables[1] == ["sub-01"]
+    record_completion(
+        ledger,
+        parameters,
+        "sub-01",
+        **{field: subjects[1][field] for field in SUBJECT_FIELDS},
+    )
+    assert create_batch_dwi_processing_pipeline(subjects, ledger=ledger) is None
+
+
+def test_record_completion_keeps_output_directory_copies(tmp_path):
+    subject = _subject(tmp_path, "sub-01")
+    entry_file = record_completion(
+        str(tmp_path / "ledger"),
+        {},
+        "sub-01",
+        **{field: subject[field] for field in SUBJECT_FIELDS},
+        wm_fod="/work/wm.mif",
+        sinked=["/out/sub-01/wm_fod/wm.mif"],
+    )
+    with open(entry_file) as f:
+        assert json.load(f)["outputs"] == {"sinked": ["/out/sub-01/wm_fod/wm.mif"]}
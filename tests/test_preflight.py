@@ -0,0 +1,162 @@
+import stat
+
+import nibabel
+import numpy as np
+import pytest
+
+from mrproc.preflight import check_executables
+from mrproc.preflight import check_subject
+from mrproc.preflight import estimate_subject_needs
+from mrproc.preflight import parse_version
+from mrproc.preflight import required_executables
+from mrproc.preflight import run_preflight
+from mrproc.workflows.batch import SUBJECT_FIELDS
+from mrproc.workflows.batch import create_batch_dwi_processing_pipeline
+
+
+def _image(path, shape):
+    nibabel.save(nibabel.Nifti1Image(np.zeros(shape, np.float32), np.eye(4)), path)
+    return path
+
+
+def _subject(directory, nb_volumes=5, nb_bvals=5):
+    directory.mkdir(parents=True, exist_ok=True)
+    bvals = directory / "dwi.bval"
+    bvals.write_text(" ".join(["0"] + ["1000"] * (nb_bvals - 1)) + "\n")
+    bvecs = directory / "dwi.bvec"
+    bvecs.write_text("\n".join(" ".join(["0.0"] * nb_bvals) for _ in range(3)))
+    return {
+        "subject_id": directory.name,
+        "diffusion_volume": _image(
+            str(directory / "dwi.nii.gz"), (4, 4, 3, nb_volumes)
+        ),
+        "bvals": str(bvals),
+        "bvecs": str(bvecs),
+        "t1_volume": _image(str(directory / "t1.nii.gz"), (8, 8, 6)),
+    }
+
+
+def _executable(directory, name, output=""):
+    path = directory / name
+    path.write_text("#!/bin/sh\necho '%s'\n" % output)
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+
+
+def test_check_subject(tmp_path):
+    subject = _subject(tmp_path / "sub-01")
+    problems, shapes = check_subject(subject, SUBJECT_FIELDS)
+    assert problems == []
+    assert shapes["diffusion_volume"] == (4, 4, 3, 5)
+
+    subject = _subject(tmp_path / "sub-02", nb_bvals=4)
+    problems, _ = check_subject(subject, SUBJECT_FIELDS)
+    assert problems == ["4 bvals for 5 diffusion volumes"]
+
+    subject["t1_volume"] = str(tmp_path / "missing.nii.gz")
+    problems, _ = check_subject(subject, SUBJECT_FIELDS)
+    assert problems == ["t1_volume %s does not exist" % subject["t1_volume"]]
+
+    subject = _subject(tmp_path / "sub-03")
+    with open(subject["t1_volume"], "wb") as f:
+        f.write(b"not an image")
+    problems, _ = check_subject(subject, SUBJECT_FIELDS)
+    assert "unreadable header" in problems[0]
+
+
+def test_check_subject_t1_shape(tmp_path):
+    subject = _subject(tmp_path / "sub-01")
+    _image(subject["t1_volume"], (8, 8, 6, 1, 1))
+    assert check_subject(subject, SUBJECT_FIELDS)[0] == []
+    _image(subject["t1_volume"], (8, 8, 6, 1, 2))
+    assert check_subject(subject, SUBJECT_FIELDS)[0] == [
+        "t1_volume %s is not 3D (shape (8, 8, 6, 1, 2))" % subject["t1_volume"]
+    ]
+    # Without a T1 volume, only the diffusion series is checked
+    fields = [field for field in SUBJECT_FIELDS if field != "t1_volume"]
+    problems, shapes = check_subject(subject, fields)
+    assert problems == [] and "t1_volume" not in shapes
+
+
+def test_check_subject_parcellation(tmp_path):
+    subject = _subject(tmp_path / "sub-01")
+    subject["parcellation"] = _image(str(tmp_path / "dseg.nii.gz"), (8, 8, 5))
+    problems, _ = check_subject(subject, SUBJECT_FIELDS + ["parcellation"])
+    assert problems == ["parcellation of shape (8, 8, 5), the T1 volume is (8, 8, 6)"]
+
+
+def test_check_executables(tmp_path, monkeypatch):
+    _executable(tmp_path, "mrconvert", "== mrconvert 3.0.4 ==")
+    _executable(tmp_path, "flirt", "FLIRT version 5.5")
+    _executable(tmp_path, "reg_f3d")
+    monkeypatch.setenv("PATH", str(tmp_path))
+    errors, warnings = check_executables(["mrconvert", "flirt", "reg_f3d", "tcksift"])
+    assert errors == [
+        "%s version 5.5, at least 6.0 is required" % (tmp_path / "flirt"),
+        "tcksift not found on the PATH",
+    ]
+    assert warnings == [
+        "could not determine the version of %s" % (tmp_path / "reg_f3d")
+    ]
+    assert parse_version("NiftyReg 1.5.58") == (1, 5, 58)
+
+
+def test_required_executables(tmp_path):
+    batch = create_batch_dwi_processing_pipeline(
+        [_subject(tmp_path / "sub-01")], sift_mode="sift2", registration="rigid"
+    )
+    executables = required_executables(batch)
+    assert {"tckgen", "tcksift2", "flirt", "convert_xfm"} <= set(executables)
+    assert {"N4BiasFieldCorrection", "run_first_all"} <= set(executables)
+    assert "tcksift" not in executables and "reg_f3d" not in executables
+
+
+def test_estimate_subject_needs(tmp_path):
+    subject = _subject(tmp_path / "sub-01")
+    batch = create_batch_dwi_processing_pipeline([subject])
+    _, shapes = check_subject(subject, SUBJECT_FIELDS)
+    mem_gb, disk_gb = estimate_subject_needs(batch, shapes, nb_tracks=10000000)
+    # SIFT dominates the memory of a 10M streamlines run
+    assert mem_gb == 4.0 + 2.5 * 10
+    assert disk_gb == pytest.approx(2 * 2400 * 10000000 / 1e9, abs=0.01)
+    _, preview_disk_gb = estimate_subject_needs(
+        batch, shapes, nb_tracks=10000000, sift_mode="none"
+    )
+    assert preview_disk_gb < disk_gb
+
+
+def test_run_preflight(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", "")
+    subjects = [_subject(tmp_path / "sub-01"), _subject(tmp_path / "sub-02", 5, 6)]
+    batch = create_batch_dwi_processing_pipeline(subjects)
+    accepted, report = run_preflight(
+        subjects,
+        batch,
+        str(tmp_path / "work"),
+        SUBJECT_FIELDS,
+        nb_tracks=10000000,
+        memory_gb=64,
+    )
+    assert [subject["subject_id"] for subject in accepted] == ["sub-01"]
+    assert report["rejected"] == {"sub-02": ["6 bvals for 5 diffusion volumes"]}
+    assert "mrconvert not found on the PATH" in report["errors"]
+
+    accepted, report = run_preflight(
+        subjects[:1],
+        batch,
+        str(tmp_path / "work"),
+        SUBJECT_FIELDS,
+        nb_tracks=10000000,
+        memory_gb=8,
+    )
+    assert accepted == []
+    assert report["rejected"]["sub-01"] == ["needs 29.0 GB of memory, 8.0 GB available"]
+
+
+def test_run_preflight_header_ingest(tmp_path):
+    subjects = [_subject(tmp_path / "sub-01")]
+    batch = create_batch_dwi_processing_pipeline(subjects, ingest="header")
+    accepted, report = run_preflight(
+        subjects, batch, str(tmp_path / "work"), SUBJECT_FIELDS, memory_gb=64
+    )
+    assert accepted == []
+    assert "header ingest needs a .nii file" in report["rejected"]["sub-01"][0]
@@ -0,0 +1,84 @@
+import json
+import struct
+import zlib
+
+import nibabel
+import numpy as np
+
+from mrproc.io.tck import TckWriter
+from mrproc.qc import outline
+from mrproc.qc import streamline_lengths
+from mrproc.qc import write_png
+from mrproc.qc import write_report
+
+
+def _read_png(path):
+    data = open(path, "rb").read()
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    width, height, _, color_type = struct.unpack(">IIBB", data[16:26])
+    start = data.index(b"IDAT") + 4
+    length = struct.unpack(">I", data[start - 8 : start - 4])[0]
+    raw = zlib.decompress(data[start : start + length])
+    channels = 3 if color_type == 2 else 1
+    rows = np.frombuffer(raw, np.uint8).reshape(height, 1 + width * channels)
+    assert not rows[:, 0].any()
+    return rows[:, 1:].reshape(height, width, channels).squeeze()
+
+
+def test_write_png(tmp_path):
+    image = np.arange(60, dtype=np.uint8).reshape(4, 5, 3)
+    write_png(str(tmp_path / "rgb.png"), image)
+    np.testing.assert_array_equal(_read_png(str(tmp_path / "rgb.png")), image)
+    write_png(str(tmp_path / "gray.png"), image[..., 0])
+    np.testing.assert_array_equal(_read_png(str(tmp_path / "gray.png")), image[..., 0])
+
+
+def test_outline():
+    mask = np.zeros((5, 5), dtype=bool)
+    mask[1:4, 1:4] = True
+    border = outline(mask)
+    assert border.sum() == 8
+    assert not border[2, 2]
+
+
+def test_streamline_lengths(tmp_path):
+    streamlines = [
+        np.array([[0, 0, 0], [3, 4, 0], [3, 4, 2]], dtype=np.float32),
+        np.array([[1, 1, 1]], dtype=np.float32),
+        np.array([[0, 0, 0], [0, 0, 1]], dtype=np.float32),
+    ]
+    with TckWriter(str(tmp_path / "tracks.tck")) as writer:
+        writer.write_streamlines(streamlines)
+    lengths = streamline_lengths(str(tmp_path / "tracks.tck"), chunk_size=2)
+    np.testing.assert_allclose(lengths, [7.0, 0.0, 1.0])
+
+
+def test_write_report(tmp_path):
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    fa = np.zeros((10, 12, 8))
+    fa[2:8, 2:10, 2:6] = 0.5
+    fa[2:5, 2:10, 2:6] = 0.25
+    t1 = fa * 200
+    for name, data in [("fa", fa), ("mask", fa > 0), ("t1", t1)]:
+        nibabel.save(
+            nibabel.Nifti1Image(data.astype(np.float32), affine),
+            str(tmp_path / ("%s.nii.gz" % name)),
+        )
+    with TckWriter(str(tmp_path / "tracks.tck")) as writer:
+        writer.write_streamlines([np.zeros((3, 3), np.float32)] * 4)
+    summary, images = write_report(
+        *[str(tmp_path / name) for name in ["fa.nii.gz", "mask.nii.gz"]],
+        str(tmp_path / "fa.nii.gz"),
+        str(tmp_path / "t1.nii.gz"),
+        str(tmp_path / "tracks.tck"),
+        str(tmp_path),
+    )
+    summary = json.load(open(summary))
+    assert summary["streamlines"] == 4
+    assert summary["mask_volume_ml"] == 6 * 8 * 4 * 8 / 1000.0
+    assert summary["fa_in_mask"]["median"] == 0.375
+    assert summary["reference_t1_correlation"] == 1.0
+    fa_mask = _read_png(images[0])
+    # Sagittal (8 x 12), coronal (8 x 10) and axial (12 x 10) slices
+    assert fa_mask.shape == (12, 12 + 10 + 10, 3)
+    assert (fa_mask == [255, 0, 0]).all(axis=2).any()
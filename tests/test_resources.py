@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from mrproc.resources import apply_resource_profile
+from mrproc.resources import estimate_node_resources
+from mrproc.resources import load_resource_profile
+from mrproc.workflows.dwi_processing import create_dwi_processing_pipeline
+
+
+def test_load_resource_profile_from_file(tmp_path):
+    profile_file = tmp_path / "profile.json"
+    profile_file.write_text(json.dumps({"tractography": {"n_procs": 16}}))
+    profile = load_resource_profile(str(profile_file))
+    assert profile["tractography"]["n_procs"] == 16
+    # untouched fields keep their default values
+    assert profile["tractography"]["mem_gb"] == 2.0
+    with pytest.raises(ValueError):
+        load_resource_profile({"tractography": {"threads": 4}})
+
+
+def test_estimate_node_resources_scaling():
+    profile = load_resource_profile()
+    _, small = estimate_node_resources("sift_filtering", profile, nb_tracks=1e6)
+    _, large = estimate_node_resources("sift_filtering", profile, nb_tracks=1e7)
+    assert large > small
+    assert estimate_node_resources("unknown_node", profile) == (1, 0.2)
+
+
+def test_apply_resource_profile():
+    pipeline = create_dwi_processing_pipeline()
+    apply_resource_profile(pipeline, nb_tracks=10000000, max_procs=4)
+    tractography = pipeline.get_node("core_dwi_processing_pipeline").get_node(
+        "tractogram_pipeline.tractography"
+    )
+    assert tractography.n_procs == 4
+    assert tractography.interface.inputs.nthreads == 4
+    assert tractography.interface.inputs.environ["OMP_NUM_THREADS"] == "4"
+    assert tractography.mem_gb == 2.5
+    reg_f3d = pipeline.get_node("core_dwi_processing_pipeline.reg_f3d")
+    assert reg_f3d.interface.inputs.omp_core_val == 4
+
+
+def test_apply_resource_profile_sharded_tractography():
+    pipeline = create_dwi_processing_pipeline(nb_shards=4)
+    apply_resource_profile(pipeline, nb_tracks=10000000, nb_shards=4)
+    core_pipeline = pipeline.get_node("core_dwi_processing_pipeline")
+    tractography = core_pipeline.get_node("tractogram_pipeline.tractography")
+    # each shard generates a quarter of the streamlines
+    assert tractography.mem_gb == 2.12
+    sift_filtering = core_pipeline.get_node("tractogram_pipeline.sift_filtering")
+    assert sift_filtering.mem_gb == 29.0
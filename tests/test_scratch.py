@@ -0,0 +1,168 @@
+import json
+import os
+
+import nipype.pipeline.engine as pe
+import pytest
+from nipype.interfaces import utility
+from nipype.interfaces.utility import Function
+from nipype.pipeline.plugins.base import DistributedPluginBase
+
+from mrproc import scratch
+from mrproc.instrumentation import directory_size
+from mrproc.scratch import InstrumentedScratchManagedMultiProcPlugin
+from mrproc.scratch import PLUGIN_METHODS
+from mrproc.scratch import PLUGIN_STATE
+from mrproc.scratch import ScratchManagedMultiProcPlugin
+from mrproc.scratch import check_plugin_internals
+from mrproc.scratch import declared_outputs
+
+
+def write_file(value):
+    import os
+    import time
+
+    time.sleep(0.2)
+    with open("out.txt", "w") as f:
+        f.write(str(value) * 1000)
+    return os.path.abspath("out.txt")
+
+
+def read_file(in_file, repeat):
+    with open(in_file) as f:
+        return len(f.read()) * repeat
+
+
+def label_length(label):
+    return len(label)
+
+
+def _file_node(name):
+    return pe.Node(
+        Function(input_names=["value"], output_names=["out_file"], function=write_file),
+        name=name,
+    )
+
+
+def _create_workflow(base_dir, subjects):
+    infosource = pe.Node(
+        utility.IdentityInterface(fields=["subject_id"]), name="infosource"
+    )
+    infosource.iterables = ("subject_id", subjects)
+    first, second = _file_node("first"), _file_node("second")
+    outputnode = pe.Node(
+        utility.IdentityInterface(fields=["result"]), name="outputnode"
+    )
+    pipeline = pe.Workflow(name="pipeline")
+    pipeline.connect(first, "out_file", second, "value")
+    pipeline.connect(second, "out_file", outputnode, "result")
+    workflow = pe.Workflow(name="scratch", base_dir=str(base_dir))
+    workflow.connect(infosource, ("subject_id", label_length), pipeline, "first.value")
+    return workflow, pipeline
+
+
+def _outputs(base_dir, node_name):
+    found = []
+    for root, _, files in os.walk(base_dir):
+        if os.path.basename(root) == node_name:
+            found.extend(f for f in files if f.startswith("out.txt"))
+    return sorted(found)
+
+
+def test_declared_outputs(tmp_path):
+    workflow, pipeline = _create_workflow(tmp_path, ["sub-01"])
+    assert declared_outputs(pipeline, hierarchy="scratch") == {
+        ("scratch.pipeline.second", "out_file")
+    }
+
+
+def test_intermediates_deleted(tmp_path):
+    workflow, pipeline = _create_workflow(tmp_path, ["sub-01", "sub-02"])
+    plugin = ScratchManagedMultiProcPlugin(
+        plugin_args={
+            "n_procs": 2,
+            "intermediates": "delete",
+            "keep_outputs": declared_outputs(pipeline, hierarchy="scratch"),
+        }
+    )
+    workflow.run(plugin=plugin)
+    assert _outputs(tmp_path, "first") == []
+    assert _outputs(tmp_path, "second") == ["out.txt", "out.txt"]
+    assert plugin.freed_bytes == 2 * 1000
+
+
+def test_intermediates_rerun(tmp_path):
+    first = _file_node("first")
+    first.inputs.value = 1
+    second = pe.Node(
+        Function(
+            input_names=["in_file", "repeat"], output_names=["out"], function=read_file
+        ),
+        name="second",
+    )
+    second.inputs.repeat = 1
+    workflow = pe.Workflow(name="rerun", base_dir=str(tmp_path))
+    workflow.connect(first, "out_file", second, "in_file")
+    plugin_args = {"n_procs": 1, "intermediates": "delete"}
+    workflow.run(plugin=ScratchManagedMultiProcPlugin(plugin_args=plugin_args))
+    assert _outputs(tmp_path, "first") == []
+    # The collected producer is rerun for its changed consumer
+    second.inputs.repeat = 2
+    graph = workflow.run(plugin=ScratchManagedMultiProcPlugin(plugin_args=plugin_args))
+    results = {node.name: node.result.outputs for node in graph.nodes()}
+    assert results["second"].out == 2000
+
+
+def test_intermediates_compressed(tmp_path):
+    workflow, pipeline = _create_workflow(tmp_path, ["sub-01"])
+    plugin = ScratchManagedMultiProcPlugin(
+        plugin_args={"n_procs": 1, "intermediates": "compress"}
+    )
+    workflow.run(plugin=plugin)
+    assert _outputs(tmp_path, "first") == ["out.txt.gz"]
+    # Nodes without consumers are collected too when no output is declared
+    assert _outputs(tmp_path, "second") == ["out.txt.gz"]
+
+
+def test_scratch_quota_throttles_new_subjects(tmp_path):
+    workflow, pipeline = _create_workflow(tmp_path, ["sub-01", "sub-02", "sub-03"])
+    plugin = InstrumentedScratchManagedMultiProcPlugin(
+        plugin_args={
+            "n_procs": 2,
+            "intermediates": "delete",
+            "scratch_quota_gb": 0,
+            "scratch_check_interval": 0,
+            "report_dir": str(tmp_path / "report"),
+        }
+    )
+    workflow.run(plugin=plugin)
+    with open(tmp_path / "report" / "run_report.json") as f:
+        records = json.load(f)["nodes"]
+    started = {r["subject_id"]: r["start"] for r in records if r["name"] == "first"}
+    ended = {
+        r["subject_id"]: r["start"] + r["wall_time"]
+        for r in records
+        if r["name"] == "second"
+    }
+    last = max(started, key=started.get)
+    assert all(started[last] >= ended[subject] for subject in ended if subject != last)
+    # usage is measured on the working directory of the run
+    assert plugin.scratch_usage() == directory_size(str(tmp_path / "scratch"))
+
+
+def test_scratch_quota_requires_collection():
+    with pytest.raises(ValueError, match="quota"):
+        ScratchManagedMultiProcPlugin(plugin_args={"scratch_quota_gb": 10})
+
+
+def test_nipype_plugin_internals(monkeypatch):
+    # ScratchManager overrides these methods and edits this state of the
+    # distributed plugins of Nipype, none of which is public
+    for name in PLUGIN_METHODS:
+        assert callable(getattr(DistributedPluginBase, name, None)), name
+    plugin = DistributedPluginBase()
+    for name in PLUGIN_STATE:
+        assert hasattr(plugin, name), name
+    check_plugin_internals(plugin)
+    monkeypatch.setattr(scratch.nipype, "__version__", "2.1.0")
+    with pytest.raises(RuntimeError, match="Unsupported Nipype version 2.1.0"):
+        ScratchManagedMultiProcPlugin()
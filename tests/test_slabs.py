@@ -0,0 +1,64 @@
+import numpy as np
+
+from mrproc.io.mif import MifFile
+from mrproc.io.mif import write_mif
+from mrproc.slabs import slab_bounds
+from mrproc.slabs import stitch_fods
+from mrproc.slabs import write_slab_masks
+
+AFFINE = np.diag([2.0, 2.0, 2.0, 1.0])
+
+
+def _brain(shape=(10, 12, 16)):
+    grid = np.indices(shape).astype(float)
+    center = (np.array(shape) - 1)[:, None, None, None] / 2
+    radii = np.array([4.0, 5.0, 6.0])[:, None, None, None]
+    return (((grid - center) / radii) ** 2).sum(axis=0) <= 1
+
+
+def test_slab_bounds():
+    brain = _brain()
+    bounds = slab_bounds(brain, 4)
+    assert len(bounds) == 4
+    assert bounds[0][0] == 0 and bounds[-1][1] == brain.shape[2]
+    assert all(stop == start for (_, stop), (start, _) in zip(bounds, bounds[1:]))
+    counts = [brain[:, :, start:stop].sum() for start, stop in bounds]
+    assert min(counts) > 0
+    assert max(counts) - min(counts) < brain.sum(axis=(0, 1)).max() * 2
+    # No empty slab when there are more slabs than slices of the mask
+    assert len(slab_bounds(brain, 100)) == (brain.sum(axis=(0, 1)) > 0).sum()
+    assert slab_bounds(np.zeros((2, 2, 5), dtype=bool), 3) == [(0, 5)]
+    assert slab_bounds(brain, 1) == [(0, brain.shape[2])]
+
+
+def test_stitch_fods(tmp_path, monkeypatch):
+    brain = _brain()
+    mask = write_mif(str(tmp_path / "mask.mif"), brain, AFFINE, datatype="UInt8")
+    slab_masks, bounds = write_slab_masks(mask, 3, str(tmp_path))
+    slabs = [np.asarray(MifFile(path).data).astype(bool) for path in slab_masks]
+    np.testing.assert_array_equal(np.sum(slabs, axis=0), brain)
+    np.testing.assert_allclose(MifFile(slab_masks[0]).affine, AFFINE)
+
+    # Voxelwise estimation, zero outside the mask of the job
+    rng = np.random.default_rng(0)
+    volumes = {
+        tissue: rng.normal(size=brain.shape + (n,)).astype(np.float32)
+        for tissue, n in [("wm", 45), ("gm", 1), ("csf", 1)]
+    }
+    files = {tissue: [] for tissue in volumes}
+    for i, slab in enumerate(slabs):
+        for tissue, volume in volumes.items():
+            files[tissue].append(
+                write_mif(
+                    str(tmp_path / ("%s%d.mif" % (tissue, i))),
+                    volume * slab[..., None],
+                    AFFINE,
+                    header={"command_history": "dwi2fod msmt_csd"},
+                )
+            )
+    monkeypatch.chdir(tmp_path)
+    stitched = stitch_fods(files["wm"], files["gm"], files["csf"], bounds)
+    for path, tissue in zip(stitched, ["wm", "gm", "csf"]):
+        image = MifFile(path)
+        np.testing.assert_array_equal(image.data, volumes[tissue] * brain[..., None])
+        assert image.header["command_history"] == "dwi2fod msmt_csd"
@@ -0,0 +1,173 @@
+import os
+import stat
+import sys
+
+import nipype.pipeline.engine as pe
+import pytest
+from nipype.interfaces.utility import Function
+from nipype.pipeline.engine.utils import generate_expanded_graph
+
+from mrproc.slurm import SLURMBundlePlugin
+from mrproc.slurm import bundle_resources
+from mrproc.slurm import partition_graph
+
+# Stand-in scheduler: jobs run in the background, squeue lists the live ones
+SBATCH = """#!/bin/bash
+root=$(dirname "$0")
+echo "$@" >> "$root/sbatch_calls"
+job_id=$(( $(ls "$root/jobs" | wc -l) + 1 ))
+script="${@: -1}"
+bash "$script" > "$(dirname "$script")/slurm-$job_id.out" 2>&1 &
+echo $! > "$root/jobs/$job_id"
+echo "$job_id;cluster"
+"""
+SQUEUE = """#!/bin/bash
+root=$(dirname "$0")
+for job in "$root"/jobs/*; do
+    [ -e "$job" ] && kill -0 $(cat "$job") 2> /dev/null && basename "$job"
+done
+exit 0
+"""
+
+
+@pytest.fixture(autouse=True)
+def job_environment(monkeypatch):
+    # Stand-in jobs import mrproc whatever the working directory of the tests
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = [root] + [path for path in [os.environ.get("PYTHONPATH")] if path]
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(paths))
+
+
+def fail_once(value, marker):
+    import os
+
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        raise RuntimeError("first attempt fails")
+    return value
+
+
+def _scheduler(directory):
+    directory.mkdir()
+    (directory / "jobs").mkdir()
+    for name, content in [("sbatch", SBATCH), ("squeue", SQUEUE)]:
+        path = directory / name
+        path.write_text(content)
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return directory
+
+
+def _flaky_node(directory):
+    node = pe.Node(
+        Function(
+            input_names=["value", "marker"], output_names=["out"], function=fail_once
+        ),
+        name="flaky",
+    )
+    node.inputs.marker = str(directory / "marker")
+    return node
+
+
+@pytest.fixture
+def create_workflow(subject_workflow, add_node):
+    """Factory of workflows whose second node needs more resources than the first"""
+
+    def create(base_dir, subjects, extra=None):
+        workflow, infosource = subject_workflow("bundled", base_dir, subjects)
+        first = add_node("first", mem_gb=0.1)
+        second = add_node("second", n_procs=2, mem_gb=0.5)
+        first.inputs.value = 0
+        workflow.config["execution"]["poll_sleep_duration"] = 0.1
+        workflow.connect(infosource, "subject_id", first, "increment")
+        workflow.connect(first, "out", second, "value")
+        if extra is not None:
+            workflow.connect(second, "out", extra, "value")
+        return workflow
+
+    return create
+
+
+def _plugin(scheduler, **plugin_args):
+    plugin_args.update(
+        sbatch=str(scheduler / "sbatch"),
+        squeue=str(scheduler / "squeue"),
+        poll_interval=0.2,
+        status_timeout=5,
+        python=sys.executable,
+    )
+    return SLURMBundlePlugin(plugin_args=plugin_args)
+
+
+def test_partition_graph(tmp_path, create_workflow):
+    workflow = create_workflow(tmp_path, [1, 2])
+    graph = workflow._create_flat_graph()
+    graph = generate_expanded_graph(graph)
+    assert sorted(partition_graph(graph)) == ["1", "2"]
+    assert bundle_resources(partition_graph(graph)["1"]) == (2, 0.5)
+    partition = partition_graph(graph, bundles={"heavy": ["second"]})
+    assert sorted(partition) == ["1", "1_heavy", "2", "2_heavy"]
+    assert [node.name for node in partition["1_heavy"]] == ["second"]
+    assert bundle_resources(partition["1"]) == (1, 0.1)
+    assert bundle_resources(partition["1_heavy"]) == (2, 0.5)
+
+
+def test_partition_graph_stages(tmp_path, add_node):
+    # A shared node between two nodes of a subject splits the subject bundle
+    workflow = pe.Workflow(name="staged", base_dir=str(tmp_path))
+    first, shared = add_node("first"), add_node("shared")
+    second = add_node("second")
+    first.inputs.value = 0
+    first.parameterization = second.parameterization = ["_subject_id_sub-01"]
+    workflow.add_nodes([first, shared, second])
+    workflow.connect(first, "out", shared, "value")
+    workflow.connect(shared, "out", second, "value")
+    partition = partition_graph(workflow._graph)
+    assert list(partition) == ["sub-01_stage1", "shared", "sub-01_stage2"]
+
+
+def test_slurm_bundle_plugin(tmp_path, create_workflow):
+    scheduler = _scheduler(tmp_path / "scheduler")
+    workflow = create_workflow(tmp_path / "work", [1, 2])
+    workflow.run(plugin=_plugin(scheduler))
+
+    calls = (scheduler / "sbatch_calls").read_text().splitlines()
+    # One job per subject, sized from the largest node
+    assert len(calls) == 2
+    assert all("--cpus-per-task=2" in call for call in calls)
+    assert all("--mem=563M" in call for call in calls)
+    results = sorted(
+        root
+        for root, _, files in os.walk(tmp_path / "work")
+        if "result_second.pklz" in files
+    )
+    assert len(results) == 2
+    statuses = list((tmp_path / "work" / "bundles").glob("*/status.json"))
+    assert len(statuses) == 2
+
+
+def test_slurm_bundle_plugin_resubmits(tmp_path, create_workflow):
+    scheduler = _scheduler(tmp_path / "scheduler")
+    workflow = create_workflow(tmp_path / "work", [1], extra=_flaky_node(tmp_path))
+    workflow.run(plugin=_plugin(scheduler))
+    assert len((scheduler / "sbatch_calls").read_text().splitlines()) == 2
+
+    scheduler = _scheduler(tmp_path / "scheduler_no_retry")
+    os.remove(tmp_path / "marker")
+    workflow = create_workflow(
+        tmp_path / "work_no_retry", [1], extra=_flaky_node(tmp_path)
+    )
+    with pytest.raises(RuntimeError, match="first attempt fails"):
+        workflow.run(plugin=_plugin(scheduler, max_retries=0))
+
+
+def test_slurm_bundle_plugin_runner_failure(tmp_path, create_workflow):
+    # Interpreter failing before the runner writes any status
+    scheduler = _scheduler(tmp_path / "scheduler")
+    python = tmp_path / "python"
+    python.write_text("#!/bin/bash\necho 'No module named mrproc' >&2\nexit 3\n")
+    python.chmod(python.stat().st_mode | stat.S_IEXEC)
+    workflow = create_workflow(tmp_path / "work", [1])
+    plugin = _plugin(scheduler, max_retries=0)
+    plugin.python = str(python)
+    with pytest.raises(RuntimeError, match="(?s)code 3.*No module named mrproc"):
+        workflow.run(plugin=plugin)
@@ -0,0 +1,77 @@
+import nibabel
+import numpy as np
+
+from mrproc import tensor
+from mrproc.io.mif import write_mif
+from mrproc.tensor import design_matrix
+from mrproc.tensor import fit_tensor
+from mrproc.tensor import fractional_anisotropy
+from mrproc.tensor import write_fa
+
+
+def _scheme(nb_directions=30, seed=0):
+    rng = np.random.default_rng(seed)
+    directions = rng.normal(size=(nb_directions, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    bvals = np.repeat([1000.0, 2000.0], nb_directions // 2)
+    scheme = np.column_stack([directions, bvals])
+    return np.vstack([[0, 0, 0, 0], [0, 0, 0, 0], scheme])
+
+
+def _tensors(nb_voxels, seed=0):
+    rng = np.random.default_rng(seed)
+    eigenvalues = rng.uniform(0.1e-3, 1.7e-3, size=(nb_voxels, 3))
+    rotations, _ = np.linalg.qr(rng.normal(size=(nb_voxels, 3, 3)))
+    matrices = np.einsum("vij,vj,vkj->vik", rotations, eigenvalues, rotations)
+    coefficients = matrices[:, [0, 1, 2, 0, 0, 1], [0, 1, 2, 1, 2, 2]]
+    mean = eigenvalues.mean(axis=1, keepdims=True)
+    fa = np.sqrt(
+        1.5 * ((eigenvalues - mean) ** 2).sum(axis=1) / (eigenvalues**2).sum(axis=1)
+    )
+    return coefficients, fa
+
+
+def _signals(coefficients, scheme, s0=1000.0):
+    design = design_matrix(scheme)
+    return s0 * np.exp(coefficients @ design[:, :6].T)
+
+
+def test_fit_tensor():
+    scheme = _scheme()
+    coefficients, fa = _tensors(50)
+    parameters = fit_tensor(_signals(coefficients, scheme), design_matrix(scheme))
+    np.testing.assert_allclose(parameters[:, :6], coefficients, atol=1e-9)
+    np.testing.assert_allclose(np.exp(parameters[:, 6]), 1000.0)
+    np.testing.assert_allclose(fractional_anisotropy(parameters), fa, atol=1e-6)
+
+
+def test_fit_tensor_noise():
+    scheme = _scheme(60)
+    coefficients, fa = _tensors(200, seed=1)
+    signals = _signals(coefficients, scheme)
+    signals += np.random.default_rng(2).normal(scale=5.0, size=signals.shape)
+    parameters = fit_tensor(signals, design_matrix(scheme))
+    assert np.abs(fractional_anisotropy(parameters) - fa).mean() < 0.02
+
+
+def test_write_fa(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Small slabs to go through several chunks
+    monkeypatch.setattr(tensor, "CHUNK_VALUES", 4 * 5 * 32)
+    scheme = _scheme()
+    coefficients, fa = _tensors(4 * 5 * 3, seed=3)
+    signals = _signals(coefficients, scheme).reshape(4, 5, 3, len(scheme))
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    write_mif(
+        "dwi.mif",
+        signals,
+        affine,
+        {"dw_scheme": "\n".join(",".join("%g" % v for v in row) for row in scheme)},
+    )
+    mask = np.ones((4, 5, 3), dtype=bool)
+    mask[0] = False
+    write_mif("mask.mif", mask, affine, datatype="UInt8")
+    image = nibabel.load(write_fa("dwi.mif", mask="mask.mif"))
+    expected = np.where(mask, fa.reshape(4, 5, 3), 0)
+    np.testing.assert_allclose(image.get_fdata(), expected, atol=1e-5)
+    np.testing.assert_allclose(image.affine, affine)
@@ -0,0 +1,228 @@
+"""
+"""
+
+import json
+
+import pytest
+
+from mrproc.workflows.batch import create_batch_dwi_processing_pipeline
+from mrproc.workflows.batch import find_bids_subjects
+from mrproc.workflows.batch import read_manifest
+
+
+def _touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("")
+    return str(path)
+
+
+def _make_bids_subject(root, label, session=None):
+    subject_dir = root / ("sub-" + label)
+    data_dir = subject_dir / session if session else subject_dir
+    prefix = "sub-" + label + ("_" + session if session else "")
+    _touch(data_dir / "dwi" / (prefix + "_dwi.nii.gz"))
+    _touch(data_dir / "dwi" / (prefix + "_dwi.bval"))
+    _touch(data_dir / "dwi" / (prefix + "_dwi.bvec"))
+    _touch(subject_dir / "anat" / ("sub-" + label + "_T1w.nii.gz"))
+
+
+def test_read_manifest_tsv(tmp_path):
+    manifest = tmp_path / "subjects.tsv"
+    manifest.write_text(
+        "subject_id\tdiffusion_volume\tbvals\tbvecs\tt1_volume\n"
+        "sub-01\tdwi.nii.gz\tdwi.bval\tdwi.bvec\tt1.nii.gz\n"
+    )
+    subjects = read_manifest(str(manifest))
+    assert len(subjects) == 1
+    assert subjects[0]["subject_id"] == "sub-01"
+    assert subjects[0]["bvals"] == str(tmp_path / "dwi.bval")
+
+
+def test_read_manifest_json_missing_field(tmp_path):
+    manifest = tmp_path / "subjects.json"
+    manifest.write_text(json.dumps([{"subject_id": "sub-01", "bvals": "b"}]))
+    with pytest.raises(ValueError, match="diffusion_volume"):
+        read_manifest(str(manifest))
+
+
+def test_find_bids_subjects(tmp_path):
+    _make_bids_subject(tmp_path, "01")
+    _make_bids_subject(tmp_path, "02", session="ses-01")
+    (tmp_path / "sub-03").mkdir()
+    subjects = find_bids_subjects(str(tmp_path))
+    assert [s["subject_id"] for s in subjects] == ["sub-01", "sub-02_ses-01"]
+    assert subjects[1]["t1_volume"].endswith("sub-02_T1w.nii.gz")
+    assert find_bids_subjects(str(tmp_path), participant_label=["02"])[0][
+        "subject_id"
+    ].startswith("sub-02")
+
+
+def test_create_batch_dwi_processing_pipeline(tmp_path):
+    subjects = [
+        {
+            "subject_id": "sub-%02d" % i,
+            "diffusion_volume": "dwi.nii.gz",
+            "bvals": "dwi.bval",
+            "bvecs": "dwi.bvec",
+            "t1_volume": "t1.nii.gz",
+        }
+        for i in range(3)
+    ]
+    batch = create_batch_dwi_processing_pipeline(
+        subjects, nb_tracks=1000, output_dir=str(tmp_path)
+    )
+    batch.base_dir = str(tmp_path)
+    execgraph = batch._create_flat_graph()
+    from nipype.pipeline.engine.utils import generate_expanded_graph
+
+    expanded = generate_expanded_graph(execgraph)
+    tractography = [n for n in expanded.nodes() if n.name == "tractography"]
+    assert len(tractography) == len(subjects)
+
+
+def test_cli_sift_arguments():
+    from mrproc.cli import build_parser
+
+    args = build_parser().parse_args(
+        ["subjects.tsv", "-w", "work", "--term-ratio", "0.1", "--seed", "3"]
+    )
+    assert args.term_ratio == 0.1
+    assert args.term_number is None
+    assert args.seed == 3
+
+
+def test_cli_registration_arguments():
+    from mrproc.cli import build_parser
+
+    args = build_parser().parse_args(["subjects.tsv", "-w", "work"])
+    assert args.registration == "nonlinear"
+    assert args.registration_resolution == 1.0
+    args = build_parser().parse_args(
+        ["subjects.tsv", "-w", "work", "--registration", "rigid"]
+    )
+    assert args.registration == "rigid"
+
+
+def test_group_response_batch(tmp_path):
+    from nipype.pipeline.engine.utils import generate_expanded_graph
+
+    from mrproc.workflows.batch import select_response_subjects
+
+    subjects = [
+        {
+            "subject_id": "sub-%02d" % i,
+            "diffusion_volume": "dwi.nii.gz",
+            "bvals": "dwi.bval",
+            "bvecs": "dwi.bvec",
+            "t1_volume": "t1.nii.gz",
+        }
+        for i in range(6)
+    ]
+    subset = select_response_subjects(subjects, 3)
+    assert [subject["subject_id"] for subject in subset] == [
+        "sub-00",
+        "sub-02",
+        "sub-04",
+    ]
+    batch = create_batch_dwi_processing_pipeline(
+        subjects, nb_tracks=1000, group_response=3
+    )
+    batch.base_dir = str(tmp_path)
+    expanded = generate_expanded_graph(batch._create_flat_graph())
+    names = [node.name for node in expanded.nodes()]
+    # responses are only estimated on the subset, FODs for every subject
+    assert names.count("diffusion2response") == 3
+    assert names.count("diffusion2fod") == len(subjects)
+    assert names.count("tractography") == len(subjects)
+    assert names.count("group_response") == 1
+
+
+def test_connectome_batch(tmp_path):
+    subjects = [
+        {
+            "subject_id": "sub-%02d" % i,
+            "diffusion_volume": "dwi.nii.gz",
+            "bvals": "dwi.bval",
+            "bvecs": "dwi.bvec",
+            "t1_volume": "t1.nii.gz",
+            "parcellation": "dseg.nii.gz",
+        }
+        for i in range(2)
+    ]
+    batch = create_batch_dwi_processing_pipeline(
+        subjects, connectome=True, ledger=str(tmp_path / "ledger")
+    )
+    selectfiles = batch.get_node("selectfiles")
+    assert selectfiles.inputs.fields[-1] == "parcellation"
+    assert batch.get_node("record_completion").inputs.parameters["connectome"]
+    del subjects[1]["parcellation"]
+    with pytest.raises(ValueError, match="missing for sub-01"):
+        create_batch_dwi_processing_pipeline(subjects, connectome=True)
+
+
+def test_preview_batch(tmp_path):
+    from mrproc.workflows.dwi_processing import PREVIEW_TRACKS
+
+    subjects = [
+        {
+            "subject_id": "sub-01",
+            "diffusion_volume": "dwi.nii.gz",
+            "bvals": "dwi.bval",
+            "bvecs": "dwi.bvec",
+            "t1_volume": "t1.nii.gz",
+        }
+    ]
+    batch = create_batch_dwi_processing_pipeline(
+        subjects, preview=True, term_ratio=0.1, ledger=str(tmp_path / "ledger")
+    )
+    workflow = batch.get_node("dwi_processing_pipeline")
+    assert workflow.get_node("inputnode").inputs.nb_tracks == PREVIEW_TRACKS
+    core = workflow.get_node("core_dwi_processing_pipeline")
+    assert core.get_node("qc") is not None
+    parameters = batch.get_node("record_completion").inputs.parameters
+    assert parameters["preview"] and parameters["sift_mode"] == "none"
+    assert parameters["term_ratio"] is None
+
+
+def test_compress_outputs(tmp_path):
+    import gzip
+
+    from mrproc.workflows.batch import compress_output_copies
+
+    subjects = [
+        {
+            "subject_id": "sub-01",
+            "diffusion_volume": "dwi.nii.gz",
+            "bvals": "dwi.bval",
+            "bvecs": "dwi.bvec",
+            "t1_volume": "t1.nii.gz",
+        }
+    ]
+    with pytest.raises(ValueError, match="requires an output directory"):
+        create_batch_dwi_processing_pipeline(subjects, compress_outputs=True)
+    batch = create_batch_dwi_processing_pipeline(
+        subjects,
+        intermediate_format="nifti",
+        output_dir=str(tmp_path / "out"),
+        compress_outputs=True,
+        ledger=str(tmp_path / "ledger"),
+    )
+    compress = batch.get_node("compress_outputs")
+    assert compress.inputs.n_procs == 4
+    assert ("compress_outputs", "out_files", "sinked") in {
+        (source.name, output, input)
+        for source, target, data in batch._graph.edges(data=True)
+        if target.name == "record_completion"
+        for output, input in data["connect"]
+    }
+    core = batch.get_node("dwi_processing_pipeline.core_dwi_processing_pipeline")
+    assert core.get_node("tissue_classif").inputs.out_file == "5tt.nii"
+
+    files = [_touch(tmp_path / name) for name in ["wm.mif", "tracks.tck", "t.nii"]]
+    (tmp_path / "wm.mif").write_bytes(b"mrtrix image\n" * 10)
+    compressed = compress_output_copies([files[:2], files[2]], n_procs=2)
+    assert compressed == [files[0] + ".gz", files[1], files[2] + ".gz"]
+    with gzip.open(compressed[0]) as f:
+        assert f.read() == b"mrtrix image\n" * 10
+    # Already compressed by a previous run
+    assert compress_output_copies(files[0]) == [files[0] + ".gz"]
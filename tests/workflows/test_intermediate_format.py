@@ -0,0 +1,37 @@
+import pytest
+
+from mrproc.workflows.dwi_processing import apply_intermediate_format
+from mrproc.workflows.dwi_processing import create_core_dwi_processing_pipeline
+
+
+def test_default_format():
+    core = create_core_dwi_processing_pipeline()
+    apply_intermediate_format(core)
+    assert core.get_node("tissue_classif").inputs.out_file == "5tt.nii.gz"
+    assert core.get_node("bet").inputs.output_type == "NIFTI_GZ"
+    # reg_f3d keeps its own naming
+    assert not core.get_node("reg_f3d").inputs.res_file
+
+
+def test_uncompressed_formats():
+    core = create_core_dwi_processing_pipeline(
+        registration="rigid", qc=True, tensor_backend="numpy"
+    )
+    apply_intermediate_format(core, "mif")
+    assert core.get_node("tissue_classif").inputs.out_file == "5tt.mif"
+    # FA and mask are read by FSL and nibabel
+    assert core.get_node("tensor").get_node("diffusion2fa").inputs.out_file == "fa.nii"
+    assert core.get_node("mask2nifti").inputs.out_file == "mask.nii"
+    for name in ["bet", "resample_fa", "linear_registration"]:
+        assert core.get_node(name).inputs.output_type == "NIFTI"
+
+    core = create_core_dwi_processing_pipeline()
+    apply_intermediate_format(core, "nifti")
+    assert core.get_node("tissue_classif").inputs.out_file == "5tt.nii"
+    assert core.get_node("tensor").get_node("tensor2fa").inputs.out_fa == "fa.nii"
+    assert core.get_node("reg_f3d").inputs.res_file == "t1_registered.nii"
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError, match="Unknown intermediate format"):
+        apply_intermediate_format(create_core_dwi_processing_pipeline(), "nrrd")
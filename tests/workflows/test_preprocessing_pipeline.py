@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from mrproc.workflows.dwi_processing import create_dwi_processing_pipeline
+from mrproc.workflows.dwi_processing import create_preprocessing_pipeline
+
+
+def test_bias_corrected_volume_is_defined():
+    preprocessing = create_preprocessing_pipeline()
+    diffusionbiascorrect = preprocessing.get_node("diffusionbiascorrect")
+    diffusionbiascorrect.inputs.in_file = __file__
+    outputs = diffusionbiascorrect.interface._list_outputs()
+    assert outputs["out_file"] == os.path.abspath("dwi_biascorr.mif")
+
+
+def test_ingest_modes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ["dwi.nii", "dwi.bvec", "dwi.bval"]:
+        (tmp_path / name).write_text("")
+    preprocessing = create_preprocessing_pipeline()
+    diffusionbiascorrect = preprocessing.get_node("diffusionbiascorrect")
+    diffusionbiascorrect.inputs.in_file = "dwi.nii"
+    diffusionbiascorrect.inputs.in_bvec = "dwi.bvec"
+    diffusionbiascorrect.inputs.in_bval = "dwi.bval"
+    assert (
+        "-fslgrad dwi.bvec dwi.bval dwi.nii" in diffusionbiascorrect.interface.cmdline
+    )
+
+    for ingest, entry in [("convert", "mrconvert"), ("header", "diffusion_header")]:
+        workflow = create_dwi_processing_pipeline(ingest=ingest)
+        assert workflow.get_node(entry) is not None
+    workflow = create_dwi_processing_pipeline(ingest="fslgrad")
+    assert workflow.get_node("mrconvert") is None
+    assert workflow.get_node("diffusion_header") is None
+    with pytest.raises(ValueError, match="Unknown ingest mode"):
+        create_dwi_processing_pipeline(ingest="copy")
@@ -0,0 +1,153 @@
+import pytest
+from nipype.pipeline.engine.utils import generate_expanded_graph
+
+from mrproc.cache import CachedNode
+from mrproc.workflows.dwi_processing import create_core_dwi_processing_pipeline
+
+
+def _edges(workflow, target):
+    """(source node, source output, target input) of the connections to a node"""
+    return {
+        (source.name, output, input)
+        for source, _, data in workflow._graph.in_edges(target, data=True)
+        for output, input in data["connect"]
+    }
+
+
+def test_rigid_registration():
+    core = create_core_dwi_processing_pipeline(registration="rigid")
+    assert core.get_node("reg_f3d") is None
+    registration = core.get_node("linear_registration")
+    assert isinstance(registration, CachedNode)
+    assert registration.interface.inputs.dof == 6
+    assert ("resample_fa", "out_file", "reference") in _edges(core, registration)
+    outputnode = core.get_node("outputnode")
+    assert ("invxfm", "out_file", "diffusion_to_t1_transform") in _edges(
+        core, outputnode
+    )
+    tissue_classif = core.get_node("tissue_classif")
+    assert ("linear_registration", "out_file", "in_file") in _edges(
+        core, tissue_classif
+    )
+
+
+def test_registration_resolution():
+    core = create_core_dwi_processing_pipeline(
+        registration="affine", registration_resolution=None
+    )
+    assert core.get_node("resample_fa") is None
+    registration = core.get_node("linear_registration")
+    assert registration.interface.inputs.dof == 12
+    assert ("tensor", "outputnode.fa", "reference") in _edges(core, registration)
+
+    core = create_core_dwi_processing_pipeline(
+        registration_resolution=2.0, registration_levels=2
+    )
+    assert core.get_node("resample_fa").interface.inputs.apply_isoxfm == 2.0
+    reg_f3d = core.get_node("reg_f3d")
+    assert reg_f3d.interface.inputs.lp_val == 2
+    # Cubic B-spline by default, without backward transformation
+    assert not reg_f3d.interface.inputs.vel_flag
+    outputnode = core.get_node("outputnode")
+    assert not any(
+        field == "diffusion_to_t1_transform" for _, _, field in _edges(core, outputnode)
+    )
+
+
+def test_diffeomorphic_registration():
+    core = create_core_dwi_processing_pipeline(registration="diffeomorphic")
+    assert core.get_node("reg_f3d").interface.inputs.vel_flag
+    outputnode = core.get_node("outputnode")
+    assert ("reg_f3d", "invcpp_file", "diffusion_to_t1_transform") in _edges(
+        core, outputnode
+    )
+
+
+def test_unknown_registration():
+    with pytest.raises(ValueError, match="Unknown registration mode"):
+        create_core_dwi_processing_pipeline(registration="bspline")
+
+
+def test_connectome_stage():
+    core = create_core_dwi_processing_pipeline(sift_mode="sift2", connectome=True)
+    connectome = core.get_node("connectome_pipeline")
+    edges = _edges(core, connectome)
+    assert ("reg_f3d", "cpp_file", "inputnode.transform") in edges
+    assert ("resample_fa", "out_file", "inputnode.reference") in edges
+    assert (
+        "tractogram_pipeline",
+        "outputnode.tractogram_weights",
+        "inputnode.tractogram_weights",
+    ) in edges
+    resample = connectome.get_node("parcellation2diffusion")
+    assert resample.interface.inputs.inter_val == "NN"
+
+    core = create_core_dwi_processing_pipeline(registration="rigid", connectome=True)
+    connectome = core.get_node("connectome_pipeline")
+    assert ("linear_registration", "out_matrix_file", "inputnode.transform") in (
+        _edges(core, connectome)
+    )
+    assert create_core_dwi_processing_pipeline().get_node("connectome_pipeline") is None
+
+
+def test_preview_pipeline():
+    from mrproc.workflows.dwi_processing import PREVIEW_TRACKS
+    from mrproc.workflows.dwi_processing import create_preview_pipeline
+
+    workflow = create_preview_pipeline(
+        registration="rigid", registration_resolution=None
+    )
+    assert workflow.get_node("inputnode").inputs.nb_tracks == PREVIEW_TRACKS
+    core = workflow.get_node("core_dwi_processing_pipeline")
+    assert core.get_node("tractogram_pipeline").get_node("sift_filtering") is None
+    assert core.get_node("linear_registration").interface.inputs.dof == 6
+    assert core.get_node("resample_fa") is None
+    qc = core.get_node("qc")
+    assert {
+        ("mask2nifti", "out_file", "mask"),
+        ("tensor", "outputnode.fa", "fa"),
+        ("tensor", "outputnode.fa", "reference"),
+        ("linear_registration", "out_file", "registered_t1"),
+        ("tractogram_pipeline", "outputnode.tractogram", "tractogram"),
+    } == _edges(core, qc)
+    assert ("core_dwi_processing_pipeline", "outputnode.qc_images", "qc_images") in (
+        _edges(workflow, workflow.get_node("outputnode"))
+    )
+    # Upstream stages are those of the full workflow
+    full = create_core_dwi_processing_pipeline(
+        registration="rigid", registration_resolution=None
+    )
+    for name in ["bet", "linear_registration", "tissue_classif"]:
+        assert core.get_node(name).inputs.get_hashval()[1] == (
+            full.get_node(name).inputs.get_hashval()[1]
+        )
+
+
+def _flat_nodes(workflow):
+    graph = generate_expanded_graph(workflow._create_flat_graph())
+    return {node.fullname: node for node in graph.nodes()}
+
+
+def test_full_run_reuses_preview(tmp_path):
+    from mrproc.workflows.dwi_processing import create_dwi_processing_pipeline
+    from mrproc.workflows.dwi_processing import create_preview_pipeline
+
+    preview = create_preview_pipeline()
+    full = create_dwi_processing_pipeline()
+    preview.base_dir = full.base_dir = str(tmp_path)
+    preview_nodes = _flat_nodes(preview)
+    full_nodes = _flat_nodes(full)
+    # A node is cached when a node of the same path had the same inputs
+    shared = {
+        name
+        for name in full_nodes
+        if ".tractogram_pipeline." not in name and name in preview_nodes
+    }
+    assert {name.rsplit(".", 1)[-1] for name in set(full_nodes) - shared} == {
+        "tractography",
+        "sift_filtering",
+    }
+    for name in shared:
+        assert preview_nodes[name].inputs.get_hashval()[1] == (
+            full_nodes[name].inputs.get_hashval()[1]
+        ), name
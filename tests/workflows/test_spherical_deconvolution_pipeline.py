@@ -0,0 +1,61 @@
+import pytest
+
+from mrproc.workflows.dwi_processing import create_dwi_processing_pipeline
+from mrproc.workflows.dwi_processing import create_spherical_deconvolution_pipeline
+
+
+def test_single_job_csd_pipeline():
+    csd = create_spherical_deconvolution_pipeline()
+    assert csd.get_node("split_mask") is None
+    inputnode = csd.get_node("inputnode")
+    diffusion2fod = csd.get_node("diffusion2fod")
+    assert ("mask", "mask_file") in csd._graph.get_edge_data(inputnode, diffusion2fod)[
+        "connect"
+    ]
+
+
+def test_sharded_csd_pipeline():
+    csd = create_spherical_deconvolution_pipeline(nb_slabs=4)
+    split_mask = csd.get_node("split_mask")
+    diffusion2fod = csd.get_node("diffusion2fod")
+    stitch_fods = csd.get_node("stitch_fods")
+    assert split_mask.inputs.nb_slabs == 4
+    assert diffusion2fod.iterfield == ["mask_file"]
+    assert csd._graph.get_edge_data(split_mask, diffusion2fod)["connect"] == [
+        ("slab_masks", "mask_file")
+    ]
+    assert csd._graph.get_edge_data(diffusion2fod, stitch_fods)["connect"] == [
+        ("wm_odf", "wm_files"),
+        ("gm_odf", "gm_files"),
+        ("csf_odf", "csf_files"),
+    ]
+    assert csd._graph.get_edge_data(stitch_fods, csd.get_node("outputnode"))[
+        "connect"
+    ] == [("wm_odf", "wm_fod")]
+    pipeline = create_dwi_processing_pipeline(nb_slabs=2, group_response=True)
+    core = pipeline.get_node("core_dwi_processing_pipeline")
+    assert core.get_node("msmt_csd").get_node("split_mask").inputs.nb_slabs == 2
+    with pytest.raises(ValueError, match="at least 1"):
+        create_spherical_deconvolution_pipeline(nb_slabs=0)
+
+
+def test_response_estimation_pipeline():
+    from mrproc.workflows.dwi_processing import create_response_estimation_pipeline
+
+    csd = create_spherical_deconvolution_pipeline(fod=False)
+    assert csd.get_node("diffusion2fod") is None
+    with pytest.raises(ValueError, match="nothing to estimate"):
+        create_spherical_deconvolution_pipeline(group_response=True, fod=False)
+    workflow = create_response_estimation_pipeline(registration="rigid", nb_slabs=4)
+    names = [node.fullname for node in workflow._create_flat_graph().nodes()]
+    assert "response_estimation_pipeline.core_dwi_processing_pipeline.bet" in names
+    assert (
+        "response_estimation_pipeline.core_dwi_processing_pipeline.msmt_csd."
+        "diffusion2response" in names
+    )
+    assert not [
+        name
+        for name in names
+        if name.rsplit(".", 1)[-1]
+        in ["diffusion2fod", "split_mask", "tractography", "reg_f3d"]
+    ]
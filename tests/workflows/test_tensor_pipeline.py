@@ -0,0 +1,23 @@
+import pytest
+
+from mrproc.workflows.dwi_processing import create_core_dwi_processing_pipeline
+from mrproc.workflows.dwi_processing import create_tensor_pipeline
+
+
+def test_mrtrix_tensor_pipeline():
+    tensor = create_tensor_pipeline()
+    assert tensor.get_node("diffusion2tensor") is not None
+    assert tensor.get_node("diffusion2fa") is None
+
+
+def test_numpy_tensor_pipeline():
+    tensor = create_tensor_pipeline(backend="numpy")
+    assert tensor.get_node("diffusion2tensor") is None
+    assert tensor.get_node("diffusion2fa") is not None
+    core = create_core_dwi_processing_pipeline(tensor_backend="numpy")
+    assert core.get_node("tensor").get_node("diffusion2fa") is not None
+
+
+def test_unknown_tensor_backend():
+    with pytest.raises(ValueError, match="Unknown tensor backend"):
+        create_tensor_pipeline(backend="dipy")
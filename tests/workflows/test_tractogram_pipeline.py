@@ -0,0 +1,160 @@
+import pytest
+
+from mrproc.workflows.dwi_processing import create_dwi_processing_pipeline
+from mrproc.workflows.dwi_processing import create_tractogram_generation_pipeline
+
+
+def test_sharded_tractogram_pipeline():
+    pipeline = create_tractogram_generation_pipeline(nb_shards=4)
+    assert pipeline.get_node("tractography").iterfield == ["select", "rng_seed"]
+    assert pipeline.get_node("merge_shards") is not None
+    assert pipeline.get_node("split_tracks").inputs.nb_shards == 4
+
+
+def test_single_job_tractogram_pipeline():
+    pipeline = create_tractogram_generation_pipeline()
+    assert pipeline.get_node("merge_shards") is None
+    assert not hasattr(pipeline.get_node("tractography"), "iterfield")
+
+
+def test_tractogram_pipeline_seed():
+    pipeline = create_tractogram_generation_pipeline(nb_shards=4)
+    inputnode = pipeline.get_node("inputnode")
+    split_tracks = pipeline.get_node("split_tracks")
+    assert pipeline._graph.get_edge_data(inputnode, split_tracks)["connect"] == [
+        ("nb_tracks", "nb_tracks"),
+        ("seed", "seed"),
+    ]
+    pipeline = create_tractogram_generation_pipeline()
+    inputnode = pipeline.get_node("inputnode")
+    tractography = pipeline.get_node("tractography")
+    assert ("seed", "rng_seed") in pipeline._graph.get_edge_data(
+        inputnode, tractography
+    )["connect"]
+
+
+def test_unfiltered_tractogram_pipeline():
+    pipeline = create_tractogram_generation_pipeline(sift_mode="none")
+    assert pipeline.get_node("sift_filtering") is None
+    tractography = pipeline.get_node("tractography")
+    outputnode = pipeline.get_node("outputnode")
+    assert pipeline._graph.get_edge_data(tractography, outputnode)["connect"] == [
+        ("out_file", "tractogram")
+    ]
+    with pytest.raises(ValueError, match="without SIFT"):
+        create_tractogram_generation_pipeline(sift_mode="none", term_ratio=0.1)
+
+
+def test_compressed_tractogram_pipeline():
+    pipeline = create_tractogram_generation_pipeline(
+        nb_shards=2, sift_mode="sift2", compression_tolerance=0.1
+    )
+    compression = pipeline.get_node("tractogram_compression")
+    assert compression.inputs.tolerance == 0.1
+    merge_shards = pipeline.get_node("merge_shards")
+    sift_filtering = pipeline.get_node("sift_filtering")
+    report = pipeline.get_node("compression_report")
+    assert pipeline._graph.get_edge_data(merge_shards, compression)["connect"] == [
+        ("out_file", "in_file")
+    ]
+    assert ("out_file", "in_file") in pipeline._graph.get_edge_data(
+        compression, sift_filtering
+    )["connect"]
+    assert pipeline._graph.get_edge_data(sift_filtering, report)["connect"] == [
+        ("out_weights", "weights")
+    ]
+    pipeline = create_tractogram_generation_pipeline(
+        sift_mode="none", compression_tolerance=0.1
+    )
+    outputnode = pipeline.get_node("outputnode")
+    assert pipeline._graph.get_edge_data(
+        pipeline.get_node("tractogram_compression"), outputnode
+    )["connect"] == [("out_file", "tractogram")]
+    assert (
+        create_tractogram_generation_pipeline().get_node("compression_report") is None
+    )
+    with pytest.raises(ValueError, match="positive"):
+        create_tractogram_generation_pipeline(compression_tolerance=0)
+
+
+def test_compression_check_pipeline():
+    pipeline = create_tractogram_generation_pipeline(
+        sift_mode="sift",
+        term_ratio=0.5,
+        compression_tolerance=0.1,
+        compression_check=True,
+    )
+    tractography = pipeline.get_node("tractography")
+    reference_sift = pipeline.get_node("reference_sift")
+    assert reference_sift.inputs.term_ratio == 0.5
+    assert ("out_file", "in_file") in pipeline._graph.get_edge_data(
+        tractography, reference_sift
+    )["connect"]
+    assert pipeline._graph.get_edge_data(
+        reference_sift, pipeline.get_node("compression_report")
+    )["connect"] == [("out_file", "reference_tractogram")]
+    with pytest.raises(ValueError, match="compression tolerance"):
+        create_tractogram_generation_pipeline(compression_check=True)
+    with pytest.raises(ValueError, match="compression tolerance"):
+        create_tractogram_generation_pipeline(
+            sift_mode="none", compression_tolerance=0.1, compression_check=True
+        )
+
+
+def test_swept_tractogram_pipeline():
+    pipeline = create_tractogram_generation_pipeline(
+        nb_shards=2,
+        sweep={"nb_tracks": [1000, 2000], "algorithm": ["iFOD2", "SD_Stream"]},
+    )
+    sweep = pipeline.get_node("sweep")
+    assert sweep.synchronize
+    assert sweep.iterables == [
+        ("nb_tracks", [1000, 1000, 2000, 2000]),
+        ("algorithm", ["iFOD2", "SD_Stream", "iFOD2", "SD_Stream"]),
+    ]
+    inputnode = pipeline.get_node("inputnode")
+    split_tracks = pipeline.get_node("split_tracks")
+    assert pipeline._graph.get_edge_data(inputnode, split_tracks)["connect"] == [
+        ("seed", "seed")
+    ]
+    assert pipeline._graph.get_edge_data(sweep, split_tracks)["connect"] == [
+        ("nb_tracks", "nb_tracks")
+    ]
+    assert pipeline._graph.get_edge_data(sweep, pipeline.get_node("tractography"))[
+        "connect"
+    ] == [("algorithm", "algorithm")]
+    with pytest.raises(ValueError, match="Unknown sweep parameter"):
+        create_tractogram_generation_pipeline(sweep={"term_number": [1]})
+    with pytest.raises(ValueError, match="Empty list of values to sweep for seed"):
+        create_tractogram_generation_pipeline(sweep={"seed": []})
+
+
+def test_sweep_scalar_values():
+    from mrproc.workflows.dwi_processing import normalize_sweep
+
+    assert normalize_sweep({"algorithm": "SD_Stream", "seed": 3}) == (
+        ("seed", (3,)),
+        ("algorithm", ("SD_Stream",)),
+    )
+    pipeline = create_tractogram_generation_pipeline(
+        sweep={"algorithm": "iFOD2", "nb_tracks": range(1000, 3000, 1000)}
+    )
+    assert pipeline.get_node("sweep").iterables == [
+        ("nb_tracks", [1000, 2000]),
+        ("algorithm", ["iFOD2", "iFOD2"]),
+    ]
+
+
+def test_sweep_expansion():
+    from nipype.pipeline.engine.utils import generate_expanded_graph
+
+    pipeline = create_dwi_processing_pipeline(
+        sweep={"min_length": [10, 20], "max_length": [200, 250, 300]}
+    )
+    expanded = generate_expanded_graph(pipeline._create_flat_graph())
+    names = [node.name for node in expanded.nodes()]
+    # Upstream stages run once, the tractogram branch once per parameter set
+    assert names.count("diffusion2fod") == 1
+    assert names.count("tissue_classif") == 1
+    assert names.count("tractography") == 6
+    assert names.count("sift_filtering") == 6
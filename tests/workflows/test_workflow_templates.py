@@ -0,0 +1,46 @@
+import pytest
+
+from mrproc.cache import CachedNode
+from mrproc.workflows.dwi_processing import create_dwi_processing_pipeline
+
+
+def test_workflow_copies_are_independent():
+    first = create_dwi_processing_pipeline()
+    second = create_dwi_processing_pipeline()
+    assert first is not second
+    first.get_node("inputnode").inputs.nb_tracks = 1000
+    assert second.get_node("inputnode").inputs.nb_tracks != 1000
+    core = second.get_node("core_dwi_processing_pipeline")
+    assert isinstance(core.get_node("reg_f3d"), CachedNode)
+
+
+def test_workflow_templates_follow_parameters():
+    sift2 = create_dwi_processing_pipeline(nb_shards=2, sift_mode="sift2")
+    tractogram_pipeline = sift2.get_node("core_dwi_processing_pipeline").get_node(
+        "tractogram_pipeline"
+    )
+    assert tractogram_pipeline.get_node("merge_shards") is not None
+    assert "out_weights" in (
+        tractogram_pipeline.get_node("sift_filtering").outputs.copyable_trait_names()
+    )
+    single = create_dwi_processing_pipeline().get_node("core_dwi_processing_pipeline")
+    assert single.get_node("tractogram_pipeline").get_node("merge_shards") is None
+
+
+def test_workflow_options():
+    from mrproc.workflows.dwi_processing import _TEMPLATES
+    from mrproc.workflows.dwi_processing import WORKFLOW_OPTIONS
+    from mrproc.workflows.dwi_processing import workflow_options
+
+    options = workflow_options({"sweep": {"seed": [1, 2]}})
+    assert set(options) == set(WORKFLOW_OPTIONS)
+    assert options["sweep"] == (("seed", (1, 2)),)
+    # Options equal to their defaults share the template of the default workflow
+    create_dwi_processing_pipeline()
+    nb_templates = len(_TEMPLATES)
+    create_dwi_processing_pipeline(nb_shards=1, registration="nonlinear")
+    assert len(_TEMPLATES) == nb_templates
+    with pytest.raises(TypeError, match="nb_track"):
+        create_dwi_processing_pipeline(nb_track=10)
+    with pytest.raises(TypeError, match="ingest"):
+        workflow_options({"ingest": "header"}, ["registration"])